@@ -0,0 +1,191 @@
+"""
+Cold start benchmark for the image service lambda
+
+Every route is measured in a fresh interpreter, the way lambda starts a new execution
+environment: the module import time, the first invocation (which builds the aws clients)
+and a second, warm invocation of the same route. The routes run against an in-process moto
+server (the default) or any LocalStack compatible endpoint, and the script exits non-zero when
+any route answers with a 5xx, since those timings measure a failure rather than a cold start.
+
+    python cold_start_benchmark.py --output cold_start.json
+    python cold_start_benchmark.py --endpoint-url http://localhost.localstack.cloud:4566
+"""
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timezone
+from typing import Any
+from urllib.parse import quote
+
+BENCHMARK_USER_ID = 'cold-start-user'
+BENCHMARK_IMAGE_ID = '00000000-0000-0000-0000-000000000000'
+SAMPLE_PNG_BASE64 = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8/wcAAgEB/RTmVQAAAABJRU5ErkJggg=='
+
+
+def seed_route_state() -> str:
+    """
+    Put the benchmark image in place, as an object issued by create_upload_url and its committed item,
+    and open a multipart upload with one part for it. The delete and complete routes use these up, so
+    this runs before every child and returns the uploadId for it
+    """
+    from image_service_handler import AWSActions, BUCKET_NAME
+
+    s3_key = f"images/{BENCHMARK_USER_ID}/{BENCHMARK_IMAGE_ID}.png"
+    sample_png = base64.b64decode(SAMPLE_PNG_BASE64)
+    object_metadata = {'userid': BENCHMARK_USER_ID, 'imageid': BENCHMARK_IMAGE_ID,
+                       'metadata': quote(json.dumps({'description': 'cold start benchmark'}))}
+    s3_client = AWSActions.get_s3_client()
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=sample_png, ContentType='image/png',
+                         Metadata=object_metadata)
+    AWSActions.put_item_in_to_dynamo_table({
+        'imageId': BENCHMARK_IMAGE_ID,
+        'userId': BENCHMARK_USER_ID,
+        'fileName': f"{BENCHMARK_IMAGE_ID}.png",
+        'contentType': 'image/png',
+        's3Key': s3_key,
+        'status': 'active',
+        'description': 'cold start benchmark',
+        'createdAt': datetime.now(timezone.utc).isoformat(),
+        'variants': {}
+    })
+
+    upload_id = s3_client.create_multipart_upload(Bucket=BUCKET_NAME, Key=s3_key, ContentType='image/png',
+                                                  Metadata={**object_metadata, 'uploadmode': 'multipart'})['UploadId']
+    s3_client.upload_part(Bucket=BUCKET_NAME, Key=s3_key, UploadId=upload_id, PartNumber=1, Body=sample_png)
+    return upload_id
+
+
+def build_event(http_method: str,
+                resource: str,
+                upload_id: str,
+                /) -> dict[str, Any]:
+    """A minimal api gateway event which reaches the aws calls of the route"""
+    event: dict[str, Any] = {
+        'httpMethod': http_method,
+        'resource': resource,
+        'requestContext': {'authorizer': {'claims': {'sub': BENCHMARK_USER_ID}}},
+        'pathParameters': {'imageId': BENCHMARK_IMAGE_ID},
+        'queryStringParameters': None
+    }
+    s3_key = f"images/{BENCHMARK_USER_ID}/{BENCHMARK_IMAGE_ID}.png"
+    metadata = {'description': 'cold start benchmark'}
+
+    if resource == '/images' and http_method == 'POST':
+        event['body'] = json.dumps({'body': SAMPLE_PNG_BASE64,
+                                    'headers': {'content-type': 'image/png',
+                                                'x-image-metadata': json.dumps(metadata)}})
+    elif resource in ('/images/upload-url', '/images/multipart'):
+        event['body'] = json.dumps({'contentType': 'image/png', 'contentLength': 1024, 'metadata': metadata})
+    elif resource in ('/images', '/images:batchGet'):
+        event['body'] = json.dumps({'imageIds': [BENCHMARK_IMAGE_ID]})
+    elif resource.startswith('/images/{imageId}/'):
+        event['body'] = json.dumps({'s3Key': s3_key, 'uploadId': upload_id})
+        event['queryStringParameters'] = {'s3Key': s3_key, 'uploadId': upload_id}
+    return event
+
+
+def measure_route(http_method: str,
+                  resource: str,
+                  endpoint_url: str | None,
+                  upload_id: str,
+                  /) -> dict[str, Any]:
+    """Runs inside the child interpreter, so the import below is a real cold import"""
+    started = time.perf_counter()
+    import image_service_handler
+    import_ms = (time.perf_counter() - started) * 1000
+
+    if endpoint_url:
+        image_service_handler.AWSUtils.ENDPOINT_URL = endpoint_url
+    event = build_event(http_method, resource, upload_id)
+
+    started = time.perf_counter()
+    response = image_service_handler.lambda_handler(event, None)
+    first_invocation_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    image_service_handler.lambda_handler(event, None)
+    warm_invocation_ms = (time.perf_counter() - started) * 1000
+
+    return {
+        'method': http_method,
+        'resource': resource,
+        'importMs': round(import_ms, 2),
+        'firstInvocationMs': round(first_invocation_ms, 2),
+        'warmInvocationMs': round(warm_invocation_ms, 2),
+        'statusCode': response['statusCode'],
+        'boto3Loaded': 'boto3' in sys.modules
+    }
+
+
+def run_benchmark(endpoint_url: str | None,
+                  repeat: int,
+                  /) -> list[dict[str, Any]]:
+    from image_service_handler import Routes
+
+    results = []
+    for http_method, resource in Routes.table:
+        for _ in range(repeat):
+            command = [sys.executable, os.path.abspath(__file__), '--child', http_method, resource,
+                       '--upload-id', seed_route_state()]
+            if endpoint_url:
+                command += ['--endpoint-url', endpoint_url]
+            output = subprocess.run(command, capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint-url', default=None,
+                        help='run against this LocalStack compatible endpoint instead of an in-process moto server')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per route')
+    parser.add_argument('--output', default=None, help='write the json results to this file')
+    parser.add_argument('--child', nargs=2, metavar=('METHOD', 'RESOURCE'), help=argparse.SUPPRESS)
+    parser.add_argument('--upload-id', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_route(args.child[0], args.child[1], args.endpoint_url, args.upload_id)))
+        return 0
+
+    # imported after the child branch, so a child only imports the handler inside measure_route
+    from image_service_handler import AWSClientRegistry, AWSUtils
+    from load_test_benchmark import create_resources, start_moto_server
+
+    server = None
+    if args.endpoint_url:
+        AWSUtils.ENDPOINT_URL = args.endpoint_url
+    else:
+        server, AWSUtils.ENDPOINT_URL = start_moto_server()
+    AWSClientRegistry.reset()
+
+    try:
+        create_resources()
+        results = run_benchmark(AWSUtils.ENDPOINT_URL, args.repeat)
+    finally:
+        if server is not None:
+            server.stop()
+
+    for result in results:
+        print(f"{result['method']:6} {result['resource']:40} import {result['importMs']:8.2f} ms  "
+              f"first {result['firstInvocationMs']:8.2f} ms  warm {result['warmInvocationMs']:8.2f} ms  "
+              f"status {result['statusCode']}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    failures = [result for result in results if result['statusCode'] >= 500]
+    for failure in failures:
+        print(f"FAILED {failure['method']} {failure['resource']} status {failure['statusCode']}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
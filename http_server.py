@@ -0,0 +1,388 @@
+"""
+Local HTTP server mode, runs the image service handlers outside lambda
+
+Real http requests are translated in to the api gateway events ImageServiceHandler expects
+and the lambda responses back in to http responses. Request bodies are read in chunks
+straight in to a buffer of their final size, and image uploads reach the handler as that raw
+buffer rather than base64. The aws clients are built once per worker before it takes traffic
+and shared by every request it serves.
+
+There is no authorizer in front of this server, the user id comes from the USER_ID_HEADER
+header (X-User-Id) which the authenticating proxy in front of it has to set, requests without
+it are refused with 401.
+
+    python http_server.py --port 8080 --workers 4      # stdlib server, HTTP/1.1 keep-alive
+    uvicorn http_server:asgi_app --workers 4           # any ASGI server
+    gunicorn -w 4 --threads 16 http_server:wsgi_app    # any WSGI server
+"""
+import argparse
+import asyncio
+import base64
+import os
+import re
+import signal
+import threading
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterable
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from image_service_handler import (AWSActions, ImageRequirements, JsonCodec, ProcessingSettings, Routes,
+                                   UsageSettings, Utils, lambda_handler, logger)
+
+
+class ServerSettings:
+    host = os.environ.get('SERVER_HOST', '127.0.0.1')
+    port = int(os.environ.get('SERVER_PORT', '8080'))
+    workers = int(os.environ.get('SERVER_WORKERS', str(os.cpu_count() or 1)))
+    # threads running the handlers for the ASGI adapter, the handlers block on aws calls
+    threads = int(os.environ.get('SERVER_THREADS', '32'))
+    user_header = os.environ.get('USER_ID_HEADER', 'X-User-Id')
+    keep_alive_timeout = int(os.environ.get('SERVER_KEEP_ALIVE_TIMEOUT', '75'))
+    read_chunk_size = 64 * 1024
+    write_chunk_size = 64 * 1024
+    # an image in the json envelope is base64, a third larger than the image itself
+    max_body_size = ImageRequirements.max_size * 4 // 3 + 64 * 1024
+
+
+class RouteMatcher:
+    """Request paths to the api gateway resource of Routes.table, literal resources win over templates"""
+
+    def __init__(self,
+                 resources: Iterable[str],
+                 /):
+        self.patterns = [
+            (resource, re.compile('^' + re.sub(r'\\{(\w+)\\}', r'(?P<\1>[^/]+)', re.escape(resource)) + '$'))
+            for resource in sorted(set(resources), key=lambda resource: (resource.count('{'), resource))
+        ]
+
+    def match(self,
+              path: str,
+              /) -> tuple[str, dict[str, str] | None]:
+        """(resource, pathParameters), an unknown path is its own resource and dispatch answers 404"""
+        for resource, pattern in self.patterns:
+            matched = pattern.match(path)
+            if matched:
+                return resource, matched.groupdict() or None
+        return path, None
+
+
+route_matcher = RouteMatcher(resource for _, resource in Routes.table)
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def prewarm() -> None:
+    """Build the aws clients and tables of the handlers, and load the json backend, before any request"""
+    JsonCodec.backend()
+    AWSActions.get_s3_client()
+    for get_table in (AWSActions.get_dynamodb_table, AWSActions.get_blob_table, AWSActions.get_search_table):
+        get_table()
+    if UsageSettings.enabled:
+        AWSActions.get_usage_table()
+    if ProcessingSettings.enabled and ProcessingSettings.queue_url:
+        AWSActions.get_sqs_client()
+    return None
+
+
+def handler_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ServerSettings.threads, thread_name_prefix='handler')
+    return _executor
+
+
+def read_body(read: Callable[[int], bytes],
+              length: int,
+              /) -> bytearray:
+    """Read a body of known length a chunk at a time in to a buffer allocated once"""
+    body = bytearray(length)
+    received = 0
+    while received < length:
+        chunk = read(min(ServerSettings.read_chunk_size, length - received))
+        if not chunk:
+            raise ConnectionError(f"Request body ended after {received} of {length} bytes")
+        body[received:received + len(chunk)] = chunk
+        received += len(chunk)
+    return body
+
+
+def parse_content_length(value: str | None,
+                         /) -> int | None:
+    """Length a Content-Length header gives, 0 when it is absent and None when it is not a plain decimal"""
+    if not value:
+        return 0
+    value = value.strip()
+    return int(value) if value.isascii() and value.isdigit() else None
+
+
+def build_event(method: str,
+                path: str,
+                query_string: str,
+                headers: Iterable[tuple[str, str]],
+                body: bytearray,
+                /) -> dict[str, Any] | None:
+    """The api gateway proxy event of a request, None when the request carries no user"""
+    header_values: dict[str, list[str]] = {}
+    for name, value in headers:
+        header_values.setdefault(name.lower(), []).append(value)
+    user_id = header_values.get(ServerSettings.user_header.lower(), [None])[0]
+    if not user_id:
+        return None
+
+    resource, path_parameters = route_matcher.match(path)
+    query_values = parse_qs(query_string, keep_blank_values=True)
+    event: dict[str, Any] = {
+        'httpMethod': method,
+        'resource': resource,
+        'path': path,
+        'pathParameters': path_parameters,
+        'queryStringParameters': {name: values[-1] for name, values in query_values.items()} or None,
+        'multiValueQueryStringParameters': query_values or None,
+        'headers': {name: ','.join(values) for name, values in header_values.items()},
+        'multiValueHeaders': header_values,
+        'requestContext': {'requestId': str(uuid.uuid4()),
+                           'resourcePath': resource,
+                           'httpMethod': method,
+                           'authorizer': {'claims': {'sub': user_id}}},
+        'body': None,
+        'isBase64Encoded': False
+    }
+    if not body:
+        return event
+
+    if Utils.event_header(event, 'content-type').startswith('image/'):
+        event['body'] = body
+        return event
+    try:
+        event['body'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        event['body'] = base64.b64encode(body).decode()
+        event['isBase64Encoded'] = True
+    return event
+
+
+def encode_response(response: dict[str, Any],
+                    /) -> tuple[int, list[tuple[str, str]], bytes]:
+    """(status, headers, body) of a lambda proxy response"""
+    body = response.get('body') or ''
+    payload = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode()
+    headers = [(name, str(value)) for name, value in (response.get('headers') or {}).items()
+               if name.lower() != 'content-length']
+    headers.append(('Content-Length', str(len(payload))))
+    return response['statusCode'], headers, payload
+
+
+def error_response(status_code: int,
+                   message: str,
+                   /) -> tuple[int, list[tuple[str, str]], bytes]:
+    return encode_response(Utils.create_response(status_code, {'message': message}))
+
+
+def handle(method: str,
+           path: str,
+           query_string: str,
+           headers: Iterable[tuple[str, str]],
+           body: bytearray,
+           /) -> tuple[int, list[tuple[str, str]], bytes]:
+    """Run one request through lambda_handler, the adapters below only move bytes"""
+    event = build_event(method, path, query_string, headers, body)
+    if event is None:
+        return error_response(401, "Unauthorized")
+    return encode_response(lambda_handler(event, None))
+
+
+async def asgi_app(scope: dict[str, Any],
+                   receive: Callable[[], Any],
+                   send: Callable[[dict[str, Any]], Any],
+                   /) -> None:
+    """
+    ASGI application. The handlers are synchronous and run their own event loops for concurrent
+    aws calls, so they run on the handler threads and never on the server's loop
+    """
+    loop = asyncio.get_running_loop()
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await loop.run_in_executor(handler_executor(), prewarm)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return None
+    if scope['type'] != 'http':
+        return None
+
+    headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+    content_length = next((value for name, value in headers if name.lower() == 'content-length'), None)
+    length = parse_content_length(content_length) if content_length else None
+    if content_length and length is None:
+        response = error_response(400, "Malformed Content-Length")
+    elif length is not None and length > ServerSettings.max_body_size:
+        response = error_response(413, "Request body too large")
+    else:
+        body = bytearray(length or 0)
+        received, more_body = 0, True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            if length is None:
+                body += chunk
+            else:
+                body[received:received + len(chunk)] = chunk
+            received += len(chunk)
+            more_body = message.get('more_body', False) and received <= ServerSettings.max_body_size
+
+        if received > ServerSettings.max_body_size:
+            response = error_response(413, "Request body too large")
+        else:
+            response = await loop.run_in_executor(handler_executor(), handle, scope['method'], scope['path'],
+                                                  scope.get('query_string', b'').decode('latin-1'), headers,
+                                                  body)
+
+    status_code, response_headers, payload = response
+    await send({'type': 'http.response.start',
+                'status': status_code,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response_headers]})
+    view = memoryview(payload)
+    for offset in range(0, len(payload), ServerSettings.write_chunk_size):
+        await send({'type': 'http.response.body',
+                    'body': bytes(view[offset:offset + ServerSettings.write_chunk_size]),
+                    'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    return None
+
+
+def wsgi_app(environ: dict[str, Any],
+             start_response: Callable[..., Any],
+             /) -> Iterable[bytes]:
+    """WSGI application, run it with worker threads since every request blocks on aws calls"""
+    headers = [(name[5:].replace('_', '-').title(), value) for name, value in environ.items()
+               if name.startswith('HTTP_')]
+    for name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if environ.get(name):
+            headers.append((name.replace('_', '-').title(), environ[name]))
+
+    length = parse_content_length(environ.get('CONTENT_LENGTH'))
+    if length is None:
+        status_code, response_headers, payload = error_response(400, "Malformed Content-Length")
+    elif length > ServerSettings.max_body_size:
+        status_code, response_headers, payload = error_response(413, "Request body too large")
+    else:
+        body = read_body(environ['wsgi.input'].read, length)
+        path = environ.get('PATH_INFO', '').encode('latin-1').decode('utf-8', 'replace')
+        status_code, response_headers, payload = handle(environ['REQUEST_METHOD'], path,
+                                                        environ.get('QUERY_STRING', ''), headers, body)
+
+    start_response(f"{status_code} {HTTPStatus(status_code).phrase}", response_headers)
+    return [payload]
+
+
+class LocalRequestHandler(BaseHTTPRequestHandler):
+    """HTTP/1.1 handler of the stdlib server, connections are kept alive until idle for keep_alive_timeout"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'ImageHost'
+    timeout = ServerSettings.keep_alive_timeout
+
+    def dispatch(self) -> None:
+        length = parse_content_length(self.headers.get('Content-Length'))
+        if self.headers.get('Transfer-Encoding'):
+            status_code, headers, payload = error_response(411, "Content-Length required")
+            self.close_connection = True
+        elif length is None:
+            status_code, headers, payload = error_response(400, "Malformed Content-Length")
+            self.close_connection = True
+        elif length > ServerSettings.max_body_size:
+            status_code, headers, payload = error_response(413, "Request body too large")
+            self.close_connection = True
+        else:
+            split_path = urlsplit(self.path)
+            body = read_body(self.rfile.read, length)
+            status_code, headers, payload = handle(self.command, unquote(split_path.path), split_path.query,
+                                                   self.headers.items(), body)
+
+        self.send_response(status_code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        return None
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = dispatch
+
+    def log_message(self,
+                    format: str,
+                    *args: Any) -> None:
+        logger.debug("%s " + format, self.address_string(), *args)
+        return None
+
+
+def serve(host: str,
+          port: int,
+          workers: int,
+          /) -> None:
+    """
+    Serve on host:port with the stdlib server. With several workers the listening socket is
+    bound once and shared by forked processes, each building its own aws clients after the fork
+    """
+    server = ThreadingHTTPServer((host, port), LocalRequestHandler)
+    server.daemon_threads = True
+    logger.info(f"Serving on http://{host}:{server.server_address[1]} with {workers} worker(s)")
+    if workers <= 1:
+        prewarm()
+        server.serve_forever()
+        return None
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                prewarm()
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                logger.error(f"Worker {os.getpid()} stopped: {str(e)}")
+                exit_code = 1
+            os._exit(exit_code)
+        children.append(pid)
+    server.socket.close()
+
+    def stop(signum: int, frame: Any) -> None:
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except (KeyboardInterrupt, SystemExit):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=ServerSettings.host)
+    parser.add_argument('--port', type=int, default=ServerSettings.port)
+    parser.add_argument('--workers', type=int, default=ServerSettings.workers, help='forked worker processes')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
+
+
+if __name__ == '__main__':
+    main()
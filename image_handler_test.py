@@ -3,8 +3,26 @@ import unittest
 from unittest.mock import patch, MagicMock
 import json
 import base64
+import os
+import time
 from image_service_handler import ImageServiceHandler
 from image_service_handler import  AWSActions
+from image_service_handler import AWSClientRegistry
+from image_service_handler import s3_event_handler, lambda_handler
+from image_service_handler import image_cache, ImageCache
+from image_service_handler import ImageVariants
+from image_service_handler import JsonLogFormatter, StructuredLogging
+from image_service_handler import Instrumentation
+from image_service_handler import MultipartUploader, MultipartUploadError
+from image_service_handler import ImageInspector, ImageRequirements
+from image_service_handler import BatchSettings, BufferReader, ImageServiceError, Utils
+from image_service_handler import SearchIndex
+from image_service_handler import ImageProcessing, LocalProcessingQueue, processing_queue_handler
+from image_service_handler import JsonCodec
+from image_service_handler import AccessTracker, TieringJob, UsageSettings
+from image_service_handler import Resilience, ResilienceSettings
+from image_service_handler import AsyncAWSActions, ContentStore, ReconciliationJob
+from http_server import asgi_app, build_event, wsgi_app
 
 
 class TestImageService(unittest.TestCase):
@@ -26,14 +44,17 @@ class TestImageService(unittest.TestCase):
         }
         self.available_image_id = "67df89b4-cbaf-4248-8227-83439e71523a"
         self.available_user_id = "default-user-id"
+        image_cache.clear()
 
     def tearDown(self):
         # Ensures all mocks are removed after each test
         patch.stopall()
 
+    @patch('image_service_handler.AWSActions.get_search_table')
+    @patch('image_service_handler.AWSActions.get_blob_table')
     @patch('image_service_handler.AWSActions.get_s3_client')
     @patch('image_service_handler.AWSActions.get_dynamodb_table')
-    def test_upload_image_success(self, mock_table, mock_s3):
+    def test_upload_image_success(self, mock_table, mock_s3, mock_blob_table, mock_search_table):
         """Test successful image upload"""
         # Prepare test data
         metadata = {
@@ -41,10 +62,10 @@ class TestImageService(unittest.TestCase):
             'description': 'Test Description'
         }
         json_body = {
-            'body': base64.b64encode(self.fake_image_encoded).decode(),
+            'body': self.fake_image_encoded.decode(),
             'isBase64Encoded': True,
             'headers': {
-                'content-type': 'image/jpeg',
+                'content-type': 'image/png',
                 'x-image-metadata': json.dumps(metadata)
             }
         }
@@ -55,8 +76,10 @@ class TestImageService(unittest.TestCase):
             "body": json.dumps(json_body),
         }
 
-        mock_s3.put_object.return_value = {}
-        mock_table.put_item.return_value = {}
+        mock_s3.return_value.put_object.return_value = {}
+        mock_table.return_value.put_item.return_value = {}
+        mock_blob_table.return_value.update_item.return_value = {'Attributes': {'refCount': 1}}
+        mock_search_table.return_value.meta.client.batch_write_item.return_value = {}
 
         response = ImageServiceHandler().upload_image(event)
 
@@ -64,12 +87,18 @@ class TestImageService(unittest.TestCase):
         response_body = json.loads(response['body'])
         self.assertIn('imageId', response_body)
         self.assertIn('metadata', response_body)
+        self.assertEqual(response_body['metadata']['titleTokens'], ['test', 'image'])
+        postings = mock_search_table.return_value.meta.client.batch_write_item.call_args.kwargs['RequestItems']
+        self.assertEqual(sorted(request['PutRequest']['Item']['searchTerm'] for requests in postings.values()
+                                for request in requests),
+                         [f"{self.user_id}#token#image", f"{self.user_id}#token#test"])
 
-        mock_s3.put_object.assert_called_once()
-        mock_table.put_item.assert_called_once()
+        mock_s3.return_value.put_object.assert_called_once()
+        mock_table.return_value.put_item.assert_called_once()
 
     @patch('image_service_handler.AWSActions.get_dynamodb_table')
-    def test_list_images_with_filters(self, mock_table):
+    @patch('image_service_handler.AWSActions.get_search_table')
+    def test_list_images_with_filters(self, mock_search_table, mock_table):
         # Prepare test data
         test_images = [
             {
@@ -83,15 +112,56 @@ class TestImageService(unittest.TestCase):
             **self.auth_context,
             'queryStringParameters': {
                 'title': 'Test',
-                'tag': 'example'
+                'tag': 'Example'
             }
         }
 
-        mock_table.scan.return_value = {'Items': test_images}
+        postings = {
+            f"{self.user_id}#tag#example": [{'sortKey': '2024-01-02T00:00:00+00:00#image1'},
+                                            {'sortKey': '2024-01-01T00:00:00+00:00#image2'}],
+            f"{self.user_id}#token#test": [{'sortKey': '2024-01-02T00:00:00+00:00#image1'},
+                                           {'sortKey': '2024-01-03T00:00:00+00:00#image3'}]
+        }
+        mock_search_table.return_value.query.side_effect = \
+            lambda **kwargs: {'Items': postings[kwargs['ExpressionAttributeValues'][':term']]}
+        mock_table.return_value.name = 'ImageMetaData'
+        mock_table.return_value.meta.client.batch_get_item.return_value = {'Responses': {'ImageMetaData': test_images}}
 
         response = ImageServiceHandler().list_images(event)
 
         self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(json.loads(response['body'])['images'], test_images)
+        mock_table.return_value.scan.assert_not_called()
+        mock_table.return_value.query.assert_not_called()
+        self.assertEqual(mock_search_table.return_value.query.call_count, 2)
+        query_kwargs = mock_search_table.return_value.query.call_args.kwargs
+        self.assertEqual(query_kwargs['KeyConditionExpression'], 'searchTerm = :term')
+        self.assertFalse(query_kwargs['ScanIndexForward'])
+        batch_get_kwargs = mock_table.return_value.meta.client.batch_get_item.call_args.kwargs
+        self.assertEqual(batch_get_kwargs['RequestItems']['ImageMetaData']['Keys'],
+                         [{'imageId': 'image1', 'userId': self.user_id}])
+
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_list_images_pagination(self, mock_table):
+        last_key = {'imageId': 'image1', 'userId': self.user_id, 'createdAt': '2024-01-01T00:00:00+00:00'}
+        mock_table.return_value.query.return_value = {'Items': [{'imageId': 'image1'}],
+                                                      'LastEvaluatedKey': last_key}
+
+        event = {**self.auth_context, 'queryStringParameters': {'limit': '1'}}
+        response_body = json.loads(ImageServiceHandler().list_images(event)['body'])
+        self.assertIsNotNone(response_body['nextToken'])
+
+        event = {**self.auth_context,
+                 'queryStringParameters': {'limit': '1', 'nextToken': response_body['nextToken']}}
+        response = ImageServiceHandler().list_images(event)
+        self.assertEqual(response['statusCode'], 200)
+        query_kwargs = mock_table.return_value.query.call_args.kwargs
+        self.assertEqual(query_kwargs['ExclusiveStartKey'], last_key)
+        self.assertEqual(query_kwargs['Limit'], 1)
+
+        other_user_event = {'queryStringParameters': {'nextToken': response_body['nextToken']}}
+        response = ImageServiceHandler().list_images(other_user_event)
+        self.assertEqual(response['statusCode'], 400)
 
     @patch('image_service_handler.AWSActions.get_s3_client')
     @patch('image_service_handler.AWSActions.get_dynamodb_table')
@@ -111,8 +181,8 @@ class TestImageService(unittest.TestCase):
         }
 
         # Configure mocks
-        mock_table.get_item.return_value = {'Item': test_metadata}
-        mock_s3.generate_presigned_url.return_value = 'https://test-url'
+        mock_table.return_value.get_item.return_value = {'Item': test_metadata}
+        mock_s3.return_value.generate_presigned_url.return_value = 'https://test-url'
 
         response = ImageServiceHandler().get_image(event)
 
@@ -149,8 +219,8 @@ class TestImageService(unittest.TestCase):
         self.assertTrue(any('Image not found' in str(value) for value in response_body.values()))
 
 
-    @patch('image_service_handler.AWSActions.get_dynamodb_table')
     @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
     def test_delete_image_success(self, mock_get_dynamodb_table, mock_s3):
         test_metadata = {
             'imageId': self.available_image_id,
@@ -165,9 +235,9 @@ class TestImageService(unittest.TestCase):
         }
         mock_table = MagicMock()
         # Configure mocks
-        mock_get_dynamodb_table.get_item.return_value = {'Item': test_metadata}
+        mock_table.get_item.return_value = {'Item': test_metadata}
         mock_get_dynamodb_table.return_value = mock_table
-        mock_s3.delete_object.return_value = {}
+        mock_s3.return_value.delete_object.return_value = {}
         mock_table.delete_item.return_value = {}
 
         # Execute test
@@ -212,7 +282,7 @@ class TestImageService(unittest.TestCase):
 
     def test_invalid_image_type(self):
         json_body = {
-            'body': base64.b64encode(self.fake_image_encoded).decode(),
+            'body': self.fake_image_encoded.decode(),
             'isBase64Encoded': True,
             'headers': {
                 'content-type': 'text/plain',
@@ -229,15 +299,15 @@ class TestImageService(unittest.TestCase):
 
         response = ImageServiceHandler().upload_image(event)
         self.assertEqual(response['statusCode'], 400)
-        self.assertIn('Unsupported image type', json.loads(response['body']['message']))
+        self.assertIn('Unsupported image type', json.loads(response['body'])['message'])
 
     def test_invalid_image_size(self):
-        fake_image_length = self.fake_image_encoded * 10000
+        fake_image_length = base64.b64decode(self.fake_image_encoded) + bytes(ImageRequirements.max_size)
         json_body = {
             'body': base64.b64encode(fake_image_length).decode(),
             'isBase64Encoded': True,
             'headers': {
-                'content-type': 'image/jpeg',
+                'content-type': 'image/png',
                 'x-image-metadata': json.dumps({
                     'title': 'Test',
                     'description': 'Test'
@@ -252,7 +322,1232 @@ class TestImageService(unittest.TestCase):
 
         response = ImageServiceHandler().upload_image(event)
         self.assertEqual(response['statusCode'], 400)
-        self.assertIn('error', json.loads(response['body']))
+        self.assertIn('exceeds maximum allowed size', json.loads(response['body'])['message'])
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    def test_create_upload_url_presigned_post(self, mock_s3):
+        mock_s3.return_value.generate_presigned_post.return_value = {'url': 'https://test-bucket',
+                                                                     'fields': {'key': 'k'}}
+        event = {
+            **self.auth_context,
+            'body': json.dumps({'contentType': 'image/png',
+                                'contentLength': 1024,
+                                'metadata': {'description': 'Test Description'}})
+        }
+
+        response = ImageServiceHandler().create_upload_url(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        response_body = json.loads(response['body'])
+        self.assertTrue(response_body['s3Key'].startswith(f"images/{self.user_id}/{response_body['imageId']}"))
+        post_kwargs = mock_s3.return_value.generate_presigned_post.call_args.kwargs
+        self.assertIn(['content-length-range', 1, 5 * 1024 * 1024], post_kwargs['Conditions'])
+        self.assertIn({'Content-Type': 'image/png'}, post_kwargs['Conditions'])
+
+    def test_create_upload_url_rejects_oversized_image(self):
+        event = {
+            **self.auth_context,
+            'body': json.dumps({'contentType': 'image/png',
+                                'contentLength': 50 * 1024 * 1024,
+                                'metadata': {'description': 'Test Description'}})
+        }
+
+        response = ImageServiceHandler().create_upload_url(event)
+        self.assertEqual(response['statusCode'], 400)
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_s3_event_registers_direct_upload(self, mock_table, mock_s3):
+        s3_key = f"images/{self.user_id}/{self.image_id}.png"
+        mock_s3.return_value.head_object.return_value = {
+            'ContentType': 'image/png',
+            'ContentLength': 1024,
+            'Metadata': {'userid': self.user_id,
+                         'imageid': self.image_id,
+                         'metadata': '%7B%22description%22%3A%22Test%22%7D'}
+        }
+        event = {'Records': [{'s3': {'object': {'key': s3_key}}},
+                             {'s3': {'object': {'key': 'unrelated/key.png'}}}]}
+
+        result = s3_event_handler(event, None)
+
+        self.assertEqual(result['registered'], [self.image_id])
+        item = mock_table.return_value.put_item.call_args.kwargs['Item']
+        self.assertEqual(item['s3Key'], s3_key)
+        self.assertEqual(item['description'], 'Test')
+
+    @patch('image_service_handler.AWSActions.get_search_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_registration_re_drives_a_pending_item(self, mock_table, mock_s3, mock_search_table):
+        from botocore.exceptions import ClientError
+        s3_key = f"images/{self.user_id}/{self.image_id}.png"
+        mock_s3.return_value.head_object.return_value = {
+            'ContentType': 'image/png',
+            'ContentLength': 1024,
+            'Metadata': {'userid': self.user_id, 'imageid': self.image_id,
+                         'metadata': '%7B%22description%22%3A%22Test%22%2C%22tags%22%3A%5B%22sea%22%5D%7D'}
+        }
+        mock_table.return_value.name = 'images'
+        mock_table.return_value.put_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        pending = {'imageId': self.image_id, 'userId': self.user_id, 's3Key': s3_key, 'status': 'pending',
+                   'statusChangedAt': '2024-01-01T00:00:00+00:00', 'createdAt': '2024-01-01T00:00:00+00:00',
+                   'tags': ['sea'], 'sizeBytes': 1024}
+        mock_table.return_value.get_item.return_value = {'Item': pending}
+        mock_search_table.return_value.meta.client.batch_write_item.return_value = {}
+
+        item = ImageServiceHandler().register_uploaded_object(s3_key)
+
+        self.assertEqual(item['status'], 'active')
+        mock_search_table.return_value.meta.client.batch_write_item.assert_called_once()
+        update = mock_table.return_value.meta.client.transact_write_items.call_args.kwargs['TransactItems'][0]
+        self.assertEqual(update['Update']['ConditionExpression'], '#status = :pending')
+
+        mock_table.return_value.get_item.return_value = {'Item': {**pending, 'status': 'active'}}
+        mock_search_table.return_value.meta.client.batch_write_item.reset_mock()
+        self.assertEqual(ImageServiceHandler().register_uploaded_object(s3_key)['status'], 'active')
+        mock_search_table.return_value.meta.client.batch_write_item.assert_not_called()
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    def test_multipart_uploader_uploads_parts(self, mock_s3):
+        mock_s3.return_value.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.return_value.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+        body = b'x' * (11 * 1024 * 1024)
+
+        MultipartUploader(part_size=5 * 1024 * 1024).upload('bucket', 'key', body, 'image/tiff', {})
+
+        self.assertEqual(mock_s3.return_value.upload_part.call_count, 3)
+        parts = mock_s3.return_value.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+        self.assertEqual([part['PartNumber'] for part in parts], [1, 2, 3])
+        mock_s3.return_value.abort_multipart_upload.assert_not_called()
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    def test_multipart_uploader_aborts_on_failure(self, mock_s3):
+        mock_s3.return_value.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.return_value.upload_part.side_effect = Exception('SlowDown')
+
+        with self.assertRaises(MultipartUploadError) as error:
+            MultipartUploader().upload('bucket', 'key', b'x' * 1024, 'image/tiff', {})
+
+        self.assertEqual(error.exception.upload_id, 'upload-1')
+        mock_s3.return_value.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='key',
+                                                                            UploadId='upload-1')
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    def test_multipart_uploader_resumes_uploaded_parts(self, mock_s3):
+        part_size = 5 * 1024 * 1024
+        mock_s3.return_value.get_paginator.return_value.paginate.return_value = [
+            {'Parts': [{'PartNumber': 1, 'ETag': 'etag-1', 'Size': part_size}]}
+        ]
+        mock_s3.return_value.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+
+        MultipartUploader(part_size=part_size).upload('bucket', 'key', b'x' * (part_size + 10), 'image/tiff', {},
+                                                      upload_id='upload-1')
+
+        mock_s3.return_value.create_multipart_upload.assert_not_called()
+        mock_s3.return_value.upload_part.assert_called_once()
+        self.assertEqual(mock_s3.return_value.upload_part.call_args.kwargs['PartNumber'], 2)
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    def test_create_multipart_upload_presigns_parts(self, mock_s3):
+        mock_s3.return_value.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_s3.return_value.generate_presigned_url.return_value = 'https://part-url'
+        event = {
+            **self.auth_context,
+            'body': json.dumps({'contentType': 'image/tiff',
+                                'contentLength': 100 * 1024 * 1024,
+                                'partSize': 10 * 1024 * 1024,
+                                'metadata': {'description': 'Test Description'}})
+        }
+
+        response = ImageServiceHandler().create_multipart_upload(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        response_body = json.loads(response['body'])
+        self.assertEqual(response_body['uploadId'], 'upload-1')
+        self.assertEqual(len(response_body['parts']), 10)
+        metadata = mock_s3.return_value.create_multipart_upload.call_args.kwargs['Metadata']
+        self.assertEqual(metadata['uploadmode'], 'multipart')
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    def test_complete_multipart_upload_validates_client_parts(self, mock_s3):
+        s3_key = f"images/{self.user_id}/{self.image_id}.tiff"
+        event = {**self.auth_context, 'httpMethod': 'POST', 'pathParameters': {'imageId': self.image_id}}
+
+        for parts in ([], [{'PartNumber': 1, 'ETag': 'etag-1'}], [{'partNumber': '1', 'etag': 'etag-1'}],
+                      [{'partNumber': 2, 'etag': 'etag-2'}, {'partNumber': 1, 'etag': 'etag-1'}]):
+            event['body'] = json.dumps({'s3Key': s3_key, 'uploadId': 'upload-1', 'parts': parts})
+            self.assertEqual(ImageServiceHandler().complete_multipart_upload(event)['statusCode'], 400)
+        mock_s3.return_value.complete_multipart_upload.assert_not_called()
+
+        event['body'] = json.dumps({'s3Key': s3_key, 'uploadId': 'upload-1',
+                                    'parts': [{'partNumber': 1, 'etag': 'etag-1'}]})
+        mock_s3.return_value.head_object.side_effect = Exception('NoSuchKey')
+        ImageServiceHandler().complete_multipart_upload(event)
+        self.assertEqual(mock_s3.return_value.complete_multipart_upload.call_args.kwargs['MultipartUpload'],
+                         {'Parts': [{'PartNumber': 1, 'ETag': 'etag-1'}]})
+
+        self.assertEqual(Utils.parse_upload_parts([{'partNumber': 1, 'etag': 'etag-1'},
+                                                   {'partNumber': 3, 'etag': 'etag-3'}]),
+                         [{'PartNumber': 1, 'ETag': 'etag-1'}, {'PartNumber': 3, 'ETag': 'etag-3'}])
+
+    @patch('image_service_handler.time.sleep')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_delete_images_batch(self, mock_table, mock_s3, mock_sleep):
+        table = mock_table.return_value
+        table.name = 'ImageMetaData'
+        table.meta.client.batch_get_item.return_value = {
+            'Responses': {'ImageMetaData': [{'imageId': 'image1', 's3Key': 'images/image1.png'},
+                                            {'imageId': 'image2', 's3Key': 'images/image2.png'},
+                                            {'imageId': 'image3', 's3Key': 'images/image3.png'}]}
+        }
+        mock_s3.return_value.delete_objects.return_value = {
+            'Errors': [{'Key': 'images/image3.png', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+        }
+        unprocessed = {'ImageMetaData': [{'DeleteRequest': {'Key': {'imageId': 'image2',
+                                                                    'userId': self.user_id}}}]}
+        table.meta.client.batch_write_item.side_effect = [{'UnprocessedItems': unprocessed},
+                                                          {'UnprocessedItems': {}}]
+        event = {
+            **self.auth_context,
+            'body': json.dumps({'imageIds': ['image1', 'image2', 'image3', 'missing', 'image1']})
+        }
+
+        response = ImageServiceHandler().delete_images(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        response_body = json.loads(response['body'])
+        statuses = {result['imageId']: result['status'] for result in response_body['results']}
+        self.assertEqual(statuses, {'image1': 'deleted', 'image2': 'deleted',
+                                    'image3': 'failed', 'missing': 'not_found'})
+        self.assertEqual(table.meta.client.batch_write_item.call_count, 2)
+        mock_sleep.assert_called_once()
+        mock_s3.return_value.delete_objects.assert_called_once()
+
+    @patch('image_service_handler.ContentStore.release')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_delete_all_images_works_page_by_page(self, mock_table, mock_s3, mock_release):
+        table = mock_table.return_value
+        table.meta.client.batch_write_item.return_value = {}
+        table.query.side_effect = [
+            {'Items': [{'imageId': 'image1', 's3Key': 'blobs/shared', 'sha256': 'shared'},
+                       {'imageId': 'image2', 's3Key': 'blobs/own', 'sha256': 'own'}],
+             'LastEvaluatedKey': {'imageId': 'image2', 'userId': self.user_id}},
+            {'Items': [{'imageId': 'image3', 's3Key': 'images/legacy.png'}]}
+        ]
+        mock_release.side_effect = lambda sha256: sha256 == 'own'
+        mock_s3.return_value.delete_objects.return_value = {}
+        event = {**self.auth_context, 'body': json.dumps({'deleteAll': True})}
+
+        response = ImageServiceHandler().delete_images(event)
+
+        self.assertEqual(json.loads(response['body'])['deleted'], 3)
+        self.assertEqual(table.query.call_args_list[0].kwargs['Limit'], BatchSettings.delete_page_size)
+        self.assertEqual(table.query.call_args_list[1].kwargs['ExclusiveStartKey'],
+                         {'imageId': 'image2', 'userId': self.user_id})
+        self.assertEqual(sorted(call.args[0] for call in mock_release.call_args_list), ['own', 'shared'])
+        deleted_keys = [[entry['Key'] for entry in call.kwargs['Delete']['Objects']]
+                        for call in mock_s3.return_value.delete_objects.call_args_list]
+        self.assertEqual(deleted_keys, [['blobs/own'], ['images/legacy.png']])
+        self.assertEqual(table.meta.client.batch_write_item.call_count, 2)
+
+    def test_delete_images_requires_ids(self):
+        event = {**self.auth_context, 'body': json.dumps({'imageIds': []})}
+
+        response = ImageServiceHandler().delete_images(event)
+        self.assertEqual(response['statusCode'], 400)
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_batch_get_images(self, mock_table, mock_s3):
+        table = mock_table.return_value
+        table.name = 'ImageMetaData'
+        table.meta.client.batch_get_item.return_value = {
+            'Responses': {'ImageMetaData': [{'imageId': 'image2', 'userId': self.user_id, 's3Key': 'k2'},
+                                            {'imageId': 'image1', 'userId': self.user_id, 's3Key': 'k1'}]}
+        }
+        mock_s3.return_value.generate_presigned_url.side_effect = \
+            lambda action, Params, ExpiresIn: f"https://{Params['Key']}"
+        event = {**self.auth_context, 'body': json.dumps({'imageIds': ['image1', 'image2', 'other']})}
+
+        response = lambda_handler({**event, 'httpMethod': 'POST', 'resource': '/images:batchGet'}, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        response_body = json.loads(response['body'])
+        self.assertEqual([image['imageId'] for image in response_body['images']], ['image1', 'image2'])
+        self.assertEqual(response_body['images'][0]['downloadUrl'], 'https://k1')
+        self.assertEqual(response_body['notFound'], ['other'])
+        keys = table.meta.client.batch_get_item.call_args.kwargs['RequestItems']['ImageMetaData']['Keys']
+        self.assertTrue(all(key['userId'] == self.user_id for key in keys))
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_get_image_served_from_cache(self, mock_table, mock_s3):
+        mock_table.return_value.get_item.return_value = {'Item': {'imageId': self.image_id,
+                                                                  'userId': self.user_id,
+                                                                  's3Key': 'test/key.jpg'}}
+        mock_s3.return_value.generate_presigned_url.return_value = 'https://test-url'
+        event = {**self.auth_context, 'pathParameters': {'imageId': self.image_id}}
+
+        first = ImageServiceHandler().get_image(event)
+        second = ImageServiceHandler().get_image(event)
+
+        self.assertEqual(first['body'], second['body'])
+        mock_table.return_value.get_item.assert_called_once()
+        mock_s3.return_value.generate_presigned_url.assert_called_once()
+        self.assertEqual(image_cache.stats()['hits'], 1)
+        self.assertEqual(image_cache.stats()['misses'], 1)
+
+        ImageServiceHandler().delete_image(event)
+        ImageServiceHandler().get_image(event)
+        self.assertEqual(mock_table.return_value.get_item.call_count, 3)
+
+    def test_image_cache_evicts_and_expires(self):
+        cache = ImageCache(max_entries=2, ttl=60)
+        cache.put('user', 'image1', {'imageId': 'image1'})
+        cache.put('user', 'image2', {'imageId': 'image2'})
+        cache.get('user', 'image1')
+        cache.put('user', 'image3', {'imageId': 'image3'})
+
+        self.assertIsNone(cache.get('user', 'image2'))
+        self.assertIsNotNone(cache.get('user', 'image1'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        with patch('image_service_handler.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('user', 'image1'))
+
+    def test_render_variant_scales_down(self):
+        from io import BytesIO
+        from PIL import Image
+
+        source = BytesIO()
+        Image.new('RGB', (800, 400), 'red').save(source, format='PNG')
+
+        rendered = ImageVariants.render(source.getvalue(), 200, 'webp')
+
+        with Image.open(BytesIO(rendered)) as image:
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(image.size, (200, 100))
+
+    @patch('image_service_handler.ImageVariants.request')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_get_image_variant(self, mock_table, mock_s3, mock_request):
+        item = {'imageId': self.image_id, 'userId': self.user_id, 's3Key': 'images/original.png', 'variants': {}}
+        mock_table.return_value.get_item.return_value = {'Item': item}
+        mock_s3.return_value.generate_presigned_url.side_effect = \
+            lambda action, Params, ExpiresIn: f"https://{Params['Key']}"
+        event = {**self.auth_context,
+                 'pathParameters': {'imageId': self.image_id},
+                 'queryStringParameters': {'size': 'thumb'}}
+
+        response_body = json.loads(ImageServiceHandler().get_image(event)['body'])
+        self.assertEqual(response_body['variant'], {'name': 'thumb.webp', 'status': 'pending'})
+        self.assertEqual(response_body['downloadUrl'], 'https://images/original.png')
+        mock_request.assert_called_once_with(self.user_id, self.image_id, ['thumb.webp'])
+        update_kwargs = mock_table.return_value.update_item.call_args.kwargs
+        self.assertEqual(update_kwargs['UpdateExpression'], 'SET #requests = :requests')
+        self.assertIn('attribute_not_exists(#variants.#variant)', update_kwargs['ConditionExpression'])
+
+        from botocore.exceptions import ClientError
+        mock_table.return_value.update_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        response_body = json.loads(ImageServiceHandler().get_image(event)['body'])
+        self.assertEqual(response_body['variant']['status'], 'pending')
+        mock_request.assert_called_once()
+
+        item['variants'] = {'thumb.webp': f'images/{self.user_id}/{self.image_id}/thumb.webp'}
+        response_body = json.loads(ImageServiceHandler().get_image(event)['body'])
+        self.assertEqual(response_body['variant']['status'], 'ready')
+        self.assertEqual(response_body['downloadUrl'], f'https://images/{self.user_id}/{self.image_id}/thumb.webp')
+
+        event['queryStringParameters'] = {'size': 'huge'}
+        self.assertEqual(ImageServiceHandler().get_image(event)['statusCode'], 400)
+
+    @patch('image_service_handler.ImageVariants.render', return_value=b'variant')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_generate_variants_records_on_item(self, mock_table, mock_s3, mock_render):
+        mock_table.return_value.get_item.return_value = {'Item': {'imageId': self.image_id,
+                                                                  'userId': self.user_id,
+                                                                  's3Key': 'images/original.png',
+                                                                  'variants': {}}}
+
+        variants = ImageVariants.generate(self.user_id, self.image_id, ['thumb.webp'])
+
+        s3_key = f'images/{self.user_id}/{self.image_id}/thumb.webp'
+        self.assertEqual(variants, {'thumb.webp': s3_key})
+        self.assertEqual(mock_s3.return_value.put_object.call_args.kwargs['Key'], s3_key)
+        update_kwargs = mock_table.return_value.update_item.call_args.kwargs
+        self.assertEqual(update_kwargs['UpdateExpression'], 'SET #variants.#v0 = :v0')
+        self.assertEqual(update_kwargs['ExpressionAttributeValues'], {':v0': s3_key})
+
+        # the item had no variants map when it was read, a concurrent generator created one since
+        from botocore.exceptions import ClientError
+        mock_table.return_value.get_item.return_value = {'Item': {'imageId': self.image_id,
+                                                                  'userId': self.user_id,
+                                                                  's3Key': 'images/original.png',
+                                                                  'variantRequests': {'thumb.webp': 'x'}}}
+        mock_table.return_value.update_item.reset_mock()
+        mock_table.return_value.update_item.side_effect = [
+            ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'), {}]
+
+        ImageVariants.generate(self.user_id, self.image_id, ['thumb.webp'])
+
+        create, assign = [call.kwargs for call in mock_table.return_value.update_item.call_args_list]
+        self.assertEqual(create['UpdateExpression'], 'SET #variants = :variants REMOVE #requests.#v0')
+        self.assertIn('attribute_not_exists(#variants)', create['ConditionExpression'])
+        self.assertEqual(assign['UpdateExpression'], 'SET #variants.#v0 = :v0 REMOVE #requests.#v0')
+        self.assertNotIn('ConditionExpression', assign)
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_upload_image_deduplicates_content(self, mock_table, mock_s3, mock_blob_table):
+        mock_blob_table.return_value.update_item.return_value = {'Attributes': {'refCount': 2, 'stored': True}}
+        json_body = {
+            'body': self.fake_image_encoded.decode(),
+            'headers': {'content-type': 'image/png',
+                        'x-image-metadata': json.dumps({'description': 'Test Description'})}
+        }
+        event = {**self.auth_context, 'body': json.dumps(json_body)}
+
+        response = ImageServiceHandler().upload_image(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        mock_s3.return_value.put_object.assert_not_called()
+        item = mock_table.return_value.put_item.call_args.kwargs['Item']
+        self.assertEqual(item['s3Key'], f"blobs/{item['sha256']}")
+        self.assertEqual(mock_blob_table.return_value.update_item.call_args.kwargs['Key'],
+                         {'sha256': item['sha256']})
+
+        # the first upload of these bytes has not stored them yet, or failed to, so this one stores them
+        mock_blob_table.return_value.update_item.reset_mock()
+        mock_blob_table.return_value.update_item.return_value = {'Attributes': {'refCount': 2}}
+        response = ImageServiceHandler().upload_image(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(mock_s3.return_value.put_object.call_args.kwargs['Key'], f"blobs/{item['sha256']}")
+        mark_stored = mock_blob_table.return_value.update_item.call_args.kwargs
+        self.assertEqual(mark_stored['UpdateExpression'], 'SET #stored = :stored')
+        self.assertEqual(mark_stored['ConditionExpression'], 'attribute_exists(sha256)')
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_delete_image_keeps_shared_blob(self, mock_table, mock_s3, mock_blob_table):
+        mock_table.return_value.get_item.return_value = {'Item': {'imageId': self.image_id,
+                                                                  'userId': self.user_id,
+                                                                  's3Key': 'blobs/abc',
+                                                                  'sha256': 'abc'}}
+        mock_blob_table.return_value.update_item.return_value = {'Attributes': {'refCount': 1}}
+        event = {**self.auth_context, 'pathParameters': {'imageId': self.image_id}}
+
+        response = ImageServiceHandler().delete_image(event)
+        self.assertEqual(response['statusCode'], 200)
+        mock_s3.return_value.delete_object.assert_not_called()
+        mock_table.return_value.delete_item.assert_called_once()
+
+        mock_blob_table.return_value.update_item.return_value = {'Attributes': {'refCount': 0}}
+        ImageServiceHandler().delete_image(event)
+        mock_blob_table.return_value.delete_item.assert_called_once()
+        mock_s3.return_value.delete_object.assert_called_once_with(Bucket='imagehost', Key='blobs/abc')
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_upload_image_rolls_back_item_when_put_object_fails(self, mock_table, mock_s3, mock_blob_table):
+        mock_blob_table.return_value.update_item.side_effect = [{'Attributes': {'refCount': 1}},
+                                                                {'Attributes': {'refCount': 0}}]
+        mock_s3.return_value.put_object.side_effect = Exception('SlowDown')
+        json_body = {
+            'body': self.fake_image_encoded.decode(),
+            'headers': {'content-type': 'image/png',
+                        'x-image-metadata': json.dumps({'description': 'Test Description'})}
+        }
+        event = {**self.auth_context, 'body': json.dumps(json_body)}
+
+        response = ImageServiceHandler().upload_image(event)
+
+        self.assertEqual(response['statusCode'], 500)
+        mock_table.return_value.put_item.assert_called_once()
+        item = mock_table.return_value.put_item.call_args.kwargs['Item']
+        mock_table.return_value.delete_item.assert_called_once_with(Key={'imageId': item['imageId'],
+                                                                         'userId': self.user_id})
+        mock_blob_table.return_value.delete_item.assert_called_once()
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_delete_image_leaves_item_deleting_when_delete_object_fails(self, mock_table, mock_s3):
+        metadata = {'imageId': self.image_id, 'userId': self.user_id, 's3Key': 'test/key.jpg'}
+        mock_table.return_value.get_item.return_value = {'Item': metadata}
+        mock_s3.return_value.delete_object.side_effect = Exception('AccessDenied')
+        event = {**self.auth_context, 'pathParameters': {'imageId': self.image_id}}
+
+        response = ImageServiceHandler().delete_image(event)
+
+        self.assertEqual(response['statusCode'], 500)
+        update_kwargs = mock_table.return_value.update_item.call_args.kwargs
+        self.assertEqual(update_kwargs['ExpressionAttributeValues'][':deleting'], 'deleting')
+        self.assertIn('attribute_not_exists(releasedAt)', update_kwargs['ConditionExpression'])
+        mock_table.return_value.delete_item.assert_not_called()
+        mock_table.return_value.put_item.assert_not_called()
+
+        from botocore.exceptions import ClientError
+        mock_s3.return_value.delete_object.side_effect = None
+        mock_table.return_value.update_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        self.assertEqual(ImageServiceHandler().delete_image(event)['statusCode'], 200)
+        self.assertEqual(mock_table.return_value.delete_item.call_args.kwargs['ConditionExpression'],
+                         '#status = :deleting')
+
+    def test_event_log_summary_excludes_body(self):
+        event = {**self.auth_context,
+                 'httpMethod': 'POST',
+                 'resource': '/images',
+                 'body': 'secret-image-bytes' * 1000}
+
+        with self.assertLogs(level='INFO') as logs:
+            StructuredLogging.log_event(event, MagicMock(aws_request_id='request-1'))
+
+        record = logs.records[0]
+        self.assertEqual(record.fields['bodySize'], len(event['body']))
+        self.assertEqual(record.fields['userId'], self.user_id)
+        log_line = json.loads(JsonLogFormatter().format(record))
+        self.assertEqual(log_line['requestId'], 'request-1')
+        self.assertNotIn('secret-image-bytes', json.dumps(log_line))
+
+    @patch('image_service_handler.AWSClientRegistry.load_boto3')
+    def test_client_registry_reuses_clients(self, mock_load_boto3):
+        mock_boto3 = mock_load_boto3.return_value
+        AWSClientRegistry.reset()
+        self.addCleanup(AWSClientRegistry.reset)
+
+        first_s3 = AWSActions.get_s3_client()
+        second_s3 = AWSActions.get_s3_client()
+        first_table = AWSActions.get_dynamodb_table()
+        second_table = AWSActions.get_dynamodb_table()
+
+        self.assertIs(first_s3, second_s3)
+        self.assertIs(first_table, second_table)
+        mock_boto3.client.assert_called_once()
+        mock_boto3.resource.assert_called_once()
+
+        AWSClientRegistry.reset()
+        AWSActions.get_s3_client()
+        self.assertEqual(mock_boto3.client.call_count, 2)
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_instrumentation_emits_request_breakdown(self, mock_table, mock_s3):
+        documents = []
+        Instrumentation.install(sink=documents.append)
+        self.addCleanup(Instrumentation.uninstall)
+        mock_table.return_value.get_item.return_value = {'Item': {'imageId': self.image_id,
+                                                                  'userId': self.user_id,
+                                                                  's3Key': 'test/key.jpg'}}
+        mock_s3.return_value.generate_presigned_url.return_value = 'https://test-url'
+        event = {**self.auth_context,
+                 'httpMethod': 'GET',
+                 'resource': '/images/{imageId}',
+                 'pathParameters': {'imageId': self.image_id}}
+
+        response = lambda_handler(event, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        document = documents[0]
+        self.assertEqual(document['Route'], 'GET /images/{imageId}')
+        self.assertEqual(document['StatusCode'], 200)
+        timing_names = [timing['name'] for timing in document['Timings']]
+        self.assertIn('ImageServiceHandler.get_image', timing_names)
+        self.assertIn('AWSActions.get_item_from_table', timing_names)
+        self.assertIn('AWSActions.generate_presigned_url_for_object', timing_names)
+        self.assertEqual(document['ImageCacheMisses'], 1)
+        metric_names = [metric['Name'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        self.assertIn('get_item_from_tableDuration', metric_names)
+
+    def test_instrumentation_disabled_by_default(self):
+        self.assertFalse(Instrumentation.enabled)
+        # the only wrapper is the always installed Resilience guard
+        self.assertNotIn('__wrapped__', vars(AWSActions.get_item_from_table.__wrapped__))
+
+    def test_router_not_found_and_method_not_allowed(self):
+        response = lambda_handler({'httpMethod': 'PATCH', 'resource': '/images/{imageId}'}, None)
+        self.assertEqual(response['statusCode'], 405)
+        self.assertEqual(response['headers']['Allow'], 'DELETE, GET')
+
+        response = lambda_handler({'httpMethod': 'GET', 'resource': '/unknown'}, None)
+        self.assertEqual(response['statusCode'], 404)
+
+    def test_import_does_not_load_boto3_or_asyncio(self):
+        import subprocess
+        import sys
+
+        output = subprocess.run([sys.executable, '-c',
+                                 "import sys, image_service_handler; "
+                                 "print('boto3' in sys.modules, 'asyncio' in sys.modules)"],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.stdout.strip(), 'False False')
+
+    def test_image_inspector_reads_format_and_dimensions(self):
+        from io import BytesIO
+        from PIL import Image
+
+        for image_format, content_type in (('JPEG', 'image/jpeg'), ('PNG', 'image/png'),
+                                           ('GIF', 'image/gif'), ('WEBP', 'image/webp')):
+            buffer = BytesIO()
+            Image.new('RGB', (321, 123)).save(buffer, format=image_format)
+            self.assertEqual(ImageInspector.inspect(buffer.getbuffer()), (content_type, 321, 123))
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    def test_upload_image_rejects_mismatched_or_oversized_pixels(self, mock_s3):
+        png = bytearray(base64.b64decode(self.fake_image_encoded))
+        cases = (('image/jpeg', bytes(png), 'not image/jpeg'),
+                 ('image/png', bytes(png[:16]) + (100000).to_bytes(4, 'big') * 2 + bytes(png[24:]),
+                  'exceed maximum allowed pixels'),
+                 ('image/png', b'plain text', 'Unrecognized image data'))
+        for content_type, image, message in cases:
+            json_body = {'body': base64.b64encode(image).decode(),
+                         'headers': {'content-type': content_type,
+                                     'x-image-metadata': json.dumps({'description': 'Test'})}}
+            response = ImageServiceHandler().upload_image({**self.auth_context, 'body': json.dumps(json_body)})
+            self.assertEqual(response['statusCode'], 400)
+            self.assertIn(message, json.loads(response['body'])['message'])
+        mock_s3.assert_not_called()
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_upload_image_raw_binary_body(self, mock_table, mock_s3, mock_blob_table):
+        mock_blob_table.return_value.update_item.return_value = {'Attributes': {'refCount': 1}}
+        event = {
+            **self.auth_context,
+            'headers': {'Content-Type': 'image/png',
+                        'X-Image-Metadata': json.dumps({'description': 'Test Description'})},
+            'isBase64Encoded': True,
+            'body': self.fake_image_encoded.decode()
+        }
+
+        response = ImageServiceHandler().upload_image(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        put_kwargs = mock_s3.return_value.put_object.call_args.kwargs
+        self.assertIsInstance(put_kwargs['Body'], bytearray)
+        self.assertEqual(put_kwargs['Body'], base64.b64decode(self.fake_image_encoded))
+        self.assertEqual(put_kwargs['ContentType'], 'image/png')
+
+    @patch('image_service_handler.ImageRequirements.decode_chunk_size', 8)
+    def test_decode_base64_in_chunks(self):
+        image = os.urandom(1001)
+        self.assertEqual(Utils.decode_base64(base64.b64encode(image).decode()), image)
+        for invalid in ('abc', 'ab!d', 'YQ==YQ=='):
+            with self.assertRaises(ImageServiceError):
+                Utils.decode_base64(invalid)
+
+    def test_buffer_reader_streams_memoryview(self):
+        reader = BufferReader(memoryview(b'0123456789')[2:8])
+        self.assertEqual(len(reader), 6)
+        self.assertEqual(reader.read(4), b'2345')
+        self.assertEqual(reader.read(), b'67')
+        reader.seek(0)
+        self.assertEqual(reader.read(-1), b'234567')
+
+    @patch('image_service_handler.AWSActions.get_search_table')
+    def test_search_index_normalizes_and_pages(self, mock_search_table):
+        self.assertEqual(SearchIndex.normalize_tags(' Summer ,beach,  SUMMER,,Blue  Sky'),
+                         ['summer', 'beach', 'blue sky'])
+        self.assertEqual(SearchIndex.tokenize('Sunset at the Beach, sunset!'), ['sunset', 'at', 'the', 'beach'])
+
+        mock_search_table.return_value.query.return_value = {'Items': [{'sortKey': '2024-01-03#image3'},
+                                                                       {'sortKey': '2024-01-02#image2'},
+                                                                       {'sortKey': '2024-01-01#image1'}]}
+        image_ids, next_sort_key = SearchIndex.search(['u#tag#summer'], limit=2)
+        self.assertEqual(image_ids, ['image3', 'image2'])
+        self.assertEqual(next_sort_key, '2024-01-02#image2')
+
+        SearchIndex.search(['u#tag#summer'], limit=2, after=next_sort_key)
+        query_kwargs = mock_search_table.return_value.query.call_args.kwargs
+        self.assertEqual(query_kwargs['KeyConditionExpression'], 'searchTerm = :term AND sortKey < :after')
+        self.assertEqual(query_kwargs['ProjectionExpression'], 'sortKey')
+
+    @patch('image_service_handler.AWSActions.get_search_table')
+    def test_search_intersects_posting_lists_lazily(self, mock_search_table):
+        postings = {'u#tag#sea': [f"2024-01-{day:02d}#image{day}" for day in range(30, 0, -1)],
+                    'u#tag#sun': [f"2024-01-{day:02d}#image{day}" for day in range(30, 0, -3)]}
+
+        def query(**kwargs):
+            sort_keys = postings[kwargs['ExpressionAttributeValues'][':term']]
+            start = sort_keys.index(kwargs['ExclusiveStartKey']['sortKey']) + 1 if 'ExclusiveStartKey' in kwargs else 0
+            page = sort_keys[start:start + kwargs['Limit']]
+            response = {'Items': [{'sortKey': sort_key} for sort_key in page]}
+            if start + kwargs['Limit'] < len(sort_keys):
+                response['LastEvaluatedKey'] = {'sortKey': page[-1]}
+            return response
+
+        mock_search_table.return_value.query.side_effect = query
+        with patch('image_service_handler.SearchSettings.min_query_size', 3):
+            image_ids, next_sort_key = SearchIndex.search(['u#tag#sea', 'u#tag#sun'], limit=2)
+
+        self.assertEqual(image_ids, ['image30', 'image27'])
+        self.assertEqual(next_sort_key, '2024-01-27#image27')
+        self.assertEqual(mock_search_table.return_value.query.call_count, 4)
+
+    @patch('image_service_handler.time.sleep')
+    @patch('image_service_handler.SearchIndex.search', return_value=(['image1', 'image2'], '2024-01-01#image2'))
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_search_answers_503_when_matches_were_not_read(self, mock_table, mock_search, mock_sleep):
+        table = mock_table.return_value
+        table.name = 'ImageMetaData'
+        unprocessed = {'ImageMetaData': {'Keys': [{'imageId': 'image2', 'userId': self.user_id}]}}
+        table.meta.client.batch_get_item.return_value = {
+            'Responses': {'ImageMetaData': [{'imageId': 'image1', 'userId': self.user_id, 'status': 'active'}]},
+            'UnprocessedKeys': unprocessed
+        }
+
+        response = ImageServiceHandler().list_images({**self.auth_context,
+                                                      'queryStringParameters': {'tag': 'sea'}})
+
+        self.assertEqual(response['statusCode'], 503)
+        self.assertIn('Retry-After', response['headers'])
+        self.assertNotIn('nextToken', json.loads(response['body']))
+
+    def test_processing_strips_exif_and_extracts_attributes(self):
+        from io import BytesIO
+        from PIL import Image
+
+        exif = Image.Exif()
+        exif[0x010F] = 'CameraMaker'
+        exif[0x0112] = 6
+        buffer = BytesIO()
+        Image.new('RGB', (40, 20), (200, 30, 30)).save(buffer, format='JPEG', exif=exif.tobytes())
+
+        stripped, attributes = ImageProcessing.analyze(buffer.getvalue(), 'image/jpeg')
+
+        self.assertNotIn(b'CameraMaker', stripped)
+        self.assertEqual(ImageInspector.inspect(memoryview(stripped)), ('image/jpeg', 20, 40))
+        self.assertEqual((attributes['width'], attributes['height']), (20, 40))
+        self.assertEqual(len(attributes['perceptualHash']), 16)
+        self.assertEqual(len(attributes['dominantColors']), 1)
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_processing_never_rewrites_a_shared_blob(self, mock_table, mock_s3, mock_blob_table):
+        from io import BytesIO
+        from PIL import Image
+
+        exif = Image.Exif()
+        exif[0x010F] = 'CameraMaker'
+        buffer = BytesIO()
+        Image.new('RGB', (40, 20), (200, 30, 30)).save(buffer, format='JPEG', exif=exif.tobytes())
+        source = buffer.getvalue()
+        sha256 = ContentStore.sha256_digest(source)
+        objects = {ContentStore.blob_s3_key(sha256): source}
+        ref_counts = {sha256: 2}
+        stored = {sha256}
+        items = {user_id: {'imageId': 'image', 'userId': user_id, 'status': 'processing', 'sha256': sha256,
+                           's3Key': ContentStore.blob_s3_key(sha256), 'contentType': 'image/jpeg',
+                           'statusChangedAt': 'x'}
+                 for user_id in ('alice', 'bob')}
+
+        def update_blob(**kwargs):
+            blob_sha256 = kwargs['Key']['sha256']
+            if ':delta' not in kwargs['ExpressionAttributeValues']:
+                stored.add(blob_sha256)
+                return {}
+            ref_counts[blob_sha256] = ref_counts.get(blob_sha256, 0) + kwargs['ExpressionAttributeValues'][':delta']
+            return {'Attributes': {'refCount': ref_counts[blob_sha256], 'stored': blob_sha256 in stored}}
+
+        mock_blob_table.return_value.update_item.side_effect = update_blob
+        mock_table.return_value.get_item.side_effect = lambda Key: {'Item': items[Key['userId']]}
+        mock_s3.return_value.get_object.side_effect = lambda Bucket, Key: {'Body': MagicMock(read=lambda: objects[Key])}
+        mock_s3.return_value.put_object.side_effect = lambda **kwargs: objects.update({kwargs['Key']: kwargs['Body']})
+        mock_s3.return_value.delete_object.side_effect = lambda Bucket, Key: objects.pop(Key)
+
+        for user_id in ('alice', 'bob'):
+            self.assertEqual(ImageProcessing.process(user_id, 'image'), 'active')
+
+        put_keys = [call.kwargs['Key'] for call in mock_s3.return_value.put_object.call_args_list]
+        self.assertEqual(len(put_keys), 1)
+        self.assertNotEqual(put_keys[0], ContentStore.blob_s3_key(sha256))
+        stripped_sha256 = put_keys[0].split('/', 1)[1]
+        self.assertEqual(ContentStore.sha256_digest(objects[put_keys[0]]), stripped_sha256)
+        self.assertEqual(ref_counts, {sha256: 0, stripped_sha256: 2})
+        self.assertEqual(list(objects), [put_keys[0]])
+        for call in mock_table.return_value.update_item.call_args_list:
+            self.assertEqual(call.kwargs['ExpressionAttributeValues'][':sha256'], stripped_sha256)
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_processing_queue_is_idempotent_and_marks_failures(self, mock_table, mock_s3):
+        items = {'done': {'imageId': 'done', 'userId': self.user_id, 'status': 'active', 'processedAt': 'x'},
+                 'broken': {'imageId': 'broken', 'userId': self.user_id, 'status': 'processing',
+                            's3Key': 'blobs/abc', 'contentType': 'image/png'}}
+        mock_table.return_value.get_item.side_effect = lambda Key: {'Item': items[Key['imageId']]}
+        mock_s3.return_value.get_object.side_effect = Exception('NoSuchKey')
+
+        queue = LocalProcessingQueue(2, background=False)
+        for image_id in ('done', 'broken', 'done'):
+            queue.send({'userId': self.user_id, 'imageId': image_id})
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.flush(), 1)
+        self.assertEqual(len(queue), 0)
+
+        mock_s3.return_value.get_object.assert_called_once_with(Bucket='imagehost', Key='blobs/abc')
+        update_kwargs = mock_table.return_value.update_item.call_args.kwargs
+        self.assertEqual(update_kwargs['Key'], {'imageId': 'broken', 'userId': self.user_id})
+        self.assertEqual(update_kwargs['ExpressionAttributeValues'][':status'], 'failed')
+        self.assertIn('attribute_not_exists(processedAt)', update_kwargs['ConditionExpression'])
+
+        records = [{'messageId': f"m{index}", 'body': json.dumps({'userId': self.user_id, 'imageId': image_id})}
+                   for index, image_id in enumerate(('done', 'broken'))]
+        self.assertEqual(processing_queue_handler({'Records': records}, None),
+                         {'batchItemFailures': [{'itemIdentifier': 'm1'}]})
+
+    @patch('image_service_handler.time.time', return_value=1_800_000_000.0)
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_get_image_conditional_request(self, mock_table, mock_s3, mock_time):
+        mock_table.return_value.get_item.return_value = {'Item': {'imageId': self.image_id, 'userId': self.user_id,
+                                                                  's3Key': 'blobs/abc'}}
+        mock_s3.return_value.generate_presigned_url.return_value = 'https://example.com/signed'
+        event = {**self.auth_context, 'pathParameters': {'imageId': self.image_id}}
+
+        first = ImageServiceHandler().get_image(event)
+        self.assertEqual(first['statusCode'], 200)
+        self.assertEqual(first['headers']['Cache-Control'], 'private, max-age=60')
+        etag = first['headers']['ETag']
+
+        revalidated = ImageServiceHandler().get_image({**event, 'headers': {'If-None-Match': f'W/{etag}, "other"'}})
+        self.assertEqual(revalidated['statusCode'], 304)
+        self.assertEqual(revalidated['body'], '')
+        self.assertEqual(revalidated['headers']['ETag'], etag)
+
+        changed = ImageServiceHandler().get_image({**event, 'headers': {'if-none-match': '"stale"'}})
+        self.assertEqual(changed['statusCode'], 200)
+        self.assertEqual(json.loads(changed['body']), json.loads(first['body']))
+
+        # another container, or a cache miss, signs a different url for the same image
+        image_cache.invalidate(self.user_id, self.image_id)
+        mock_s3.return_value.generate_presigned_url.return_value = 'https://example.com/signed-again'
+        resigned = ImageServiceHandler().get_image({**event, 'headers': {'If-None-Match': etag}})
+        self.assertEqual(resigned['statusCode'], 304)
+
+        image_cache.invalidate(self.user_id, self.image_id)
+        mock_table.return_value.get_item.return_value['Item']['s3Key'] = 'blobs/def'
+        moved = ImageServiceHandler().get_image({**event, 'headers': {'If-None-Match': etag}})
+        self.assertEqual(moved['statusCode'], 200)
+        self.assertNotEqual(moved['headers']['ETag'], etag)
+
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_list_images_conditional_request(self, mock_table):
+        mock_table.return_value.query.return_value = {'Items': [{'imageId': 'image1'}]}
+        first = ImageServiceHandler().list_images(self.auth_context)
+        etag = first['headers']['ETag']
+
+        mock_table.return_value.query.return_value = {'Items': [{'imageId': 'image1'}, {'imageId': 'image2'}]}
+        changed = ImageServiceHandler().list_images({**self.auth_context, 'headers': {'If-None-Match': etag}})
+        self.assertEqual(changed['statusCode'], 200)
+        self.assertNotEqual(changed['headers']['ETag'], etag)
+
+        unchanged = ImageServiceHandler().list_images({**self.auth_context,
+                                                       'headers': {'If-None-Match': changed['headers']['ETag']}})
+        self.assertEqual(unchanged['statusCode'], 304)
+        self.assertNotIn('ETag', Utils.create_response(404, {'message': 'Not Found'})['headers'])
+
+    def test_json_codec_backends_encode_alike(self):
+        from datetime import datetime, timezone
+        from decimal import Decimal
+
+        body = {'images': [{'imageId': f"image{index}", 'width': Decimal(640), 'ratio': Decimal('1.5'),
+                            'createdAt': datetime(2024, 1, 1, tzinfo=timezone.utc)} for index in range(7)],
+                'count': 7, 'nextToken': None}
+        backend = JsonCodec.backend()
+        try:
+            encoded = {}
+            for name in ('stdlib', 'orjson'):
+                JsonCodec.use(name)
+                encoded[name] = JsonCodec.dumps(body)
+                self.assertEqual(''.join(JsonCodec.iter_dumps(body, 'images', batch_size=3)), encoded[name])
+                self.assertEqual(JsonCodec.loads(encoded[name])['images'][0],
+                                 {'imageId': 'image0', 'width': 640, 'ratio': 1.5,
+                                  'createdAt': '2024-01-01T00:00:00+00:00'})
+            self.assertEqual(encoded['stdlib'], encoded['orjson'])
+            self.assertEqual(''.join(JsonCodec.iter_dumps({'images': []}, 'images')), '{"images":[]}')
+        finally:
+            JsonCodec.use(backend)
+
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_access_tracker_debounces_and_batches(self, mock_table):
+        tracker = AccessTracker(sample_rate=1, resolution=3600, flush_size=2, flush_interval=60)
+        for _ in range(5):
+            tracker.record(self.user_id, 'image1')
+        mock_table.return_value.update_item.assert_not_called()
+
+        tracker.record(self.user_id, 'image2')
+        mock_table.return_value.update_item.assert_not_called()
+        self.assertEqual(tracker.flush_if_due(), 0)
+        self.assertEqual(mock_table.return_value.update_item.call_count, 2)
+        tracker.flush_if_due()
+        self.assertEqual(mock_table.return_value.update_item.call_count, 2)
+        self.assertIn('lastAccess < :accessedAt',
+                      mock_table.return_value.update_item.call_args.kwargs['ConditionExpression'])
+
+        AccessTracker(sample_rate=0, resolution=0, flush_size=1, flush_interval=0).record(self.user_id, 'image3')
+        self.assertEqual(mock_table.return_value.update_item.call_count, 2)
+
+        with patch('image_service_handler.access_tracker.flush_if_due') as flush_if_due:
+            lambda_handler({'httpMethod': 'GET', 'resource': '/unknown'}, None)
+        flush_if_due.assert_called_once_with()
+
+    @patch('image_service_handler.AWSActions.get_usage_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_usage_quota_and_tiering_page(self, mock_table, mock_s3, mock_usage_table):
+        mock_usage_table.return_value.get_item.return_value = {'Item': {'totalBytes': 1000, 'imageCount': 1}}
+        with patch.object(UsageSettings, 'quota_bytes', 1024):
+            response = ImageServiceHandler().upload_image({
+                **self.auth_context,
+                'headers': {'Content-Type': 'image/png', 'X-Image-Metadata': json.dumps({'description': 'Test'})},
+                'isBase64Encoded': True,
+                'body': self.fake_image_encoded.decode()
+            })
+        self.assertEqual(response['statusCode'], 403)
+        self.assertEqual(json.loads(response['body'])['message'], 'Storage quota exceeded')
+        mock_s3.return_value.put_object.assert_not_called()
+
+        job = TieringJob('run1', total_segments=1)
+        items = [{'imageId': 'cold', 'userId': 'a', 's3Key': 'images/a/cold.png', 'sizeBytes': 1 << 20,
+                  'createdAt': '2020-01-01T00:00:00+00:00'},
+                 {'imageId': 'small', 'userId': 'a', 's3Key': 'images/a/small.png', 'sizeBytes': 10,
+                  'createdAt': '2020-01-01T00:00:00+00:00'},
+                 {'imageId': 'recent', 'userId': 'b', 's3Key': 'images/b/recent.png', 'sizeBytes': 1 << 20,
+                  'createdAt': '2020-01-01T00:00:00+00:00', 'lastAccess': job.now.isoformat()}]
+        job.tier_page(items)
+        mock_s3.return_value.copy_object.assert_called_once()
+        self.assertEqual(mock_s3.return_value.copy_object.call_args.kwargs['StorageClass'], 'GLACIER_IR')
+        self.assertEqual(job.transitioned, 1)
+
+        job.commit_page(0, 0, items, None)
+        actions = mock_table.return_value.meta.client.transact_write_items.call_args.kwargs['TransactItems']
+        self.assertEqual([action['Update']['ExpressionAttributeValues'] for action in actions[:-1]],
+                         [{':bytes': (1 << 20) + 10, ':images': 2}, {':bytes': 1 << 20, ':images': 1}])
+        self.assertTrue(actions[-1]['Put']['Item']['done'])
+
+    @patch('image_service_handler.AWSActions.get_usage_table')
+    def test_tiering_keeps_usage_changed_during_the_run(self, mock_usage_table):
+        from botocore.exceptions import ClientError
+
+        usage_table = mock_usage_table.return_value
+        usage_table.meta.client.batch_write_item.return_value = {}
+        job = TieringJob('run1', total_segments=1)
+        job.started_at = '2026-01-01T00:00:00+00:00'
+        usage_table.scan.return_value = {'Items': [
+            {'userId': 'quiet', job.scan_names['#bytes']: 10, job.scan_names['#images']: 1},
+            {'userId': 'busy', job.scan_names['#bytes']: 10, job.scan_names['#images']: 1},
+            {'userId': f"{TieringJob.checkpoint_prefix}run1#0", 'done': True}
+        ]}
+
+        def update_item(**kwargs):
+            if kwargs['Key']['userId'] == 'busy' and 'ConditionExpression' in kwargs:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+            return {}
+
+        usage_table.update_item.side_effect = update_item
+        self.assertTrue(job.finalize())
+
+        calls = [call.kwargs for call in usage_table.update_item.call_args_list]
+        self.assertEqual([(call['Key']['userId'], call['UpdateExpression']) for call in calls],
+                         [('quiet', 'SET totalBytes = :bytes, imageCount = :images, '
+                                    'reconciledRun = :run REMOVE #bytes, #images'),
+                          ('busy', 'SET totalBytes = :bytes, imageCount = :images, '
+                                   'reconciledRun = :run REMOVE #bytes, #images'),
+                          ('busy', 'SET reconciledRun = :run REMOVE #bytes, #images')])
+        self.assertEqual(calls[0]['ConditionExpression'], 'attribute_not_exists(changedAt) OR changedAt < :started')
+        self.assertEqual(calls[0]['ExpressionAttributeValues'][':started'], job.started_at)
+        self.assertEqual(job.usage_kept, 1)
+
+    @patch('image_service_handler.time.sleep')
+    @patch('image_service_handler.AWSActions.get_usage_table')
+    def test_tiering_usage_calls_are_guarded(self, mock_usage_table, mock_sleep):
+        from botocore.exceptions import ClientError
+
+        throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Slow'}}, 'GetItem')
+        mock_usage_table.return_value.get_item.side_effect = [throttled, {'Item': {'done': True}}]
+        Resilience.reset()
+        try:
+            self.assertTrue(TieringJob('run1', total_segments=1).scan_segment(0))
+        finally:
+            Resilience.reset()
+        self.assertEqual(mock_usage_table.return_value.get_item.call_count, 2)
+        mock_sleep.assert_called_once()
+
+    def test_http_server_builds_gateway_events(self):
+        event = build_event('GET', '/images/image1', 'title=a&tag=b&tag=c', [('X-User-Id', self.user_id)],
+                            bytearray())
+        self.assertEqual((event['resource'], event['pathParameters']), ('/images/{imageId}', {'imageId': 'image1'}))
+        self.assertEqual(event['queryStringParameters'], {'title': 'a', 'tag': 'c'})
+        self.assertEqual(event['requestContext']['authorizer']['claims']['sub'], self.user_id)
+
+        literal = build_event('POST', '/images/upload-url', '', [('X-User-Id', self.user_id)], bytearray(b'{}'))
+        self.assertEqual((literal['resource'], literal['pathParameters'], literal['body']),
+                         ('/images/upload-url', None, '{}'))
+        image = build_event('POST', '/images', '', [('X-User-Id', self.user_id), ('Content-Type', 'image/png')],
+                            bytearray(b'raw'))
+        self.assertIsInstance(image['body'], bytearray)
+        self.assertIsNone(build_event('GET', '/images', '', [], bytearray()))
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_http_server_adapters_pass_raw_uploads(self, mock_table, mock_s3, mock_blob_table):
+        from io import BytesIO
+        import asyncio
+
+        mock_blob_table.return_value.update_item.return_value = {'Attributes': {'refCount': 1}}
+        image = base64.b64decode(self.fake_image_encoded)
+        started = []
+        body = wsgi_app({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/images', 'QUERY_STRING': '',
+                         'CONTENT_TYPE': 'image/png', 'CONTENT_LENGTH': str(len(image)),
+                         'HTTP_X_USER_ID': self.user_id,
+                         'HTTP_X_IMAGE_METADATA': json.dumps({'description': 'Test'}),
+                         'wsgi.input': BytesIO(image)}, lambda status, headers: started.append(status))
+        self.assertEqual(started, ['200 OK'])
+        self.assertIn('imageId', json.loads(b''.join(body)))
+        self.assertEqual(bytes(mock_s3.return_value.put_object.call_args.kwargs['Body']), image)
+
+        messages = [{'type': 'http.request', 'body': b'{"imageIds"', 'more_body': True},
+                    {'type': 'http.request', 'body': b': []}', 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi_app({'type': 'http', 'method': 'POST', 'path': '/images:batchGet', 'query_string': b'',
+                              'headers': [(b'x-user-id', self.user_id.encode())]}, receive, send))
+        self.assertEqual(sent[0]['status'], 400)
+        self.assertFalse(sent[-1]['more_body'])
+
+    def test_http_server_adapters_reject_malformed_content_length(self):
+        from io import BytesIO
+        import asyncio
+
+        started = []
+        wsgi_app({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/images', 'QUERY_STRING': '',
+                  'CONTENT_LENGTH': '12abc', 'wsgi.input': BytesIO(b'')},
+                 lambda status, headers: started.append(status))
+        self.assertEqual(started, ['400 Bad Request'])
+
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi_app({'type': 'http', 'method': 'POST', 'path': '/images', 'query_string': b'',
+                              'headers': [(b'content-length', b'-1')]}, receive, send))
+        self.assertEqual(sent[0]['status'], 400)
+
+    @patch('image_service_handler.time.sleep')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_throttled_calls_retry_then_shed_with_503(self, mock_table, mock_sleep):
+        from botocore.exceptions import ClientError
+
+        throttled = ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Slow'}},
+                                'GetItem')
+        key = {'imageId': 'throttled-image', 'userId': self.user_id}
+        event = {**self.auth_context, 'pathParameters': {'imageId': 'throttled-image'}}
+        Resilience.reset()
+        try:
+            mock_table.return_value.get_item.side_effect = [throttled, {'Item': key}]
+            self.assertEqual(AWSActions.get_item_from_table(key), {'Item': key})
+            self.assertEqual(mock_sleep.call_count, 1)
+
+            mock_table.return_value.get_item.side_effect = throttled
+            mock_table.return_value.get_item.reset_mock()
+            response = ImageServiceHandler().get_image(event)
+            self.assertEqual(response['statusCode'], 503)
+            self.assertEqual(response['headers']['Retry-After'], '1')
+            self.assertNotIn('Internal', json.loads(response['body'])['message'])
+            self.assertEqual(mock_table.return_value.get_item.call_count, ResilienceSettings.throttle_max_attempts)
+
+            for _ in range(ResilienceSettings.failure_threshold - 1):
+                ImageServiceHandler().get_image(event)
+            mock_table.return_value.get_item.reset_mock()
+            shed = ImageServiceHandler().get_image(event)
+            self.assertEqual(shed['statusCode'], 503)
+            self.assertGreaterEqual(int(shed['headers']['Retry-After']), 1)
+            mock_table.return_value.get_item.assert_not_called()
+        finally:
+            Resilience.reset()
+
+    @patch('image_service_handler.time.sleep')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_resilience_retries_only_failed_chunks_and_keeps_half_open_circuits(self, mock_table, mock_sleep):
+        from botocore.exceptions import ClientError
+        throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Slow'}}, 'BatchWriteItem')
+        self.assertEqual(AWSClientRegistry.client_config().retries['max_attempts'], 0)
+
+        sent_chunks = []
+
+        def batch_write_item(RequestItems):
+            chunk = [request['PutRequest']['Item']['imageId'] for request in RequestItems['images']]
+            sent_chunks.append(chunk)
+            if chunk[0] == 'image25' and len(sent_chunks) <= 2:
+                raise throttled
+            return {}
+
+        mock_table.return_value.name = 'images'
+        mock_table.return_value.meta.client.batch_write_item.side_effect = batch_write_item
+        Resilience.reset()
+        try:
+            with patch('image_service_handler.BatchSettings.max_workers', 1):
+                unprocessed = AWSActions.batch_put_items_in_to_table([{'imageId': f"image{index}"}
+                                                                      for index in range(30)])
+            self.assertEqual(unprocessed, [])
+            self.assertEqual([chunk[0] for chunk in sent_chunks], ['image0', 'image25', 'image25'])
+
+            breaker = Resilience.breaker('get_item_from_table')
+            breaker.opened_at = time.monotonic() - ResilienceSettings.open_seconds
+            Resilience.deadline.set(time.monotonic())
+            response = ImageServiceHandler().get_image({**self.auth_context,
+                                                        'pathParameters': {'imageId': self.image_id}})
+            self.assertEqual(response['statusCode'], 503)
+            self.assertIsNotNone(breaker.opened_at)
+            self.assertFalse(breaker.trial_running)
+            mock_table.return_value.get_item.assert_not_called()
+        finally:
+            Resilience.deadline.set(None)
+            Resilience.reset()
+
+    @patch('image_service_handler.time.sleep')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_resilience_retries_connection_errors_and_timeouts(self, mock_table, mock_s3, mock_sleep):
+        from botocore.exceptions import EndpointConnectionError, ReadTimeoutError
+
+        key = {'imageId': self.image_id, 'userId': self.user_id}
+        mock_table.return_value.get_item.side_effect = [EndpointConnectionError(endpoint_url='https://dynamodb'),
+                                                        {'Item': key}]
+        mock_s3.return_value.delete_objects.side_effect = [ReadTimeoutError(endpoint_url='https://s3'), {}]
+        Resilience.reset()
+        try:
+            self.assertEqual(AWSActions.get_item_from_table(key), {'Item': key})
+            self.assertEqual(AWSActions.delete_objects_from_bucket('imagehost', ['images/a.png']), {})
+            self.assertEqual(mock_s3.return_value.delete_objects.call_count, 2)
+            self.assertEqual(mock_sleep.call_count, 2)
+            self.assertIsNone(Resilience.breaker('get_item_from_table').opened_at)
+        finally:
+            Resilience.reset()
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_upload_with_idempotency_key_replays_or_conflicts(self, mock_table, mock_s3, mock_blob_table):
+        from botocore.exceptions import ClientError
+        from datetime import datetime, timezone
+        image_id = Utils.upload_image_id(self.user_id, 'retry-1')
+        sha256 = ContentStore.sha256_digest(base64.b64decode(self.fake_image_encoded))
+        existing = {'imageId': image_id, 'userId': self.user_id, 'sha256': sha256, 'status': 'active',
+                    'statusChangedAt': datetime.now(timezone.utc).isoformat()}
+        mock_table.return_value.put_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        mock_table.return_value.get_item.return_value = {'Item': existing}
+        event = {**self.auth_context, 'isBase64Encoded': True, 'body': self.fake_image_encoded.decode(),
+                 'headers': {'Content-Type': 'image/png', 'Idempotency-Key': 'retry-1',
+                             'X-Image-Metadata': json.dumps({'description': 'Test Description'})}}
+
+        response = ImageServiceHandler().upload_image(event)
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(json.loads(response['body'])['imageId'], image_id)
+        self.assertEqual(mock_table.return_value.put_item.call_args.kwargs['ConditionExpression'],
+                         'attribute_not_exists(imageId)')
+        mock_blob_table.return_value.update_item.assert_not_called()
+        mock_s3.return_value.put_object.assert_not_called()
+
+        existing['status'] = 'pending'
+        self.assertEqual(ImageServiceHandler().upload_image(event)['statusCode'], 409)
+        existing['sha256'] = 'another-image'
+        self.assertEqual(ImageServiceHandler().upload_image(event)['statusCode'], 422)
+        mock_table.return_value.delete_item.assert_not_called()
+
+    @patch('image_service_handler.AWSActions.get_blob_table')
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_reconciliation_joins_listing_with_table(self, mock_table, mock_s3, mock_blob_table):
+        from datetime import datetime, timezone
+        old = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        mock_s3.return_value.list_objects_v2.return_value = {
+            'Contents': [{'Key': key, 'LastModified': old}
+                         for key in ('blobs/aaa', 'blobs/orphan', 'images/u/x.png', 'other/file')],
+            'IsTruncated': False
+        }
+        items = [{'imageId': 'kept', 'userId': 'u', 's3Key': 'blobs/aaa', 'sha256': 'aaa', 'status': 'active',
+                  'createdAt': old.isoformat(), 'variants': {'thumb': 'images/u/kept/thumb'}},
+                 {'imageId': 'crashed', 'userId': 'u', 's3Key': 'blobs/bbb', 'sha256': 'bbb', 'status': 'pending',
+                  'statusChangedAt': old.isoformat(), 'createdAt': old.isoformat()}]
+        mock_table.return_value.scan.side_effect = lambda **kwargs: {'Items': items if kwargs['Segment'] == 0 else []}
+        mock_blob_table.return_value.name = 'blobs'
+        mock_blob_table.return_value.meta.client.batch_get_item.return_value = {
+            'Responses': {'blobs': [{'sha256': 'aaa', 'refCount': 3}]}
+        }
+
+        report = ReconciliationJob(dry_run=True).run()
+
+        self.assertTrue(report['complete'])
+        self.assertEqual((report['objects'], report['rows']), (4, 3))
+        self.assertEqual((report['orphanObjects'], report['rolledBack'], report['missingVariants'],
+                          report['blobCounts']), (2, 1, 1, 1))
+        self.assertEqual(mock_table.return_value.scan.call_args.kwargs['ExpressionAttributeNames'],
+                         {'#status': 'status'})
+        mock_s3.return_value.delete_objects.assert_not_called()
+        mock_table.return_value.delete_item.assert_not_called()
+        mock_blob_table.return_value.update_item.assert_not_called()
+
+    def test_reconciliation_keeps_objects_whose_registration_failed_after_validation(self):
+        job = ReconciliationJob()
+        with patch.object(ImageServiceHandler, 'uploaded_object_item',
+                          side_effect=ImageServiceError("Object was not issued by the upload-url endpoint")):
+            self.assertEqual(job.adopt_object('images/u/stray.png'), ['images/u/stray.png'])
+
+        with patch.object(ImageServiceHandler, 'uploaded_object_item', return_value={'imageId': 'i', 'userId': 'u'}), \
+                patch.object(ImageServiceHandler, 'store_uploaded_item',
+                             side_effect=ImageServiceError("Search index unavailable", 500)):
+            with self.assertRaises(ImageServiceError):
+                job.adopt_object('images/u/i.png')
+        self.assertEqual(job.report['registered'], 0)
+
+    @patch('image_service_handler.AWSActions.get_s3_client')
+    @patch('image_service_handler.AWSActions.get_dynamodb_table')
+    def test_reconciliation_flushes_more_deletes_than_the_pool_has_workers(self, mock_table, mock_s3):
+        import threading
+
+        mock_s3.return_value.delete_objects.return_value = {}
+        job = ReconciliationJob()
+        for index in range(5):
+            job.repair('deletesFinished', ImageServiceHandler.finish_delete,
+                       {'imageId': f'image{index}', 'userId': self.user_id, 's3Key': f'images/{index}.png',
+                        'variants': {'thumb.webp': f'images/{index}/thumb.webp'}}, True)
+
+        with patch.object(AsyncAWSActions, '_executor', None), \
+                patch('image_service_handler.AWSUtils.max_pool_connections', 2):
+            flush = threading.Thread(target=job.flush, daemon=True)
+            flush.start()
+            flush.join(10)
+            self.assertFalse(flush.is_alive())
+            AsyncAWSActions.executor().shutdown()
+        self.assertEqual(mock_s3.return_value.delete_object.call_count, 5)
+        self.assertEqual(mock_table.return_value.delete_item.call_count, 5)
+        self.assertEqual(job.report['failed'], 0)
 
 
 if __name__ == '__main__':
@@ -1,34 +1,307 @@
+import binascii
+import contextvars
+import hashlib
+import heapq
 import json
 import logging
+import math
 import os
+import queue
+import random
+import re
+import tempfile
 import uuid
-import sys
+import threading
+import time
 
-from typing import Any
-import mimetypes
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial, wraps
+from itertools import groupby
+from operator import itemgetter
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Coroutine, Iterable, Iterator
 
-from base64 import b64decode
+from collections import OrderedDict
+from io import BytesIO
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime, time as datetime_time, timedelta, timezone
+from decimal import Decimal
+from urllib.parse import quote, unquote, unquote_plus
 
-import boto3
+if TYPE_CHECKING:
+    from botocore.config import Config
 
-possible_top_dir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
-                                                 os.pardir,
-                                                 os.pardir))
 
-if os.path.exists(os.path.join(possible_top_dir, 'ImageHost', '__init__.py')):
-    sys.path.insert(0, possible_top_dir)
+class AWSClientRegistry:
+    """Module level cache of boto3 clients, reused across warm lambda invocations"""
+
+    _lock = threading.Lock()
+    _clients: dict[tuple[str, str | None], Any] = {}
+    _dynamodb_resources: dict[str | None, Any] = {}
+    _tables: dict[tuple[str | None, str], Any] = {}
+
+    @staticmethod
+    def load_boto3() -> Any:
+        """boto3 is imported on first use so cold starts only pay for it once a route needs aws"""
+        import boto3
+        return boto3
+
+    @staticmethod
+    def client_config() -> 'Config':
+        from botocore.config import Config
+
+        return Config(
+            max_pool_connections=AWSUtils.max_pool_connections,
+            connect_timeout=AWSUtils.connect_timeout,
+            read_timeout=AWSUtils.read_timeout,
+            retries={
+                # Resilience retries the calls it guards, botocore retrying underneath would multiply the attempts
+                'max_attempts': 0 if ResilienceSettings.enabled else AWSUtils.retry_max_attempts,
+                'mode': AWSUtils.retry_mode
+            }
+        )
+
+    @classmethod
+    def get_client(cls,
+                   service_name: str,
+                   endpoint_url: str | None,
+                   /) -> Any:
+        client = cls._clients.get((service_name, endpoint_url))
+        if client is None:
+            with cls._lock:
+                client = cls._clients.get((service_name, endpoint_url))
+                if client is None:
+                    client = cls.load_boto3().client(service_name,
+                                                     endpoint_url=endpoint_url,
+                                                     config=cls.client_config())
+                    if Instrumentation.enabled:
+                        Instrumentation.register_client_hooks(client)
+                    cls._clients[(service_name, endpoint_url)] = client
+        return client
+
+    @classmethod
+    def get_s3_client(cls,
+                      endpoint_url: str | None,
+                      /) -> Any:
+        return cls.get_client('s3', endpoint_url)
+
+    @classmethod
+    def get_dynamodb_table(cls,
+                           table_name: str,
+                           endpoint_url: str | None,
+                           /) -> Any:
+        table = cls._tables.get((endpoint_url, table_name))
+        if table is None:
+            with cls._lock:
+                table = cls._tables.get((endpoint_url, table_name))
+                if table is None:
+                    dynamodb = cls._dynamodb_resources.get(endpoint_url)
+                    if dynamodb is None:
+                        dynamodb = cls.load_boto3().resource('dynamodb',
+                                                             endpoint_url=endpoint_url,
+                                                             config=cls.client_config())
+                        if Instrumentation.enabled:
+                            Instrumentation.register_client_hooks(dynamodb.meta.client)
+                        cls._dynamodb_resources[endpoint_url] = dynamodb
+                    table = dynamodb.Table(table_name)
+                    cls._tables[(endpoint_url, table_name)] = table
+        return table
+
+    @classmethod
+    def reset(cls) -> None:
+        """Drop every cached client, the next call builds fresh ones (used by tests)"""
+        with cls._lock:
+            cls._clients.clear()
+            cls._dynamodb_resources.clear()
+            cls._tables.clear()
 
 
 class AWSActions:
 
     @staticmethod
     def get_s3_client() -> Any:
-        return boto3.client('s3', endpoint_url=AWSUtils.ENDPOINT_URL)
+        return AWSClientRegistry.get_s3_client(AWSUtils.ENDPOINT_URL)
 
     @staticmethod
     def get_dynamodb_table() -> Any:
-        dynamodb = boto3.resource('dynamodb', endpoint_url=AWSUtils.ENDPOINT_URL)
-        return dynamodb.Table(os.environ.get('Table_name', 'ImageMetaData'))
+        return AWSClientRegistry.get_dynamodb_table(os.environ.get('Table_name', 'ImageMetaData'),
+                                                    AWSUtils.ENDPOINT_URL)
+
+    @staticmethod
+    def get_blob_table() -> Any:
+        return AWSClientRegistry.get_dynamodb_table(os.environ.get('Blob_table_name', 'ImageBlobs'),
+                                                    AWSUtils.ENDPOINT_URL)
+
+    @staticmethod
+    def get_search_table() -> Any:
+        return AWSClientRegistry.get_dynamodb_table(SearchSettings.table_name, AWSUtils.ENDPOINT_URL)
+
+    @staticmethod
+    def get_usage_table() -> Any:
+        return AWSClientRegistry.get_dynamodb_table(UsageSettings.table_name, AWSUtils.ENDPOINT_URL)
+
+    @staticmethod
+    def get_usage(user_id: str,
+                  /) -> dict[str, Any]:
+        return AWSActions.get_usage_table().get_item(Key={'userId': user_id}, ConsistentRead=True).get('Item', {})
+
+    @staticmethod
+    def add_usage(user_id: str,
+                  size: int,
+                  images: int,
+                  /) -> None:
+        AWSActions.get_usage_table().update_item(
+            Key={'userId': user_id},
+            UpdateExpression='ADD totalBytes :bytes, imageCount :images SET changedAt = :changedAt',
+            ExpressionAttributeValues={':bytes': size, ':images': images,
+                                       ':changedAt': datetime.now(timezone.utc).isoformat()}
+        )
+        return None
+
+    @staticmethod
+    def update_blob_reference(sha256: str,
+                              delta: int,
+                              /,
+                              *,
+                              content_type: str | None = None) -> dict[str, Any]:
+        """Atomically add delta to the reference count of a blob, returns the record as updated"""
+        table_obj = AWSActions.get_blob_table()
+        update_expression = 'ADD refCount :delta SET updatedAt = :updatedAt'
+        values: dict[str, Any] = {':delta': delta, ':updatedAt': datetime.now(timezone.utc).isoformat()}
+        if content_type:
+            update_expression += ', contentType = if_not_exists(contentType, :contentType)'
+            values[':contentType'] = content_type
+        response = table_obj.update_item(Key={'sha256': sha256},
+                                         UpdateExpression=update_expression,
+                                         ExpressionAttributeValues=values,
+                                         ReturnValues='ALL_NEW')
+        return response.get('Attributes', {})
+
+    @staticmethod
+    def mark_blob_stored(sha256: str,
+                         /) -> None:
+        """Record that the bytes of a referenced blob are in the bucket"""
+        AWSActions.get_blob_table().update_item(Key={'sha256': sha256},
+                                                UpdateExpression='SET #stored = :stored',
+                                                ConditionExpression='attribute_exists(sha256)',
+                                                ExpressionAttributeNames={'#stored': 'stored'},
+                                                ExpressionAttributeValues={':stored': True})
+        return None
+
+    @staticmethod
+    def delete_blob_record_if_unreferenced(sha256: str,
+                                           /) -> bool:
+        """Delete the blob record unless an upload took a new reference in the meantime"""
+        table_obj = AWSActions.get_blob_table()
+        try:
+            table_obj.delete_item(Key={'sha256': sha256},
+                                  ConditionExpression='refCount <= :zero',
+                                  ExpressionAttributeValues={':zero': 0})
+        except Exception as e:
+            if Utils.client_error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    @staticmethod
+    def repair_blob_reference(sha256: str,
+                              ref_count: int,
+                              observed: int | None,
+                              cutoff: str,
+                              /) -> bool:
+        """
+        Set the reference count of a blob to what the table holds, unless its record changed
+        since cutoff or no longer has the observed count (None when it had no record)
+        """
+        condition = ('attribute_not_exists(sha256)' if observed is None else
+                     'refCount = :observed AND (attribute_not_exists(updatedAt) OR updatedAt < :cutoff)')
+        values: dict[str, Any] = {':refCount': ref_count, ':updatedAt': datetime.now(timezone.utc).isoformat()}
+        if observed is not None:
+            values.update({':observed': observed, ':cutoff': cutoff})
+        try:
+            AWSActions.get_blob_table().update_item(Key={'sha256': sha256},
+                                                    UpdateExpression='SET refCount = :refCount, updatedAt = :updatedAt',
+                                                    ConditionExpression=condition,
+                                                    ExpressionAttributeValues=values)
+        except Exception as e:
+            if Utils.client_error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    @staticmethod
+    def delete_blob_record_if_stale(sha256: str,
+                                    cutoff: str,
+                                    /) -> bool:
+        """Delete the blob record unless it changed since cutoff, True when the blob is free to go"""
+        try:
+            AWSActions.get_blob_table().delete_item(
+                Key={'sha256': sha256},
+                ConditionExpression='attribute_not_exists(updatedAt) OR updatedAt < :cutoff',
+                ExpressionAttributeValues={':cutoff': cutoff}
+            )
+        except Exception as e:
+            if Utils.client_error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    @staticmethod
+    def get_lambda_client() -> Any:
+        return AWSClientRegistry.get_client('lambda', AWSUtils.ENDPOINT_URL)
+
+    @staticmethod
+    def get_sqs_client() -> Any:
+        return AWSClientRegistry.get_client('sqs', AWSUtils.ENDPOINT_URL)
+
+    @staticmethod
+    def send_message_to_queue(queue_url: str,
+                              payload: dict[str, Any],
+                              /) -> None:
+        sqs_client = AWSActions.get_sqs_client()
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(payload))
+        return None
+
+    @staticmethod
+    def invoke_function_async(function_name: str,
+                              payload: dict[str, Any],
+                              /) -> None:
+        lambda_client = AWSActions.get_lambda_client()
+        lambda_client.invoke(FunctionName=function_name,
+                             InvocationType='Event',
+                             Payload=json.dumps(payload).encode())
+        return None
+
+    @staticmethod
+    def change_storage_class(bucket_name: str,
+                             s3_key: str,
+                             storage_class: str,
+                             /) -> None:
+        """Copy the object on to itself in the new storage class, metadata and content type are kept"""
+        s3_client = AWSActions.get_s3_client()
+        s3_client.copy_object(Bucket=bucket_name,
+                              Key=s3_key,
+                              CopySource={'Bucket': bucket_name, 'Key': s3_key},
+                              StorageClass=storage_class,
+                              MetadataDirective='COPY')
+        return None
+
+    @staticmethod
+    def list_objects_in_bucket(bucket_name: str,
+                               /,
+                               *,
+                               continuation_token: str | None = None) -> dict[str, Any]:
+        """One page of up to 1000 keys, s3 returns them in key order"""
+        list_kwargs: dict[str, Any] = {'Bucket': bucket_name}
+        if continuation_token:
+            list_kwargs['ContinuationToken'] = continuation_token
+        return AWSActions.get_s3_client().list_objects_v2(**list_kwargs)
+
+    @staticmethod
+    def get_object_from_bucket(bucket_name: str,
+                               s3_key: str,
+                               /) -> bytes:
+        s3_client = AWSActions.get_s3_client()
+        return s3_client.get_object(Bucket=bucket_name, Key=s3_key)['Body'].read()
 
     @staticmethod
     def put_object_in_to_bucket(bucket_name: str,
@@ -37,11 +310,15 @@ class AWSActions:
                                 user_id: str,
                                 content_type: str,
                                 /) -> None:
+        if isinstance(body, (bytes, bytearray, memoryview)) and len(body) > MultipartSettings.threshold:
+            MultipartUploader().upload(bucket_name, s3_key, body, content_type, {'userId': user_id})
+            return None
+
         s3_client = AWSActions.get_s3_client()
         s3_client.put_object(
             Bucket=bucket_name,
             Key=s3_key,
-            Body=body,
+            Body=BufferReader(body) if isinstance(body, memoryview) else body,
             ContentType=content_type,
             Metadata={'userId': user_id}
         )
@@ -59,34 +336,120 @@ class AWSActions:
                                           s3_key: str,
                                           /,
                                           *,
-                                          action_name: str = "get_object") -> str:
+                                          action_name: str = "get_object",
+                                          extra_params: dict[str, Any] | None = None,
+                                          expires_in: int | None = None) -> str:
         s3_client = AWSActions.get_s3_client()
 
         return s3_client.generate_presigned_url(
             action_name,
-            Params={'Bucket': bucket_name, 'Key': s3_key},
-            ExpiresIn=AWSUtils.s3_presigned_url_timeout
+            Params={'Bucket': bucket_name, 'Key': s3_key, **(extra_params or {})},
+            ExpiresIn=expires_in or AWSUtils.s3_presigned_url_timeout
         )
 
+    @staticmethod
+    def generate_presigned_urls_for_objects(bucket_name: str,
+                                            s3_keys: list[str],
+                                            /,
+                                            *,
+                                            action_name: str = "get_object") -> dict[str, str]:
+        """Presign many keys in one pass, signing is local so no request goes to s3"""
+        s3_client = AWSActions.get_s3_client()
+
+        return {s3_key: s3_client.generate_presigned_url(
+                    action_name,
+                    Params={'Bucket': bucket_name, 'Key': s3_key},
+                    ExpiresIn=AWSUtils.s3_presigned_url_timeout)
+                for s3_key in dict.fromkeys(s3_keys)}
+
+    @staticmethod
+    def generate_presigned_post_for_object(bucket_name: str,
+                                           s3_key: str,
+                                           /,
+                                           *,
+                                           fields: dict[str, Any],
+                                           conditions: list[Any],
+                                           expires_in: int | None = None) -> dict[str, Any]:
+        s3_client = AWSActions.get_s3_client()
+
+        return s3_client.generate_presigned_post(
+            bucket_name,
+            s3_key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expires_in or AWSUtils.s3_presigned_url_timeout
+        )
+
+    @staticmethod
+    def head_object_in_bucket(bucket_name: str,
+                              s3_key: str,
+                              /) -> dict[str, Any]:
+        s3_client = AWSActions.get_s3_client()
+        return s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+
     @staticmethod
     def put_item_in_to_dynamo_table(item: dict[str, Any],
-                                    /) -> None:
+                                    /,
+                                    *,
+                                    condition: str | None = None) -> None:
         table_obj = AWSActions.get_dynamodb_table()
-        table_obj.put_item(Item=item)
+        if condition:
+            table_obj.put_item(Item=item, ConditionExpression=condition)
+        else:
+            table_obj.put_item(Item=item)
         return None
 
+    @staticmethod
+    def update_item_in_table(key: dict[str, Any],
+                             update_expression: str,
+                             values: dict[str, Any],
+                             /,
+                             *,
+                             names: dict[str, str] | None = None,
+                             condition: str | None = None,
+                             table: Any = None) -> dict[str, Any]:
+        table_obj = table or AWSActions.get_dynamodb_table()
+        update_kwargs: dict[str, Any] = {
+            'Key': key,
+            'UpdateExpression': update_expression,
+            'ExpressionAttributeValues': values,
+            'ReturnValues': 'ALL_NEW'
+        }
+        if names:
+            update_kwargs['ExpressionAttributeNames'] = names
+        if condition:
+            update_kwargs['ConditionExpression'] = condition
+        return table_obj.update_item(**update_kwargs)
+
     @staticmethod
     def get_item_from_table(key_to_look: dict[str, Any],
-                            /) -> dict[str, Any]:
-        table_obj = AWSActions.get_dynamodb_table()
+                            /,
+                            *,
+                            consistent: bool = False,
+                            table: Any = None) -> dict[str, Any]:
+        table_obj = table or AWSActions.get_dynamodb_table()
+        if consistent:
+            return table_obj.get_item(Key=key_to_look, ConsistentRead=True)
         data_to_retrive = table_obj.get_item(Key=key_to_look)
         return data_to_retrive
 
     @staticmethod
     def delete_an_item_from_table(item: dict[str, Any],
-                                  /) -> None:
+                                  /,
+                                  *,
+                                  condition: str | None = None,
+                                  values: dict[str, Any] | None = None,
+                                  names: dict[str, str] | None = None) -> None:
         table_obj = AWSActions.get_dynamodb_table()
-        table_obj.delete_item(Key=item)
+        if not condition:
+            table_obj.delete_item(Key=item)
+            return None
+        delete_kwargs: dict[str, Any] = {'Key': item, 'ConditionExpression': condition}
+        if values:
+            delete_kwargs['ExpressionAttributeValues'] = values
+        if names:
+            delete_kwargs['ExpressionAttributeNames'] = names
+        table_obj.delete_item(**delete_kwargs)
         return None
 
     @staticmethod
@@ -98,130 +461,3571 @@ class AWSActions:
                                          ExpressionAttributeValues=values)
         return data_to_retrive
 
+    @staticmethod
+    def scan_table_segment(segment: int,
+                           total_segments: int,
+                           /,
+                           *,
+                           projection: str | None = None,
+                           names: dict[str, str] | None = None,
+                           limit: int | None = None,
+                           exclusive_start_key: dict[str, Any] | None = None,
+                           table: Any = None) -> dict[str, Any]:
+        """One page of a parallel scan, with the consumed capacity for rate limiting"""
+        table_obj = table or AWSActions.get_dynamodb_table()
+        scan_kwargs: dict[str, Any] = {'Segment': segment,
+                                       'TotalSegments': total_segments,
+                                       'ReturnConsumedCapacity': 'TOTAL'}
+        if projection:
+            scan_kwargs['ProjectionExpression'] = projection
+        if names:
+            scan_kwargs['ExpressionAttributeNames'] = names
+        if limit:
+            scan_kwargs['Limit'] = limit
+        if exclusive_start_key:
+            scan_kwargs['ExclusiveStartKey'] = exclusive_start_key
+        return table_obj.scan(**scan_kwargs)
+
+    @staticmethod
+    def transact_write_items(actions: list[dict[str, Any]],
+                             /) -> None:
+        AWSActions.get_dynamodb_table().meta.client.transact_write_items(TransactItems=actions)
+        return None
+
+    @staticmethod
+    def query_items_from_table(key_condition: str,
+                               values: dict[str, Any],
+                               /,
+                               *,
+                               index_name: str | None = None,
+                               filter_expressions: str | None = None,
+                               limit: int | None = None,
+                               exclusive_start_key: dict[str, Any] | None = None,
+                               scan_forward: bool = True,
+                               projection: str | None = None,
+                               table: Any = None) -> dict[str, Any]:
+        table_obj = table or AWSActions.get_dynamodb_table()
+        query_kwargs: dict[str, Any] = {
+            'KeyConditionExpression': key_condition,
+            'ExpressionAttributeValues': values,
+            'ScanIndexForward': scan_forward
+        }
+        if index_name:
+            query_kwargs['IndexName'] = index_name
+        if filter_expressions:
+            query_kwargs['FilterExpression'] = filter_expressions
+        if limit:
+            query_kwargs['Limit'] = limit
+        if exclusive_start_key:
+            query_kwargs['ExclusiveStartKey'] = exclusive_start_key
+        if projection:
+            query_kwargs['ProjectionExpression'] = projection
+        return table_obj.query(**query_kwargs)
+
+    @staticmethod
+    def delete_objects_from_bucket(bucket_name: str,
+                                   s3_keys: list[str],
+                                   /) -> dict[str, str]:
+        """
+        Bulk delete with delete_objects, chunks of 1000 keys are sent concurrently
+        returns the keys s3 could not delete mapped to the error message
+        """
+        s3_client = AWSActions.get_s3_client()
+
+        def delete_chunk(chunk: list[str]) -> list[dict[str, Any]]:
+            for attempt in range(BatchSettings.max_retries + 1):
+                try:
+                    response = s3_client.delete_objects(
+                        Bucket=bucket_name,
+                        Delete={'Objects': [{'Key': s3_key} for s3_key in chunk], 'Quiet': True}
+                    )
+                    return response.get('Errors', [])
+                except Exception as e:
+                    if Resilience.error_kind(e) is None or attempt == BatchSettings.max_retries:
+                        raise
+                time.sleep(BatchSettings.retry_base_delay * (2 ** attempt))
+            return []
+
+        failed_keys = {}
+        chunks = Utils.chunked(s3_keys, BatchSettings.s3_delete_chunk_size)
+        with ThreadPoolExecutor(max_workers=BatchSettings.max_workers) as executor:
+            for errors in executor.map(delete_chunk, chunks):
+                failed_keys.update({error['Key']: error.get('Message', error.get('Code', ''))
+                                    for error in errors})
+        return failed_keys
+
+    @staticmethod
+    def batch_write_requests_to_table(table_obj: Any,
+                                      requests: list[dict[str, Any]],
+                                      /) -> list[dict[str, Any]]:
+        """
+        Bulk write with batch_write_item, chunks of 25 requests are sent concurrently and
+        UnprocessedItems are retried with backoff, returns the requests that were never processed
+        """
+        def write_chunk(chunk: list[dict[str, Any]]) -> list[dict[str, Any]]:
+            request_items = {table_obj.name: chunk}
+            for attempt in range(BatchSettings.max_retries + 1):
+                try:
+                    response = table_obj.meta.client.batch_write_item(RequestItems=request_items)
+                except Exception as e:
+                    # a throttled or timed out chunk is retried on its own, like its unprocessed items
+                    if Resilience.error_kind(e) is None or attempt == BatchSettings.max_retries:
+                        raise
+                    response = {'UnprocessedItems': request_items}
+                request_items = response.get('UnprocessedItems') or {}
+                if not request_items:
+                    return []
+                if attempt < BatchSettings.max_retries:
+                    time.sleep(BatchSettings.retry_base_delay * (2 ** attempt))
+            return request_items.get(table_obj.name, [])
+
+        unprocessed_requests = []
+        chunks = Utils.chunked(requests, BatchSettings.dynamo_write_chunk_size)
+        with ThreadPoolExecutor(max_workers=BatchSettings.max_workers) as executor:
+            for chunk_unprocessed in executor.map(write_chunk, chunks):
+                unprocessed_requests.extend(chunk_unprocessed)
+        return unprocessed_requests
+
+    @staticmethod
+    def batch_delete_items_from_table(keys: list[dict[str, Any]],
+                                      /,
+                                      *,
+                                      table: Any = None) -> list[dict[str, Any]]:
+        """Bulk delete by key, returns the keys that were never processed"""
+        unprocessed_requests = AWSActions.batch_write_requests_to_table(
+            table or AWSActions.get_dynamodb_table(),
+            [{'DeleteRequest': {'Key': key}} for key in keys]
+        )
+        return [request['DeleteRequest']['Key'] for request in unprocessed_requests]
+
+    @staticmethod
+    def batch_put_items_in_to_table(items: list[dict[str, Any]],
+                                    /,
+                                    *,
+                                    table: Any = None) -> list[dict[str, Any]]:
+        """Bulk put, returns the items that were never processed"""
+        unprocessed_requests = AWSActions.batch_write_requests_to_table(
+            table or AWSActions.get_dynamodb_table(),
+            [{'PutRequest': {'Item': item}} for item in items]
+        )
+        return [request['PutRequest']['Item'] for request in unprocessed_requests]
+
+    @staticmethod
+    def batch_get_items_from_table(keys: list[dict[str, Any]],
+                                   /,
+                                   *,
+                                   projection: str | None = None,
+                                   table: Any = None) -> tuple[list[dict[str, Any]],
+                                                               list[dict[str, Any]]]:
+        """
+        Bulk read with batch_get_item, chunks of 100 keys are sent concurrently and
+        UnprocessedKeys are retried with backoff, returns (items, keys never processed)
+        """
+        table_obj = table or AWSActions.get_dynamodb_table()
+
+        def get_chunk(chunk: list[dict[str, Any]]) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+            request: dict[str, Any] = {'Keys': chunk}
+            if projection:
+                request['ProjectionExpression'] = projection
+            request_items = {table_obj.name: request}
+            items = []
+            for attempt in range(BatchSettings.max_retries + 1):
+                try:
+                    response = table_obj.meta.client.batch_get_item(RequestItems=request_items)
+                except Exception as e:
+                    if Resilience.error_kind(e) is None or attempt == BatchSettings.max_retries:
+                        raise
+                    response = {'UnprocessedKeys': request_items}
+                items.extend(response.get('Responses', {}).get(table_obj.name, []))
+                request_items = response.get('UnprocessedKeys') or {}
+                if not request_items:
+                    return items, []
+                if attempt < BatchSettings.max_retries:
+                    time.sleep(BatchSettings.retry_base_delay * (2 ** attempt))
+            return items, request_items.get(table_obj.name, {}).get('Keys', [])
+
+        items, unprocessed_keys = [], []
+        chunks = Utils.chunked(keys, BatchSettings.dynamo_get_chunk_size)
+        with ThreadPoolExecutor(max_workers=BatchSettings.max_workers) as executor:
+            for chunk_items, chunk_unprocessed in executor.map(get_chunk, chunks):
+                items.extend(chunk_items)
+                unprocessed_keys.extend(chunk_unprocessed)
+        return items, unprocessed_keys
+
+    @staticmethod
+    def create_multipart_upload(bucket_name: str,
+                                s3_key: str,
+                                content_type: str,
+                                metadata: dict[str, str],
+                                /) -> str:
+        s3_client = AWSActions.get_s3_client()
+        response = s3_client.create_multipart_upload(
+            Bucket=bucket_name,
+            Key=s3_key,
+            ContentType=content_type,
+            Metadata=metadata
+        )
+        return response['UploadId']
+
+    @staticmethod
+    def upload_part(bucket_name: str,
+                    s3_key: str,
+                    upload_id: str,
+                    part_number: int,
+                    body: Any,
+                    /) -> dict[str, Any]:
+        s3_client = AWSActions.get_s3_client()
+        response = s3_client.upload_part(
+            Bucket=bucket_name,
+            Key=s3_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=BufferReader(body) if isinstance(body, memoryview) else body
+        )
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    @staticmethod
+    def list_uploaded_parts(bucket_name: str,
+                            s3_key: str,
+                            upload_id: str,
+                            /) -> list[dict[str, Any]]:
+        s3_client = AWSActions.get_s3_client()
+        paginator = s3_client.get_paginator('list_parts')
+        parts = []
+        for page in paginator.paginate(Bucket=bucket_name, Key=s3_key, UploadId=upload_id):
+            parts.extend({'PartNumber': part['PartNumber'], 'ETag': part['ETag'], 'Size': part['Size']}
+                         for part in page.get('Parts', []))
+        return parts
+
+    @staticmethod
+    def complete_multipart_upload(bucket_name: str,
+                                  s3_key: str,
+                                  upload_id: str,
+                                  parts: list[dict[str, Any]],
+                                  /) -> dict[str, Any]:
+        s3_client = AWSActions.get_s3_client()
+        return s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=s3_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(({'PartNumber': part['PartNumber'], 'ETag': part['ETag']}
+                                              for part in parts),
+                                             key=lambda part: part['PartNumber'])}
+        )
+
+    @staticmethod
+    def abort_multipart_upload(bucket_name: str,
+                               s3_key: str,
+                               upload_id: str,
+                               /) -> None:
+        s3_client = AWSActions.get_s3_client()
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+        return None
+
+
+class ImageRequirements:
+    allowed_types = ['image/jpeg', 'image/png', 'image/gif', 'image/webp']
+    max_size = 5 * 1024 * 1024
+    max_pixels = int(os.environ.get('IMAGE_MAX_PIXELS', str(40_000_000)))
+    decode_chunk_size = 256 * 1024
+    file_extensions = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp',
+                       'image/tiff': '.tiff'}
+
+
+class MultipartSettings:
+    allowed_types = ImageRequirements.allowed_types + ['image/tiff', 'image/x-adobe-dng', 'image/x-canon-cr2',
+                                                       'image/x-nikon-nef', 'image/x-sony-arw']
+    max_size = int(os.environ.get('MULTIPART_MAX_SIZE', str(200 * 1024 * 1024)))
+    min_part_size = 5 * 1024 * 1024
+    max_parts = 10000
+    part_size = max(int(os.environ.get('MULTIPART_PART_SIZE', str(8 * 1024 * 1024))), min_part_size)
+    threshold = int(os.environ.get('MULTIPART_THRESHOLD', str(8 * 1024 * 1024)))
+    max_workers = int(os.environ.get('MULTIPART_MAX_WORKERS', '8'))
+
+    @staticmethod
+    def part_size_for(content_length: int,
+                      /,
+                      *,
+                      part_size: int | None = None) -> int:
+        """Smallest allowed part size that keeps the upload under the s3 part count limit"""
+        part_size = max(part_size or MultipartSettings.part_size, MultipartSettings.min_part_size)
+        return max(part_size, -(-content_length // MultipartSettings.max_parts))
+
+
+class VariantSettings:
+    sizes = {name: int(width) for name, width in
+             (pair.split(':') for pair in os.environ.get('IMAGE_VARIANT_SIZES',
+                                                         'thumb:200,small:480,medium:1024').split(','))}
+    formats = {'webp': ('WEBP', 'image/webp'),
+               'avif': ('AVIF', 'image/avif'),
+               'jpeg': ('JPEG', 'image/jpeg')}
+    default_format = os.environ.get('IMAGE_VARIANT_FORMAT', 'webp')
+    upload_formats = os.environ.get('IMAGE_VARIANT_UPLOAD_FORMATS', default_format).split(',')
+    generate_on_upload = os.environ.get('IMAGE_VARIANT_MODE', 'lazy') == 'upload'
+    # inside lambda the function invokes itself when no dedicated variant function is configured,
+    # a background thread is only used for local runs since lambda freezes it once the response is sent
+    function_name = os.environ.get('VARIANT_FUNCTION_NAME') or os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    # a variant requested longer ago than this without showing up is requested again
+    request_timeout = int(os.environ.get('VARIANT_REQUEST_TIMEOUT', '300'))
+    quality = int(os.environ.get('IMAGE_VARIANT_QUALITY', '80'))
+
+
+class ProcessingSettings:
+    enabled = os.environ.get('IMAGE_PROCESSING_ENABLED', 'false').lower() == 'true'
+    queue_url = os.environ.get('PROCESSING_QUEUE_URL')
+    batch_size = int(os.environ.get('PROCESSING_BATCH_SIZE', '10'))
+    max_workers = int(os.environ.get('PROCESSING_MAX_WORKERS', '4'))
+    dominant_colors = 5
+    sample_size = 64
+    reencode_quality = 95
+
+
+class TieringSettings:
+    # share of get_image reads recorded as lastAccess, 0 turns access tracking off
+    access_sample_rate = float(os.environ.get('ACCESS_SAMPLE_RATE', '0'))
+    access_resolution = int(os.environ.get('ACCESS_RESOLUTION_SECONDS', '3600'))
+    access_flush_size = 25
+    access_flush_interval = 60
+    access_max_tracked = 10000
+    # days without access after which an image moves to the storage class, coldest last,
+    # only classes which serve reads immediately so download urls keep working
+    tiers = [(int(days), storage_class) for days, storage_class in
+             (pair.split(':') for pair in os.environ.get('STORAGE_TIERS', '30:STANDARD_IA,90:GLACIER_IR').split(','))]
+    min_transition_bytes = 128 * 1024
+    total_segments = int(os.environ.get('TIERING_TOTAL_SEGMENTS', '16'))
+    max_workers = int(os.environ.get('TIERING_MAX_WORKERS', '8'))
+    scan_page_size = 99
+    max_read_units_per_second = float(os.environ.get('TIERING_MAX_READ_UNITS', '200'))
+    max_s3_calls_per_second = float(os.environ.get('TIERING_MAX_S3_CALLS', '50'))
+    time_margin_seconds = 60
+
+
+class UsageSettings:
+    table_name = os.environ.get('Usage_table_name', 'ImageUsage')
+    quota_bytes = int(os.environ.get('USER_QUOTA_BYTES', '0'))
+    quota_images = int(os.environ.get('USER_QUOTA_IMAGES', '0'))
+    enabled = bool(quota_bytes or quota_images) or os.environ.get('USAGE_TRACKING_ENABLED', 'false').lower() == 'true'
+
+
+class ConsistencySettings:
+    # items written ahead of the s3 and index writes they describe, hidden from every read
+    uncommitted_statuses = ('pending', 'deleting')
+    # a retry with the same Idempotency-Key takes over an upload pending for longer than this
+    pending_timeout = int(os.environ.get('PENDING_TIMEOUT_SECONDS', '60'))
+    idempotency_namespace = uuid.UUID('5b0f7d1e-3c59-4f0e-9a55-0c3b4c1f6a2d')
+    # ReconciliationJob leaves alone whatever changed more recently than this
+    reconcile_grace = int(os.environ.get('RECONCILE_GRACE_SECONDS', '3600'))
+    reconcile_total_segments = int(os.environ.get('RECONCILE_TOTAL_SEGMENTS', '8'))
+    reconcile_max_read_units = float(os.environ.get('RECONCILE_MAX_READ_UNITS', '200'))
+    # table rows held by one scan segment before they are sorted and spilled to a run file
+    reconcile_run_size = int(os.environ.get('RECONCILE_RUN_SIZE', '50000'))
+    reconcile_batch_size = 1000
+    reconcile_prefetch_pages = 4
+    time_margin_seconds = 30
+
+
+class BatchSettings:
+    max_ids_per_request = 1000
+    s3_delete_chunk_size = 1000
+    dynamo_write_chunk_size = 25
+    dynamo_get_chunk_size = 100
+    max_workers = int(os.environ.get('BATCH_MAX_WORKERS', '8'))
+    max_retries = int(os.environ.get('BATCH_MAX_RETRIES', '5'))
+    retry_base_delay = 0.05
+    delete_page_size = int(os.environ.get('BATCH_DELETE_PAGE_SIZE', '100'))
+
+
+class SearchSettings:
+    table_name = os.environ.get('Search_table_name', 'ImageSearchIndex')
+    max_tags = 20
+    max_title_tokens = 20
+    max_term_length = 64
+    # postings read per query, the page of a multi term search grows in to the lists page by page
+    min_query_size = int(os.environ.get('SEARCH_MIN_QUERY_SIZE', '100'))
+
+
+class ListingRequirements:
+    user_index_name = os.environ.get('User_index_name', 'userId-createdAt-index')
+    default_limit = 50
+    max_limit = 1000
+    sort_orders = {'newest': False, 'oldest': True}
+
+
+class AWSUtils:
+    s3_presigned_url_timeout = 3600
+    s3_presigned_upload_timeout = 900
+    ENDPOINT_URL = "http://localhost.localstack.cloud:4566"
+    max_pool_connections = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '50'))
+    connect_timeout = float(os.environ.get('AWS_CONNECT_TIMEOUT', '5'))
+    read_timeout = float(os.environ.get('AWS_READ_TIMEOUT', '10'))
+    retry_max_attempts = int(os.environ.get('AWS_RETRY_MAX_ATTEMPTS', '3'))
+    # adaptive adds client side rate limiting, which slows the client down while it is throttled
+    retry_mode = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+
+
+class ResilienceSettings:
+    enabled = os.environ.get('RESILIENCE_ENABLED', 'true').lower() == 'true'
+    throttle_max_attempts = int(os.environ.get('THROTTLE_MAX_ATTEMPTS', '4'))
+    throttle_base_delay = 0.1
+    throttle_max_delay = 2.0
+    # an AWSActions call, its retries included, never runs past this nor past the lambda deadline
+    operation_budget = float(os.environ.get('AWS_OPERATION_BUDGET', '8'))
+    deadline_margin = 0.5
+    failure_threshold = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+    open_seconds = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '5'))
+    throttle_codes = {'ProvisionedThroughputExceededException', 'ThrottlingException', 'Throttling',
+                      'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown', 'RequestThrottled',
+                      'RequestThrottledException', 'TransactionInProgressException'}
+    unavailable_codes = {'ServiceUnavailable', 'InternalServerError', 'InternalError', 'InternalFailure',
+                         '500', '503'}
+    timeout_errors = {'ConnectTimeoutError', 'ReadTimeoutError', 'EndpointConnectionError',
+                      'ConnectionClosedError'}
+
+
+class CacheSettings:
+    max_entries = int(os.environ.get('IMAGE_CACHE_MAX_ENTRIES', '1024'))
+    url_expiry_margin = 300
+    ttl = min(int(os.environ.get('IMAGE_CACHE_TTL', '1800')),
+              AWSUtils.s3_presigned_url_timeout - url_expiry_margin)
+
+
+class LogSettings:
+    level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    json_format = os.environ.get('LOG_FORMAT',
+                                 'json' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'text') == 'json'
+    sample_rate = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+    max_value_length = 256
+    redacted_headers = {'authorization', 'cookie', 'x-api-key', 'x-amz-security-token'}
+
+
+class Routes:
+    """(method, resource) of every api gateway route mapped to its ImageServiceHandler method"""
+    table = {
+        ('POST', '/images'): 'upload_image',
+        ('GET', '/images'): 'list_images',
+        ('DELETE', '/images'): 'delete_images',
+        ('POST', '/images/upload-url'): 'create_upload_url',
+        ('POST', '/images/multipart'): 'create_multipart_upload',
+        ('POST', '/images:batchGet'): 'batch_get_images',
+        ('GET', '/images/{imageId}'): 'get_image',
+        ('DELETE', '/images/{imageId}'): 'delete_image',
+        ('POST', '/images/{imageId}/complete'): 'complete_upload',
+        ('GET', '/images/{imageId}/multipart'): 'get_multipart_upload',
+        ('DELETE', '/images/{imageId}/multipart'): 'abort_multipart_upload',
+        ('POST', '/images/{imageId}/multipart/complete'): 'complete_multipart_upload'
+    }
+
+    # Cache-Control of the read routes, answered with an ETag and 304 on a matching If-None-Match.
+    # The responses are per user, so they stay private unless the CDN keys on the authorization header
+    cache_control = {
+        'list_images': os.environ.get('LIST_CACHE_CONTROL', 'private, max-age=0, must-revalidate'),
+        'get_image': os.environ.get('GET_IMAGE_CACHE_CONTROL', 'private, max-age=60')
+    }
+
+    @staticmethod
+    def allowed_methods(resource: str,
+                        /) -> list[str]:
+        return sorted(method for method, route_resource in Routes.table if route_resource == resource)
+
+
+class JsonSettings:
+    backend = os.environ.get('JSON_BACKEND', 'auto')
+    stream_threshold = int(os.environ.get('JSON_STREAM_THRESHOLD', '200'))
+    stream_batch_size = 100
+
+
+class MetricsSettings:
+    enabled = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+    namespace = os.environ.get('METRICS_NAMESPACE', 'ImageHost')
+
+
+class ResponseHeaders:
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*'
+    }
+    message = "Action performed Successfully"
+
+
+class JsonCodec:
+    """
+    json encoding and decoding for request and response bodies, through orjson when it is
+    installed (JSON_BACKEND=auto or orjson) and the standard library otherwise
+    """
+
+    _orjson: Any = None
+    _backend: str | None = None
+
+    @staticmethod
+    def default(value: Any,
+                /) -> Any:
+        """DynamoDB numbers come back as Decimal, they are written as json numbers rather than strings"""
+        if isinstance(value, Decimal):
+            return int(value) if value == value.to_integral_value() else float(value)
+        if isinstance(value, (datetime, date, datetime_time)):
+            return value.isoformat()
+        if isinstance(value, (set, frozenset)):
+            return sorted(value, key=str)
+        return str(value)
+
+    @classmethod
+    def backend(cls) -> str:
+        if cls._backend is None:
+            cls.use(JsonSettings.backend)
+        return cls._backend
+
+    @classmethod
+    def use(cls,
+            backend: str,
+            /) -> str:
+        """Select the backend, auto picks orjson when it can be imported"""
+        if backend not in ('auto', 'orjson', 'stdlib'):
+            raise ValueError(f"Unsupported json backend: {backend}")
+        cls._backend = 'stdlib'
+        if backend != 'stdlib':
+            try:
+                import orjson
+                cls._orjson, cls._backend = orjson, 'orjson'
+            except ImportError:
+                if backend == 'orjson':
+                    raise
+        return cls._backend
+
+    @classmethod
+    def dumps(cls,
+              value: Any,
+              /) -> str:
+        if cls.backend() == 'orjson':
+            return cls._orjson.dumps(value, default=cls.default, option=cls._orjson.OPT_NON_STR_KEYS).decode()
+        return json.dumps(value, default=cls.default, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls,
+              data: str | bytes,
+              /) -> Any:
+        """Raises json.JSONDecodeError on invalid input whichever backend is used"""
+        if cls.backend() == 'orjson':
+            return cls._orjson.loads(data)
+        return json.loads(data)
+
+    @classmethod
+    def iter_dumps(cls,
+                   body: dict[str, Any],
+                   list_key: str,
+                   /,
+                   *,
+                   batch_size: int | None = None) -> Iterator[str]:
+        """
+        Encode body piece by piece, body[list_key] a batch of items at a time, so only one batch
+        is ever held as encoder intermediates and a streaming front can send each piece as it comes
+        """
+        batch_size = batch_size or JsonSettings.stream_batch_size
+        items = body[list_key]
+        rest = {key: value for key, value in body.items() if key != list_key}
+        yield '{' + cls.dumps(list_key) + ':['
+        for offset in range(0, len(items), batch_size):
+            encoded_batch = cls.dumps(items[offset:offset + batch_size])[1:-1]
+            yield (',' if offset else '') + encoded_batch
+        yield ']'
+        if rest:
+            yield ',' + cls.dumps(rest)[1:]
+        else:
+            yield '}'
+
+
+class ImageServiceError(Exception):
+    """Custom exception for image service errors"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ServiceUnavailableError(Exception):
+    """
+    Raised instead of calling aws while a circuit is open or the request is out of time, and when
+    aws still left part of a read unprocessed after the retries
+    """
+
+    def __init__(self, message: str, retry_after: float = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One json object per line, carrying the request id and any fields passed through extra"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_line = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'requestId': StructuredLogging.request_id.get()
+        }
+        log_line.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            log_line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(log_line, default=str)
+
+
+class StructuredLogging:
+    """Cheap request logging, the event body is only serialized when debug logging is on"""
+
+    request_id: contextvars.ContextVar[str | None] = contextvars.ContextVar('request_id', default=None)
+
+    @staticmethod
+    def configure(logger_to_configure: logging.Logger,
+                  /) -> None:
+        logger_to_configure.setLevel(LogSettings.level)
+        if not LogSettings.json_format:
+            return None
+        if not logger_to_configure.handlers:
+            logger_to_configure.addHandler(logging.StreamHandler())
+        for handler in logger_to_configure.handlers:
+            handler.setFormatter(JsonLogFormatter())
+        return None
+
+    @staticmethod
+    def truncate(value: Any,
+                 /) -> Any:
+        if isinstance(value, str) and len(value) > LogSettings.max_value_length:
+            return f"{value[:LogSettings.max_value_length]}...({len(value)} chars)"
+        if isinstance(value, (bytes, bytearray)):
+            return f"({len(value)} bytes)"
+        return value
+
+    @staticmethod
+    def summarize_event(event: dict[str, Any],
+                        /) -> dict[str, Any]:
+        """Method, resource, user and body size of an event, never the body itself"""
+        body = event.get('body')
+        query_params = event.get('queryStringParameters') or {}
+        return {
+            'method': event.get('httpMethod'),
+            'resource': event.get('resource'),
+            'path': StructuredLogging.truncate(event.get('path')),
+            'userId': event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub'),
+            'bodySize': len(body) if body else 0,
+            'isBase64Encoded': event.get('isBase64Encoded', False),
+            'queryParams': {name: StructuredLogging.truncate(value) for name, value in query_params.items()}
+        }
+
+    @staticmethod
+    def redact_event(event: dict[str, Any],
+                     /) -> dict[str, Any]:
+        headers = event.get('headers') or {}
+        return {
+            **event,
+            'body': StructuredLogging.truncate(event.get('body')),
+            'headers': {name: '***' if name.lower() in LogSettings.redacted_headers else value
+                        for name, value in headers.items()}
+        }
+
+    @staticmethod
+    def log_event(event: dict[str, Any],
+                  context: Any,
+                  /) -> None:
+        request_id = getattr(context, 'aws_request_id', None) or event.get('requestContext', {}).get('requestId')
+        StructuredLogging.request_id.set(request_id)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received event: %s", json.dumps(StructuredLogging.redact_event(event), default=str))
+        elif logger.isEnabledFor(logging.INFO) and random.random() < LogSettings.sample_rate:
+            summary = StructuredLogging.summarize_event(event)
+            logger.info("Received event: %s %s", summary['method'], summary['resource'],
+                        extra={'fields': summary})
+        return None
+
+
+class RequestMetrics:
+    """Timings and counters collected while a single request is handled"""
+
+    def __init__(self,
+                 route: str,
+                 /):
+        self.route = route
+        self.started = time.perf_counter()
+        self.timings: list[tuple[str, float]] = []
+        self.counters: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add_timing(self,
+                   name: str,
+                   duration_ms: float,
+                   /) -> None:
+        with self._lock:
+            self.timings.append((name, duration_ms))
+        return None
+
+    def increment(self,
+                  name: str,
+                  value: float = 1,
+                  /) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        return None
+
+
+class Instrumentation:
+    """
+    Optional timing of every AWSActions call and handler stage, published per request in
+    CloudWatch Embedded Metric Format (or to any sink given to install). Nothing is wrapped or
+    hooked until install is called, so a disabled instrumentation costs a single flag check
+    """
+
+    enabled = False
+    sink: Callable[[dict[str, Any]], None] | None = None
+    current: contextvars.ContextVar[RequestMetrics | None] = contextvars.ContextVar('request_metrics', default=None)
+    units = {'RetryAttempts': 'Count', 'RequestBytes': 'Bytes', 'ResponseBytes': 'Bytes',
+             'ImageCacheHits': 'Count', 'ImageCacheMisses': 'Count', 'ThrottleRetries': 'Count',
+             'ShedCalls': 'Count'}
+    _originals: list[tuple[type, str, Any]] = []
+
+    @staticmethod
+    def stdout_sink(document: dict[str, Any],
+                    /) -> None:
+        """Lambda forwards stdout to cloudwatch logs, which extracts the EMF metrics"""
+        print(json.dumps(document, default=str), flush=True)
+        return None
+
+    @classmethod
+    def install(cls,
+                *,
+                sink: Callable[[dict[str, Any]], None] | None = None) -> None:
+        if cls.enabled:
+            return None
+        cls.sink = sink or cls.stdout_sink
+        for owner, names in ((AWSActions, [name for name, value in vars(AWSActions).items()
+                                           if isinstance(value, staticmethod)]),
+                             (ImageServiceHandler, sorted(set(Routes.table.values())))):
+            for name in names:
+                original = vars(owner)[name]
+                cls._originals.append((owner, name, original))
+                function = original.__func__ if isinstance(original, staticmethod) else original
+                wrapped = cls.timed(f"{owner.__name__}.{name}", function)
+                setattr(owner, name, staticmethod(wrapped) if isinstance(original, staticmethod) else wrapped)
+        cls.enabled = True
+        AWSClientRegistry.reset()
+        return None
+
+    @classmethod
+    def uninstall(cls) -> None:
+        for owner, name, original in reversed(cls._originals):
+            setattr(owner, name, original)
+        cls._originals.clear()
+        cls.enabled = False
+        cls.sink = None
+        AWSClientRegistry.reset()
+        return None
+
+    @classmethod
+    def timed(cls,
+              name: str,
+              function: Callable[..., Any],
+              /) -> Callable[..., Any]:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            metrics = cls.current.get()
+            if metrics is None:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.add_timing(name, (time.perf_counter() - started) * 1000)
+        return wrapper
+
+    @classmethod
+    def increment(cls,
+                  name: str,
+                  value: float = 1,
+                  /) -> None:
+        if not cls.enabled:
+            return None
+        metrics = cls.current.get()
+        if metrics is not None:
+            metrics.increment(name, value)
+        return None
+
+    @classmethod
+    def register_client_hooks(cls,
+                              client: Any,
+                              /) -> None:
+        """Count request and response bytes and botocore retries of every call the client makes"""
+        def before_send(request: Any, **kwargs: Any) -> None:
+            body = getattr(request, 'body', None)
+            if isinstance(body, (bytes, bytearray, str)):
+                cls.increment('RequestBytes', len(body))
+
+        def after_call(http_response: Any, parsed: dict[str, Any], **kwargs: Any) -> None:
+            cls.increment('RetryAttempts', parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+            content_length = getattr(http_response, 'headers', {}).get('content-length')
+            if content_length and content_length.isdigit():
+                cls.increment('ResponseBytes', int(content_length))
+
+        client.meta.events.register('before-send', before_send)
+        client.meta.events.register('after-call', after_call)
+        return None
+
+    @classmethod
+    def start_request(cls,
+                      route: str,
+                      /) -> RequestMetrics:
+        metrics = RequestMetrics(route)
+        cls.current.set(metrics)
+        return metrics
+
+    @classmethod
+    def finish_request(cls,
+                       response: dict[str, Any] | None,
+                       /) -> None:
+        metrics = cls.current.get()
+        if metrics is None:
+            return None
+        cls.current.set(None)
+        try:
+            (cls.sink or cls.stdout_sink)(cls.emf_document(metrics, response))
+        except Exception as e:
+            logger.warning(f"Could not publish metrics: {str(e)}")
+        return None
+
+    @staticmethod
+    def emf_document(metrics: RequestMetrics,
+                     response: dict[str, Any] | None,
+                     /) -> dict[str, Any]:
+        values: dict[str, float] = {'RequestDuration': (time.perf_counter() - metrics.started) * 1000}
+        units = {'RequestDuration': 'Milliseconds'}
+        for name, duration_ms in metrics.timings:
+            metric_name = f"{name.split('.')[-1]}Duration"
+            values[metric_name] = values.get(metric_name, 0) + duration_ms
+            units[metric_name] = 'Milliseconds'
+        for name, value in metrics.counters.items():
+            values[name] = value
+            units[name] = Instrumentation.units.get(name, 'Count')
+
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': MetricsSettings.namespace,
+                    'Dimensions': [['Route']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in values]
+                }]
+            },
+            'Route': metrics.route,
+            'RequestId': StructuredLogging.request_id.get(),
+            'StatusCode': response.get('statusCode') if response else None,
+            'Timings': [{'name': name, 'ms': round(duration_ms, 3)} for name, duration_ms in metrics.timings],
+            **{name: round(value, 3) for name, value in values.items()}
+        }
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold calls in a row failed with throttling, unavailability or a
+    timeout, and sheds every call until open_seconds passed. Then a single trial call goes
+    through, its success closes the circuit and its failure opens it again
+    """
+
+    def __init__(self,
+                 failure_threshold: int,
+                 open_seconds: float,
+                 /):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> None:
+        with self._lock:
+            if self.opened_at is None:
+                return None
+            remaining = self.opened_at + self.open_seconds - time.monotonic()
+            if remaining > 0 or self.trial_running:
+                raise ServiceUnavailableError("Service temporarily unavailable", max(remaining, 1))
+            self.trial_running = True
+        return None
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures, self.opened_at, self.trial_running = 0, None, False
+        return None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+        return None
+
+    def release(self) -> None:
+        """End a call which never reached aws, a trial call leaves the circuit open for the next trial"""
+        with self._lock:
+            self.trial_running = False
+        return None
+
+
+class Resilience:
+    """
+    Guards every AWSActions call, wrapped in place like Instrumentation does. Throttled,
+    unavailable and timed out calls, connection errors included, are retried with full jitter
+    exponential backoff while the call's time budget lasts, botocore's own retries are turned
+    off and only its adaptive rate limiting is kept, and a circuit breaker per operation sheds load once an operation keeps failing. Calls
+    made from inside a guarded call are not guarded again. The batch helpers retry the chunks
+    that failed themselves, so they are never retried as a whole. The breakers live in the
+    execution environment, so every lambda instance sheds on its own
+    """
+
+    deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar('deadline', default=None)
+    unguarded = {'get_s3_client', 'get_dynamodb_table', 'get_blob_table', 'get_search_table', 'get_usage_table',
+                 'get_lambda_client', 'get_sqs_client', 'generate_presigned_url_for_object',
+                 'generate_presigned_urls_for_objects', 'generate_presigned_post_for_object'}
+    chunk_retried = {'batch_write_requests_to_table', 'batch_get_items_from_table', 'delete_objects_from_bucket'}
+    _active: contextvars.ContextVar[bool] = contextvars.ContextVar('resilience_active', default=False)
+    _breakers: dict[str, CircuitBreaker] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def install(cls) -> None:
+        for name, value in list(vars(AWSActions).items()):
+            if isinstance(value, staticmethod) and name not in cls.unguarded:
+                setattr(AWSActions, name, staticmethod(cls.guarded(name, value.__func__)))
+        return None
+
+    @classmethod
+    def reset(cls) -> None:
+        """Close every circuit (used by tests)"""
+        with cls._lock:
+            cls._breakers.clear()
+        return None
+
+    @classmethod
+    def start_invocation(cls,
+                         context: Any,
+                         /) -> None:
+        """Take the deadline of a lambda invocation, none outside lambda"""
+        remaining = getattr(context, 'get_remaining_time_in_millis', None)
+        cls.deadline.set(time.monotonic() + remaining() / 1000 if callable(remaining) else None)
+        return None
+
+    @classmethod
+    def breaker(cls,
+                name: str,
+                /) -> CircuitBreaker:
+        breaker = cls._breakers.get(name)
+        if breaker is None:
+            with cls._lock:
+                breaker = cls._breakers.setdefault(name, CircuitBreaker(ResilienceSettings.failure_threshold,
+                                                                        ResilienceSettings.open_seconds))
+        return breaker
+
+    @staticmethod
+    def error_kind(error: Exception,
+                   /) -> str | None:
+        """throttled, unavailable or timeout for the errors a retry later can fix, None otherwise"""
+        code = Utils.client_error_code(error)
+        if code in ResilienceSettings.throttle_codes:
+            return 'throttled'
+        if code in ResilienceSettings.unavailable_codes:
+            return 'unavailable'
+        if type(error).__name__ in ResilienceSettings.timeout_errors:
+            return 'timeout'
+        return None
+
+    @classmethod
+    def response_status(cls,
+                        error: Exception,
+                        /) -> tuple[int, float] | None:
+        """(status code, retry after seconds) of an error the client should retry later"""
+        if isinstance(error, ServiceUnavailableError):
+            return 503, error.retry_after
+        kind = cls.error_kind(error)
+        if kind is None:
+            return None
+        return (504 if kind == 'timeout' else 503), ResilienceSettings.throttle_base_delay
+
+    @classmethod
+    def guarded(cls,
+                name: str,
+                function: Callable[..., Any],
+                /) -> Callable[..., Any]:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if cls._active.get():
+                return function(*args, **kwargs)
+
+            breaker = cls.breaker(name)
+            try:
+                breaker.allow()
+            except ServiceUnavailableError:
+                Instrumentation.increment('ShedCalls')
+                raise
+            started = time.monotonic()
+            deadline = started + ResilienceSettings.operation_budget
+            request_deadline = cls.deadline.get()
+            if request_deadline is not None:
+                deadline = min(deadline, request_deadline - ResilienceSettings.deadline_margin)
+            if deadline <= started:
+                breaker.release()
+                raise ServiceUnavailableError("Not enough time left to call aws")
+
+            max_attempts = 1 if name in cls.chunk_retried else ResilienceSettings.throttle_max_attempts
+            token = cls._active.set(True)
+            try:
+                for attempt in range(max_attempts):
+                    try:
+                        result = function(*args, **kwargs)
+                    except Exception as e:
+                        kind = cls.error_kind(e)
+                        if kind is None:
+                            if hasattr(e, 'response'):
+                                # aws answered, an error of the request itself says nothing of its health
+                                breaker.record_success()
+                            else:
+                                breaker.release()
+                            raise
+                        delay = random.uniform(0, min(ResilienceSettings.throttle_max_delay,
+                                                      ResilienceSettings.throttle_base_delay * 2 ** attempt))
+                        if attempt + 1 >= max_attempts or time.monotonic() + delay >= deadline:
+                            breaker.record_failure()
+                            raise
+                        Instrumentation.increment('ThrottleRetries')
+                        time.sleep(delay)
+                        continue
+                    breaker.record_success()
+                    return result
+            finally:
+                cls._active.reset(token)
+        return wrapper
+
+
+class ImageCache:
+    """
+    Bounded LRU cache of image metadata and presigned download urls kept across warm invocations,
+    entries expire before the url does so a cached url always has time left to be used.
+    Each image holds one entry per variant so invalidating an image drops all of them
+    """
+
+    def __init__(self,
+                 *,
+                 max_entries: int,
+                 ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple[str, str], dict[str, tuple[float, dict[str, Any]]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self,
+            user_id: str,
+            image_id: str,
+            /,
+            *,
+            variant: str = 'original') -> dict[str, Any] | None:
+        with self._lock:
+            variants = self._entries.get((user_id, image_id), {})
+            entry = variants.get(variant)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del variants[variant]
+                self.misses += 1
+                Instrumentation.increment('ImageCacheMisses')
+                return None
+            self._entries.move_to_end((user_id, image_id))
+            self.hits += 1
+            Instrumentation.increment('ImageCacheHits')
+            return entry[1]
+
+    def put(self,
+            user_id: str,
+            image_id: str,
+            value: dict[str, Any],
+            /,
+            *,
+            variant: str = 'original') -> None:
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            self._entries.setdefault((user_id, image_id), {})[variant] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end((user_id, image_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return None
+
+    def invalidate(self,
+                   user_id: str,
+                   image_id: str,
+                   /) -> None:
+        with self._lock:
+            self._entries.pop((user_id, image_id), None)
+        return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+        return None
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class BufferReader:
+    """Seekable read-only file object over a buffer, lets botocore stream a memoryview without copying it"""
+
+    def __init__(self,
+                 buffer: bytes | bytearray | memoryview,
+                 /):
+        self.view = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def __len__(self) -> int:
+        return self.view.nbytes
+
+    def read(self,
+             size: int | None = -1,
+             /) -> bytes:
+        end = self.view.nbytes if size is None or size < 0 else min(self.position + size, self.view.nbytes)
+        chunk = self.view[self.position:end].tobytes()
+        self.position = end
+        return chunk
+
+    def seek(self,
+             offset: int,
+             whence: int = 0,
+             /) -> int:
+        base = {0: 0, 1: self.position, 2: self.view.nbytes}[whence]
+        self.position = max(0, min(base + offset, self.view.nbytes))
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+
+class SearchIndex:
+    """
+    Inverted index of titles and tags in the search table, one posting per (term, image) where the
+    term is userId#tag#<tag> or userId#token#<title token> and the sort key createdAt#imageId keeps
+    every posting list in upload order. A search walks the posting list of each term in sort key order,
+    one query page at a time, and intersects them lazily until the page is full
+    """
+
+    token_pattern = re.compile(r'\w+')
+
+    @staticmethod
+    def normalize_tags(tags: Any,
+                       /) -> list[str]:
+        """Tags as a list or comma separated string, case folded, trimmed and deduplicated in order"""
+        if isinstance(tags, str):
+            tags = tags.split(',')
+        if not isinstance(tags, (list, tuple)):
+            raise ImageServiceError("tags must be a list or a comma separated string")
+        normalized = [' '.join(str(tag).casefold().split())[:SearchSettings.max_term_length] for tag in tags]
+        return list(dict.fromkeys(tag for tag in normalized if tag))[:SearchSettings.max_tags]
+
+    @staticmethod
+    def tokenize(text: str,
+                 /) -> list[str]:
+        tokens = (token[:SearchSettings.max_term_length]
+                  for token in SearchIndex.token_pattern.findall(text.casefold()))
+        return list(dict.fromkeys(tokens))[:SearchSettings.max_title_tokens]
+
+    @staticmethod
+    def term(user_id: str,
+             kind: str,
+             value: str,
+             /) -> str:
+        return f"{user_id}#{kind}#{value}"
+
+    @staticmethod
+    def item_terms(item: dict[str, Any],
+                   /) -> list[str]:
+        return ([SearchIndex.term(item['userId'], 'tag', tag) for tag in item.get('tags') or []] +
+                [SearchIndex.term(item['userId'], 'token', token) for token in item.get('titleTokens') or []])
+
+    @staticmethod
+    def postings(item: dict[str, Any],
+                 /) -> list[dict[str, Any]]:
+        terms = SearchIndex.item_terms(item)
+        if not terms:
+            return []
+        sort_key = f"{item['createdAt']}#{item['imageId']}"
+        return [{'searchTerm': term, 'sortKey': sort_key, 'imageId': item['imageId']} for term in terms]
+
+    @staticmethod
+    def add(items: list[dict[str, Any]],
+            /) -> None:
+        postings = [posting for item in items for posting in SearchIndex.postings(item)]
+        if postings and AWSActions.batch_put_items_in_to_table(postings, table=AWSActions.get_search_table()):
+            raise ImageServiceError("Could not index image for search", 500)
+
+    @staticmethod
+    def remove(items: list[dict[str, Any]],
+               /) -> list[dict[str, Any]]:
+        """Drop the postings of the items, returns the posting keys that could not be deleted"""
+        keys = [{'searchTerm': posting['searchTerm'], 'sortKey': posting['sortKey']}
+                for item in items for posting in SearchIndex.postings(item)]
+        if not keys:
+            return []
+        return AWSActions.batch_delete_items_from_table(keys, table=AWSActions.get_search_table())
+
+    @staticmethod
+    def posting_list(term: str,
+                     after: str | None,
+                     newest_first: bool,
+                     page_size: int,
+                     /) -> Iterator[str]:
+        """The sort keys of the term past the cursor in listing order, read as keys only a page at a time"""
+        key_condition, values = 'searchTerm = :term', {':term': term}
+        if after:
+            key_condition += ' AND sortKey < :after' if newest_first else ' AND sortKey > :after'
+            values[':after'] = after
+        exclusive_start_key = None
+        while True:
+            response = AWSActions.query_items_from_table(key_condition,
+                                                         values,
+                                                         limit=page_size,
+                                                         exclusive_start_key=exclusive_start_key,
+                                                         scan_forward=not newest_first,
+                                                         projection='sortKey',
+                                                         table=AWSActions.get_search_table())
+            yield from (posting['sortKey'] for posting in response['Items'])
+            exclusive_start_key = response.get('LastEvaluatedKey')
+            if not exclusive_start_key:
+                return
+
+    @staticmethod
+    def search(terms: list[str],
+               /,
+               *,
+               limit: int,
+               newest_first: bool = True,
+               after: str | None = None) -> tuple[list[str], str | None]:
+        """
+        Merge intersect the posting lists, each list advancing to the sort key of the one furthest
+        along, and stop at limit + 1 matches so a page costs about what it returns
+        returns (image ids in listing order, sort key to continue after or None)
+        """
+        page_size = max(limit + 1, SearchSettings.min_query_size)
+        posting_lists = [SearchIndex.posting_list(term, after, newest_first, page_size) for term in terms]
+        with ThreadPoolExecutor(max_workers=min(len(terms), BatchSettings.max_workers)) as executor:
+            heads = list(executor.map(lambda posting_list: next(posting_list, None), posting_lists))
+
+        def behind(sort_key: str, target: str) -> bool:
+            return sort_key > target if newest_first else sort_key < target
+
+        matches: list[str] = []
+        while None not in heads:
+            target = min(heads) if newest_first else max(heads)
+            if all(head == target for head in heads):
+                matches.append(target)
+                if len(matches) > limit:
+                    break
+                heads = [next(posting_list, None) for posting_list in posting_lists]
+                continue
+            heads = [next(posting_list, None) if behind(head, target) else head
+                     for head, posting_list in zip(heads, posting_lists)]
+        page = matches[:limit]
+        next_sort_key = page[-1] if len(matches) > limit else None
+        return [sort_key.rsplit('#', 1)[1] for sort_key in page], next_sort_key
+
+
+class RateLimiter:
+    """
+    Token bucket shared by threads. acquire takes the tokens right away, going in to debt if it
+    has to, and sleeps until the debt is paid, so a caller can charge what a call actually consumed
+    """
+
+    def __init__(self,
+                 rate: float,
+                 /):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self,
+                amount: float = 1,
+                /) -> None:
+        if self.rate <= 0:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return None
+
+
+class AccessTracker:
+    """
+    Records when images were last read on the item's lastAccess. Reads are sampled and an image
+    written within the resolution is skipped, the rest is buffered and written in batches by
+    lambda_handler once the response is built. Lambda freezes the process between invocations,
+    so nothing is left to a background thread
+    """
+
+    def __init__(self,
+                 *,
+                 sample_rate: float,
+                 resolution: float,
+                 flush_size: int,
+                 flush_interval: float):
+        self.sample_rate = sample_rate
+        self.resolution = resolution
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending: dict[tuple[str, str], str] = {}
+        self._recorded: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self,
+               user_id: str,
+               image_id: str,
+               /) -> None:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+
+        key, now = (user_id, image_id), time.monotonic()
+        with self._lock:
+            recorded_at = self._recorded.get(key)
+            if recorded_at is not None and now - recorded_at < self.resolution:
+                return None
+            self._recorded[key] = now
+            self._recorded.move_to_end(key)
+            while len(self._recorded) > TieringSettings.access_max_tracked:
+                self._recorded.popitem(last=False)
+            self._pending[key] = datetime.now(timezone.utc).isoformat()
+        return None
+
+    def flush_if_due(self) -> int:
+        """Flush once flush_size accesses are buffered or flush_interval passed since the last flush"""
+        now = time.monotonic()
+        with self._lock:
+            if not self._pending or (len(self._pending) < self.flush_size
+                                     and now - self._last_flush < self.flush_interval):
+                return 0
+            self._last_flush = now
+        return self.flush()
+
+    def flush(self) -> int:
+        """Write the buffered accesses, never moving lastAccess backwards, returns how many failed"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        def write(entry: tuple[tuple[str, str], str]) -> bool:
+            (user_id, image_id), accessed_at = entry
+            try:
+                AWSActions.update_item_in_table(
+                    {'imageId': image_id, 'userId': user_id},
+                    'SET lastAccess = :accessedAt',
+                    {':accessedAt': accessed_at},
+                    condition='attribute_exists(imageId) AND '
+                              '(attribute_not_exists(lastAccess) OR lastAccess < :accessedAt)'
+                )
+            except Exception as e:
+                if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                    logger.warning(f"Could not record access of {image_id}: {str(e)}")
+                    return False
+            return True
+
+        if not pending:
+            return 0
+        with ThreadPoolExecutor(max_workers=BatchSettings.max_workers) as executor:
+            return list(executor.map(write, pending.items())).count(False)
+
+
+class UsageAccounting:
+    """
+    Image count and byte totals per user in the usage table, kept current by uploads and deletes
+    and recomputed from the metadata table by TieringJob. Quotas of 0 are unlimited
+    """
+
+    @staticmethod
+    def check_quota(user_id: str,
+                    size: int,
+                    /,
+                    *,
+                    images: int = 1) -> None:
+        if not UsageSettings.quota_bytes and not UsageSettings.quota_images:
+            return None
+        usage = AWSActions.get_usage(user_id)
+        if UsageSettings.quota_bytes and int(usage.get('totalBytes', 0)) + size > UsageSettings.quota_bytes:
+            raise ImageServiceError("Storage quota exceeded", 403)
+        if UsageSettings.quota_images and int(usage.get('imageCount', 0)) + images > UsageSettings.quota_images:
+            raise ImageServiceError("Image count quota exceeded", 403)
+        return None
+
+    @staticmethod
+    def adjust(user_id: str,
+               size: int,
+               images: int,
+               /) -> None:
+        if UsageSettings.enabled and (size or images):
+            AWSActions.add_usage(user_id, size, images)
+        return None
+
+
+class TieringJob:
+    """
+    Periodic job which moves images nobody read for a while to cheaper storage classes and
+    recomputes the per-user totals. The metadata table is read with parallel segmented scans
+    under a read capacity budget. Each page's totals are committed in one transaction together
+    with the segment checkpoint, so a run can stop at the lambda deadline and resume from its
+    checkpoints without counting a page twice. Once every segment is done the scanned totals
+    replace the live ones of every user whose usage did not change since the run started, the
+    totals of a user who uploaded or deleted while the scan ran are kept and corrected next run
+    """
+
+    checkpoint_prefix = '#checkpoint#'
+    storage_class_order = ['STANDARD', 'STANDARD_IA', 'GLACIER_IR']
+    projection = 'imageId, userId, s3Key, sha256, sizeBytes, storageClass, lastAccess, createdAt'
+
+    def __init__(self,
+                 run_id: str,
+                 /,
+                 *,
+                 total_segments: int | None = None,
+                 deadline: float | None = None):
+        self.run_id = run_id
+        self.total_segments = total_segments or TieringSettings.total_segments
+        self.deadline = deadline
+        self.now = datetime.now(timezone.utc)
+        self.read_limiter = RateLimiter(TieringSettings.max_read_units_per_second)
+        self.s3_limiter = RateLimiter(TieringSettings.max_s3_calls_per_second)
+        self.scan_names = {'#bytes': f"scanBytes_{run_id}", '#images': f"scanImages_{run_id}"}
+        self.transitioned = 0
+        self.usage_kept = 0
+        self.started_at: str | None = None
+        self._lock = threading.Lock()
+
+    def time_left(self) -> bool:
+        return self.deadline is None or time.monotonic() < self.deadline
+
+    def checkpoint_key(self,
+                       segment: int,
+                       /) -> dict[str, str]:
+        return {'userId': f"{TieringJob.checkpoint_prefix}{self.run_id}#{segment}"}
+
+    def run_key(self) -> dict[str, str]:
+        return {'userId': f"{TieringJob.checkpoint_prefix}{self.run_id}#started"}
+
+    def run(self) -> dict[str, Any]:
+        # a resumed run keeps the start of its first invocation, usage changed after it is left alone
+        self.started_at = AWSActions.update_item_in_table(self.run_key(),
+                                                          'SET startedAt = if_not_exists(startedAt, :now)',
+                                                          {':now': self.now.isoformat()},
+                                                          table=AWSActions.get_usage_table())['Attributes']['startedAt']
+        with ThreadPoolExecutor(max_workers=TieringSettings.max_workers) as executor:
+            segments_done = list(executor.map(self.scan_segment, range(self.total_segments)))
+        complete = all(segments_done) and self.finalize()
+        return {'runId': self.run_id, 'complete': complete, 'transitioned': self.transitioned,
+                'usageKept': self.usage_kept}
+
+    def scan_segment(self,
+                     segment: int,
+                     /) -> bool:
+        """Scan one segment from its checkpoint, True once it reached the end"""
+        usage_table = AWSActions.get_usage_table()
+        checkpoint = AWSActions.get_item_from_table(self.checkpoint_key(segment), consistent=True,
+                                                    table=usage_table).get('Item') or {}
+        if checkpoint.get('done'):
+            return True
+
+        pages = int(checkpoint.get('pages', 0))
+        start_key = JsonCodec.loads(checkpoint['startKey']) if checkpoint.get('startKey') else None
+        while self.time_left():
+            response = AWSActions.scan_table_segment(segment,
+                                                     self.total_segments,
+                                                     projection=TieringJob.projection,
+                                                     limit=TieringSettings.scan_page_size,
+                                                     exclusive_start_key=start_key)
+            self.read_limiter.acquire(float(response.get('ConsumedCapacity', {}).get('CapacityUnits', 1)))
+            items = response['Items']
+            self.tier_page(items)
+            start_key = response.get('LastEvaluatedKey')
+            self.commit_page(segment, pages, items, start_key)
+            pages += 1
+            if not start_key:
+                return True
+        return False
+
+    def commit_page(self,
+                    segment: int,
+                    pages: int,
+                    items: list[dict[str, Any]],
+                    start_key: dict[str, Any] | None,
+                    /) -> None:
+        """Add the page totals and advance the checkpoint atomically, a page holds at most 99 users"""
+        totals: dict[str, list[int]] = {}
+        for item in items:
+            user_totals = totals.setdefault(item['userId'], [0, 0])
+            user_totals[0] += int(item.get('sizeBytes', 0))
+            user_totals[1] += 1
+
+        usage_table_name = AWSActions.get_usage_table().name
+        actions: list[dict[str, Any]] = [{'Update': {
+            'TableName': usage_table_name,
+            'Key': {'userId': user_id},
+            'UpdateExpression': 'ADD #bytes :bytes, #images :images',
+            'ExpressionAttributeNames': self.scan_names,
+            'ExpressionAttributeValues': {':bytes': size, ':images': images}
+        }} for user_id, (size, images) in totals.items()]
+        actions.append({'Put': {
+            'TableName': usage_table_name,
+            'Item': {**self.checkpoint_key(segment),
+                     'pages': pages + 1,
+                     'startKey': JsonCodec.dumps(start_key) if start_key else None,
+                     'done': start_key is None},
+            'ConditionExpression': 'attribute_not_exists(userId) OR pages = :pages',
+            'ExpressionAttributeValues': {':pages': pages}
+        }})
+        AWSActions.transact_write_items(actions)
+        return None
+
+    def target_storage_class(self,
+                             item: dict[str, Any],
+                             /) -> str | None:
+        """The colder class the item is due for, None when it stays where it is"""
+        last_used = item.get('lastAccess') or item.get('createdAt')
+        if not last_used or int(item.get('sizeBytes', 0)) < TieringSettings.min_transition_bytes:
+            return None
+        idle_days = (self.now - datetime.fromisoformat(last_used)).days
+        target = None
+        for days, storage_class in TieringSettings.tiers:
+            if idle_days >= days:
+                target = storage_class
+        order = TieringJob.storage_class_order
+        current = item.get('storageClass', 'STANDARD')
+        if target is None or (current in order and order.index(target) <= order.index(current)):
+            return None
+        return target
+
+    def tier_page(self,
+                  items: list[dict[str, Any]],
+                  /) -> None:
+        """Fill in missing sizes and transition the cold images of a page, a failure only skips the image"""
+        for item in items:
+            if 'sizeBytes' not in item and item.get('s3Key'):
+                self.s3_limiter.acquire()
+                try:
+                    head = AWSActions.head_object_in_bucket(BUCKET_NAME, item['s3Key'])
+                    item['sizeBytes'] = head.get('ContentLength', 0)
+                    item['storageClass'] = head.get('StorageClass', 'STANDARD')
+                    AWSActions.update_item_in_table({'imageId': item['imageId'], 'userId': item['userId']},
+                                                    'SET sizeBytes = :size, storageClass = :class',
+                                                    {':size': item['sizeBytes'], ':class': item['storageClass']},
+                                                    condition='attribute_exists(imageId)')
+                except Exception as e:
+                    logger.warning(f"Could not size {item['imageId']}: {str(e)}")
+
+        due = [(item, storage_class) for item in items if (storage_class := self.target_storage_class(item))]
+        shared_blobs: set[str] = set()
+        blob_keys = list({item['sha256'] for item, _ in due if item.get('sha256')})
+        if blob_keys:
+            # a deduplicated blob may be hot through another image, only sole owners move it
+            blobs, _ = AWSActions.batch_get_items_from_table([{'sha256': sha256} for sha256 in blob_keys],
+                                                             projection='sha256, refCount',
+                                                             table=AWSActions.get_blob_table())
+            shared_blobs = {blob['sha256'] for blob in blobs if int(blob.get('refCount', 0)) > 1}
+
+        for item, storage_class in due:
+            if item.get('sha256') in shared_blobs:
+                continue
+            self.s3_limiter.acquire()
+            try:
+                AWSActions.change_storage_class(BUCKET_NAME, item['s3Key'], storage_class)
+                AWSActions.update_item_in_table({'imageId': item['imageId'], 'userId': item['userId']},
+                                                'SET storageClass = :class',
+                                                {':class': storage_class},
+                                                condition='attribute_exists(imageId)')
+                with self._lock:
+                    self.transitioned += 1
+            except Exception as e:
+                logger.warning(f"Could not move {item['imageId']} to {storage_class}: {str(e)}")
+        return None
+
+    def finalize(self) -> bool:
+        """
+        Replace the live totals with the scanned ones and drop the checkpoints, True when done. A
+        user whose usage changed after the run started keeps the live totals, the scan may have
+        missed that change or counted it already
+        """
+        usage_table = AWSActions.get_usage_table()
+        start_key = None
+        while self.time_left():
+            response = AWSActions.scan_table_segment(0, 1, exclusive_start_key=start_key, table=usage_table)
+            self.read_limiter.acquire(float(response.get('ConsumedCapacity', {}).get('CapacityUnits', 1)))
+            for row in response['Items']:
+                if row['userId'].startswith(TieringJob.checkpoint_prefix) or row.get('reconciledRun') == self.run_id:
+                    continue
+                try:
+                    AWSActions.update_item_in_table({'userId': row['userId']},
+                                                    'SET totalBytes = :bytes, imageCount = :images, '
+                                                    'reconciledRun = :run REMOVE #bytes, #images',
+                                                    {':bytes': row.get(self.scan_names['#bytes'], 0),
+                                                     ':images': row.get(self.scan_names['#images'], 0),
+                                                     ':run': self.run_id, ':started': self.started_at},
+                                                    names=self.scan_names,
+                                                    condition='attribute_not_exists(changedAt) OR changedAt < :started',
+                                                    table=usage_table)
+                except Exception as e:
+                    if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                        raise
+                    AWSActions.update_item_in_table({'userId': row['userId']},
+                                                    'SET reconciledRun = :run REMOVE #bytes, #images',
+                                                    {':run': self.run_id},
+                                                    names=self.scan_names,
+                                                    table=usage_table)
+                    self.usage_kept += 1
+            start_key = response.get('LastEvaluatedKey')
+            if not start_key:
+                AWSActions.batch_delete_items_from_table([self.checkpoint_key(segment)
+                                                          for segment in range(self.total_segments)]
+                                                         + [self.run_key()],
+                                                         table=usage_table)
+                return True
+        return False
+
+
+class ReconciliationJob:
+    """
+    Periodic job which repairs the drift crashes leave between the bucket and the tables. The
+    bucket listing runs alongside parallel segmented scans of the metadata table, which spill the
+    s3 keys their items point at as sorted run files. The runs are merged back in key order and
+    joined with the listing, which s3 returns in the same order, so memory is bounded by the run
+    size and the prefetched pages whatever the size of the bucket. Anything changed within the
+    grace period is left alone since it may belong to a request still running. Repairs are
+    conditional writes sent in bulk. The join needs the whole table, so a scan cut short by the
+    deadline repairs nothing, while a join cut short keeps what it repaired so far
+    """
+
+    projection = ('imageId, userId, s3Key, sha256, sizeBytes, variants, tags, titleTokens, '
+                  '#status, statusChangedAt, createdAt')
+    row_attributes = ('imageId', 'userId', 'sha256', 'sizeBytes', 'variants', 'tags', 'titleTokens',
+                      'statusChangedAt', 'createdAt')
+
+    def __init__(self,
+                 /,
+                 *,
+                 deadline: float | None = None,
+                 dry_run: bool = False):
+        self.deadline = deadline
+        self.dry_run = dry_run
+        self.cutoff_time = datetime.now(timezone.utc) - timedelta(seconds=ConsistencySettings.reconcile_grace)
+        self.cutoff = self.cutoff_time.isoformat()
+        self.read_limiter = RateLimiter(ConsistencySettings.reconcile_max_read_units)
+        self.report = dict.fromkeys(('objects', 'rows', 'orphanObjects', 'registered', 'resumedUploads', 'rolledBack',
+                                     'deletesFinished', 'danglingItems', 'missingVariants', 'blobCounts',
+                                     'failed'), 0)
+        self.repairs: list[Callable[[], Any]] = []
+        self.blob_checks: list[tuple[str, int, bool]] = []
+        self._lock = threading.Lock()
+
+    def time_left(self) -> bool:
+        return self.deadline is None or time.monotonic() < self.deadline
+
+    def run(self) -> dict[str, Any]:
+        pages: queue.Queue = queue.Queue(maxsize=ConsistencySettings.reconcile_prefetch_pages)
+        stop = threading.Event()
+        threading.Thread(target=self.list_objects, args=(pages, stop), daemon=True).start()
+        try:
+            with tempfile.TemporaryDirectory() as spill_dir:
+                total_segments = ConsistencySettings.reconcile_total_segments
+                with ThreadPoolExecutor(max_workers=total_segments) as executor:
+                    runs = [path for segment_runs in executor.map(partial(self.spill_segment, spill_dir),
+                                                                  range(total_segments))
+                            for path in segment_runs]
+                complete = self.time_left() and self.join(self.objects(pages), runs)
+        finally:
+            stop.set()
+        return {**self.report, 'complete': complete, 'dryRun': self.dry_run}
+
+    def list_objects(self,
+                     pages: queue.Queue,
+                     stop: threading.Event,
+                     /) -> None:
+        """Prefetch listing pages in to the bounded queue, None marks the end and a failure is passed on"""
+        end: Exception | None = None
+        continuation_token = None
+        try:
+            while not stop.is_set():
+                response = AWSActions.list_objects_in_bucket(BUCKET_NAME, continuation_token=continuation_token)
+                ReconciliationJob.put_page(pages, stop, response.get('Contents', []))
+                continuation_token = response.get('NextContinuationToken')
+                if not response.get('IsTruncated'):
+                    break
+        except Exception as e:
+            end = e
+        ReconciliationJob.put_page(pages, stop, end)
+        return None
+
+    @staticmethod
+    def put_page(pages: queue.Queue,
+                 stop: threading.Event,
+                 page: Any,
+                 /) -> None:
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return None
+            except queue.Full:
+                continue
+        return None
+
+    @staticmethod
+    def objects(pages: queue.Queue,
+                /) -> Iterator[dict[str, Any]]:
+        while (page := pages.get()) is not None:
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+
+    def spill_segment(self,
+                      spill_dir: str,
+                      segment: int,
+                      /) -> list[str]:
+        """Scan one segment, writing its rows out as sorted runs, returns the run files"""
+        paths: list[str] = []
+        rows: list[dict[str, Any]] = []
+        start_key = None
+        while self.time_left():
+            response = AWSActions.scan_table_segment(segment,
+                                                     ConsistencySettings.reconcile_total_segments,
+                                                     projection=ReconciliationJob.projection,
+                                                     names={'#status': 'status'},
+                                                     exclusive_start_key=start_key)
+            self.read_limiter.acquire(float(response.get('ConsumedCapacity', {}).get('CapacityUnits', 1)))
+            for item in response['Items']:
+                rows.extend(ReconciliationJob.item_rows(item))
+            start_key = response.get('LastEvaluatedKey')
+            if rows and (len(rows) >= ConsistencySettings.reconcile_run_size or not start_key):
+                rows.sort(key=itemgetter('s3Key'))
+                path = os.path.join(spill_dir, f"{segment}-{len(paths)}.jsonl")
+                with open(path, 'w') as run_file:
+                    run_file.writelines(f"{JsonCodec.dumps(row)}\n" for row in rows)
+                paths.append(path)
+                rows = []
+            if not start_key:
+                break
+        return paths
+
+    @staticmethod
+    def item_rows(item: dict[str, Any],
+                  /) -> list[dict[str, Any]]:
+        """One row per object the item points at, the image row carries what a repair needs"""
+        if not item.get('s3Key'):
+            return []
+        status = item.get('status', 'active')
+        if status == 'pending' and Utils.is_committed(item):
+            status = 'processing'
+        changed_at = item.get('statusChangedAt') or item.get('createdAt') or ''
+        rows = [{'s3Key': item['s3Key'], 'kind': 'image', 'status': status, 'changedAt': changed_at,
+                 **{name: item[name] for name in ReconciliationJob.row_attributes if name in item}}]
+        rows.extend({'s3Key': variant_key, 'kind': 'variant', 'variant': variant, 'status': status,
+                     'changedAt': changed_at, 'imageId': item['imageId'], 'userId': item['userId']}
+                    for variant, variant_key in (item.get('variants') or {}).items())
+        return rows
+
+    @staticmethod
+    def read_run(path: str,
+                 /) -> Iterator[dict[str, Any]]:
+        with open(path) as run_file:
+            for line in run_file:
+                yield JsonCodec.loads(line)
+
+    def join(self,
+             objects: Iterator[dict[str, Any]],
+             runs: list[str],
+             /) -> bool:
+        """Merge join of the listing with the runs on s3Key, True once both sides are exhausted"""
+        groups = groupby(heapq.merge(*(ReconciliationJob.read_run(path) for path in runs), key=itemgetter('s3Key')),
+                         key=itemgetter('s3Key'))
+        s3_object, group = next(objects, None), next(groups, None)
+        complete = True
+        while s3_object is not None or group is not None:
+            if not self.time_left():
+                complete = False
+                break
+            if group is None or (s3_object is not None and s3_object['Key'] < group[0]):
+                self.reconcile(s3_object['Key'], s3_object, [])
+                s3_object = next(objects, None)
+            elif s3_object is None or group[0] < s3_object['Key']:
+                self.reconcile(group[0], None, list(group[1]))
+                group = next(groups, None)
+            else:
+                self.reconcile(group[0], s3_object, list(group[1]))
+                s3_object, group = next(objects, None), next(groups, None)
+            if len(self.repairs) + len(self.blob_checks) >= ConsistencySettings.reconcile_batch_size:
+                self.flush()
+        self.flush()
+        return complete
+
+    def reconcile(self,
+                  s3_key: str,
+                  s3_object: dict[str, Any] | None,
+                  rows: list[dict[str, Any]],
+                  /) -> None:
+        """Decide the repairs of one key, s3_object is None when the key is missing from the bucket"""
+        self.report['objects'] += s3_object is not None
+        self.report['rows'] += len(rows)
+        if not rows:
+            if s3_object['LastModified'] < self.cutoff_time:
+                self.orphan_object(s3_key)
+            return None
+
+        images = [row for row in rows if row['kind'] == 'image']
+        live = 0
+        for row in images:
+            stale = row['changedAt'] < self.cutoff
+            if row['status'] == 'pending':
+                if stale and s3_object is not None and s3_key.startswith('images/'):
+                    self.repair('resumedUploads', self.adopt_object, s3_key)
+                elif stale:
+                    self.repair('rolledBack', self.roll_back, row)
+            elif row['status'] == 'deleting':
+                if stale:
+                    self.repair('deletesFinished', ImageServiceHandler.finish_delete, row, 'sha256' not in row)
+            elif s3_object is None and stale:
+                self.repair('danglingItems', self.drop_dangling, row)
+            else:
+                live += 1
+        if s3_object is None:
+            for row in rows:
+                if (row['kind'] == 'variant' and row['status'] not in ConsistencySettings.uncommitted_statuses
+                        and row['changedAt'] < self.cutoff):
+                    self.repair('missingVariants', self.remove_variant, row)
+
+        settled = all(row['changedAt'] < self.cutoff for row in images)
+        if images and settled and s3_key.startswith('blobs/') and (
+                s3_object is None or s3_object['LastModified'] < self.cutoff_time):
+            self.blob_checks.append((s3_key.split('/', 1)[1], live, s3_object is not None))
+        return None
+
+    def orphan_object(self,
+                      s3_key: str,
+                      /) -> None:
+        """An object no item points at, only the prefixes this service writes are touched"""
+        if s3_key.startswith('blobs/'):
+            self.repair('orphanObjects', self.delete_orphan_blob, s3_key)
+        elif s3_key.startswith('images/'):
+            self.repair('orphanObjects', self.adopt_object, s3_key)
+        return None
+
+    def repair(self,
+               kind: str,
+               function: Callable[..., Any],
+               /,
+               *args: Any) -> None:
+        self.report[kind] += 1
+        if not self.dry_run:
+            self.repairs.append(partial(function, *args))
+        return None
+
+    def flush(self) -> None:
+        """Send the repairs decided so far, a repair may return s3 keys which are then deleted in bulk"""
+        if self.blob_checks:
+            self.check_blobs(self.blob_checks)
+            self.blob_checks = []
+        repairs, self.repairs = self.repairs, []
+        if not repairs:
+            return None
+        s3_keys_to_delete = []
+        for result in Utils.run_async(AsyncAWSActions.map(lambda repair: repair(), repairs)):
+            if isinstance(result, Exception):
+                logger.warning(f"Reconciliation repair failed: {str(result)}")
+                self.report['failed'] += 1
+            elif isinstance(result, list):
+                s3_keys_to_delete.extend(result)
+        if s3_keys_to_delete:
+            failed_keys = AWSActions.delete_objects_from_bucket(BUCKET_NAME, s3_keys_to_delete)
+            self.report['failed'] += len(failed_keys)
+        return None
+
+    def check_blobs(self,
+                    checks: list[tuple[str, int, bool]],
+                    /) -> None:
+        """Compare the reference counts with the items counted by the join, (sha256, items, stored)"""
+        records, _ = AWSActions.batch_get_items_from_table([{'sha256': sha256} for sha256, _, _ in checks],
+                                                           projection='sha256, refCount, updatedAt',
+                                                           table=AWSActions.get_blob_table())
+        records_by_sha = {record['sha256']: record for record in records}
+        for sha256, references, stored in checks:
+            record = records_by_sha.get(sha256)
+            if record is not None and record.get('updatedAt', '') >= self.cutoff:
+                continue
+            observed = None if record is None else int(record.get('refCount', 0))
+            if references == 0 and stored:
+                self.repair('orphanObjects', self.delete_orphan_blob, ContentStore.blob_s3_key(sha256))
+            elif references == 0 and record is not None:
+                self.repair('blobCounts', AWSActions.delete_blob_record_if_stale, sha256, self.cutoff)
+            elif references and observed != references:
+                self.repair('blobCounts', AWSActions.repair_blob_reference, sha256, references, observed, self.cutoff)
+        return None
+
+    def delete_orphan_blob(self,
+                           s3_key: str,
+                           /) -> list[str]:
+        """The record goes first, so an upload acquiring the blob meanwhile keeps the object"""
+        if AWSActions.delete_blob_record_if_stale(s3_key.split('/', 1)[1], self.cutoff):
+            return [s3_key]
+        return []
+
+    def adopt_object(self,
+                     s3_key: str,
+                     /) -> list[str]:
+        """
+        Roll a direct upload whose completion was lost forward, anything else under images/ goes.
+        Only a failed validation condemns the object, a failure once the item is being written
+        keeps it for the next run
+        """
+        service = ImageServiceHandler()
+        try:
+            item = service.uploaded_object_item(s3_key)
+        except ImageServiceError:
+            return [s3_key]
+        service.store_uploaded_item(item)
+        with self._lock:
+            self.report['registered'] += 1
+        return []
+
+    def roll_back(self,
+                  row: dict[str, Any],
+                  /) -> None:
+        """Remove an upload abandoned while pending, unless a retry took it over meanwhile"""
+        try:
+            AWSActions.delete_an_item_from_table({'imageId': row['imageId'], 'userId': row['userId']},
+                                                 condition='#status = :pending AND statusChangedAt = :seen',
+                                                 values={':pending': 'pending', ':seen': row['changedAt']},
+                                                 names={'#status': 'status'})
+        except Exception as e:
+            if Utils.client_error_code(e) == 'ConditionalCheckFailedException':
+                return None
+            raise
+        SearchIndex.remove([row])
+        return None
+
+    @staticmethod
+    def drop_dangling(row: dict[str, Any],
+                      /) -> None:
+        """Delete an item whose object is gone, through the same claim a user's delete makes"""
+        key = {'imageId': row['imageId'], 'userId': row['userId']}
+        try:
+            claimed = ImageServiceHandler().claim_delete(key)
+        except ImageServiceError:
+            return None
+        if claimed:
+            if 'sha256' in row:
+                ContentStore.release(row['sha256'])
+            UsageAccounting.adjust(row['userId'], -int(row.get('sizeBytes') or 0), -1)
+        ImageServiceHandler.finish_delete(row, False)
+        return None
+
+    @staticmethod
+    def remove_variant(row: dict[str, Any],
+                       /) -> None:
+        try:
+            AWSActions.update_item_in_table({'imageId': row['imageId'], 'userId': row['userId']},
+                                            'REMOVE variants.#variant',
+                                            {':s3Key': row['s3Key']},
+                                            names={'#variant': row['variant']},
+                                            condition='variants.#variant = :s3Key')
+        except Exception as e:
+            if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                raise
+        return None
+
+
+class MultipartUploadError(ImageServiceError):
+    """Raised when a server side multipart upload fails, carries the upload id for resuming"""
+
+    def __init__(self, message: str, upload_id: str, status_code: int = 500):
+        super().__init__(message, status_code)
+        self.upload_id = upload_id
+
+
+class MultipartUploader:
+    """Uploads large bodies to s3 as parts in parallel on a thread pool"""
+
+    def __init__(self,
+                 *,
+                 part_size: int | None = None,
+                 max_workers: int | None = None,
+                 abort_on_failure: bool = True):
+        self.part_size = max(part_size or MultipartSettings.part_size, MultipartSettings.min_part_size)
+        self.max_workers = max_workers or MultipartSettings.max_workers
+        self.abort_on_failure = abort_on_failure
+
+    def iter_parts(self,
+                   body: Any,
+                   part_size: int,
+                   /) -> Iterator[tuple[int, Any]]:
+        """Yields (part_number, chunk), bytes-like bodies are sliced without copying"""
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            view = memoryview(body)
+            for part_number, offset in enumerate(range(0, len(view), part_size), start=1):
+                yield part_number, view[offset:offset + part_size]
+            return
+
+        part_number = 1
+        while chunk := body.read(part_size):
+            yield part_number, chunk
+            part_number += 1
+
+    def upload(self,
+               bucket_name: str,
+               s3_key: str,
+               body: Any,
+               content_type: str,
+               metadata: dict[str, str],
+               /,
+               *,
+               upload_id: str | None = None,
+               content_length: int | None = None) -> dict[str, Any]:
+        """
+        Upload body (bytes-like or a readable file object) as a multipart upload
+        @upload_id: an existing upload to resume, parts already in s3 are not sent again
+        """
+        if content_length is None and isinstance(body, (bytes, bytearray, memoryview)):
+            content_length = len(body)
+        part_size = MultipartSettings.part_size_for(content_length or 0, part_size=self.part_size)
+
+        completed_parts: dict[int, dict[str, Any]] = {}
+        if upload_id:
+            completed_parts = {part['PartNumber']: part
+                               for part in AWSActions.list_uploaded_parts(bucket_name, s3_key, upload_id)}
+        else:
+            upload_id = AWSActions.create_multipart_upload(bucket_name, s3_key, content_type, metadata)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                in_flight: set[Future] = set()
+                for part_number, chunk in self.iter_parts(body, part_size):
+                    uploaded = completed_parts.get(part_number)
+                    if uploaded and uploaded.get('Size', len(chunk)) == len(chunk):
+                        continue
+                    if len(in_flight) >= self.max_workers * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            part = future.result()
+                            completed_parts[part['PartNumber']] = part
+                    in_flight.add(executor.submit(AWSActions.upload_part, bucket_name, s3_key,
+                                                  upload_id, part_number, chunk))
+
+                for future in in_flight:
+                    part = future.result()
+                    completed_parts[part['PartNumber']] = part
+
+            return AWSActions.complete_multipart_upload(bucket_name, s3_key, upload_id,
+                                                        list(completed_parts.values()))
+        except Exception as e:
+            logger.error(f"Multipart upload {upload_id} for {s3_key} failed: {str(e)}")
+            if self.abort_on_failure:
+                AWSActions.abort_multipart_upload(bucket_name, s3_key, upload_id)
+            raise MultipartUploadError(f"Multipart upload failed: {str(e)}", upload_id)
+
+
+class ImageInspector:
+    """Detects the image format from its magic bytes and reads the dimensions from the headers only"""
+
+    jpeg_sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+    @staticmethod
+    def inspect(data: memoryview,
+                /) -> tuple[str, int, int]:
+        """Returns (content_type, width, height), never decodes pixels or copies the body"""
+        if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+            return 'image/png', int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')
+        if data[:6] in (b'GIF87a', b'GIF89a') and len(data) >= 10:
+            return 'image/gif', int.from_bytes(data[6:8], 'little'), int.from_bytes(data[8:10], 'little')
+        if data[:3] == b'\xff\xd8\xff':
+            return ('image/jpeg', *ImageInspector.jpeg_dimensions(data))
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            return ('image/webp', *ImageInspector.webp_dimensions(data))
+        raise ImageServiceError("Unrecognized image data")
+
+    @staticmethod
+    def jpeg_dimensions(data: memoryview,
+                        /) -> tuple[int, int]:
+        """Walk the marker segments up to the first start of frame"""
+        offset = 2
+        while offset + 9 <= len(data):
+            if data[offset] != 0xFF:
+                break
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                offset += 1
+                continue
+            if marker in ImageInspector.jpeg_sof_markers:
+                return (int.from_bytes(data[offset + 7:offset + 9], 'big'),
+                        int.from_bytes(data[offset + 5:offset + 7], 'big'))
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                offset += 2
+                continue
+            offset += 2 + int.from_bytes(data[offset + 2:offset + 4], 'big')
+        raise ImageServiceError("Corrupt JPEG header")
+
+    @staticmethod
+    def webp_dimensions(data: memoryview,
+                        /) -> tuple[int, int]:
+        chunk = data[12:16]
+        if chunk == b'VP8 ' and len(data) >= 30:
+            return (int.from_bytes(data[26:28], 'little') & 0x3FFF,
+                    int.from_bytes(data[28:30], 'little') & 0x3FFF)
+        if chunk == b'VP8L' and len(data) >= 25:
+            bits = int.from_bytes(data[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X' and len(data) >= 30:
+            return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+        raise ImageServiceError("Corrupt WebP header")
+
+
+class AsyncAWSActions:
+    """
+    asyncio front for AWSActions so a handler can overlap independent s3 and dynamodb calls,
+    the calls run on one pooled executor sized like the boto3 connection pool and share the
+    cached, thread safe clients of AWSClientRegistry. A call made from a pool worker, such as
+    a reconciliation repair which deletes an image, runs inline on that worker, waiting on the
+    pool from inside it deadlocks once every worker waits
+    """
+
+    _executor: ThreadPoolExecutor | None = None
+    _lock = threading.Lock()
+    _worker = threading.local()
+
+    @classmethod
+    def mark_worker(cls) -> None:
+        cls._worker.active = True
+        return None
+
+    @classmethod
+    def executor(cls) -> ThreadPoolExecutor:
+        if cls._executor is None:
+            with cls._lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(max_workers=AWSUtils.max_pool_connections,
+                                                       thread_name_prefix='aws-actions',
+                                                       initializer=cls.mark_worker)
+        return cls._executor
+
+    @classmethod
+    async def run(cls,
+                  function: Callable[..., Any],
+                  /,
+                  *args: Any) -> Any:
+        """Await function(*args) on the pool, carrying over context vars such as request metrics"""
+        if getattr(cls._worker, 'active', False):
+            return function(*args)
+        import asyncio
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(cls.executor(),
+                                                                partial(context.run, function, *args))
+
+    @classmethod
+    async def map(cls,
+                  function: Callable[[Any], Any],
+                  items: list[Any],
+                  /) -> list[Any]:
+        """function over every item on the pool, a failure comes back in place of its result"""
+        import asyncio
+        return await asyncio.gather(*(cls.run(function, item) for item in items), return_exceptions=True)
+
+    @staticmethod
+    async def gather_with_rollback(*legs: tuple[Awaitable[Any], Callable[[], Awaitable[Any]] | None]) -> list[Any]:
+        """
+        Run the legs concurrently, each leg is (awaitable, rollback). When any leg fails the
+        rollback of every leg that succeeded is awaited and the first failure is raised
+        """
+        import asyncio
+        results = await asyncio.gather(*(leg for leg, _ in legs), return_exceptions=True)
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if not failures:
+            return results
+
+        for (_, rollback), result in zip(legs, results):
+            if rollback is None or isinstance(result, BaseException):
+                continue
+            try:
+                await rollback()
+            except Exception as e:
+                logger.error(f"Rollback failed: {str(e)}")
+        raise failures[0]
+
+
+class ContentStore:
+    """
+    Content addressed storage for uploaded images, identical bytes share one blobs/{sha256} object
+    and a reference count record in the blob table decides when the object can go away. The record
+    is marked stored once a put of the object succeeded, until then every upload of the same bytes
+    puts them itself, so an image is never committed on a blob whose first put is still running or failed
+    """
+
+    hash_chunk_size = 1024 * 1024
+
+    @staticmethod
+    def blob_s3_key(sha256: str,
+                    /) -> str:
+        return f"blobs/{sha256}"
+
+    @staticmethod
+    def sha256_digest(data: bytes | bytearray | memoryview | str,
+                      /) -> str:
+        """Hash the body chunk by chunk over a memoryview so no copy of it is made"""
+        if isinstance(data, str):
+            data = data.encode()
+        view = memoryview(data)
+        digest = hashlib.sha256()
+        for offset in range(0, len(view), ContentStore.hash_chunk_size):
+            digest.update(view[offset:offset + ContentStore.hash_chunk_size])
+        return digest.hexdigest()
+
+    @staticmethod
+    def acquire(sha256: str,
+                content_type: str,
+                /) -> bool:
+        """Take a reference on the blob, True when its bytes are not stored yet and the caller has to store them"""
+        return not AWSActions.update_blob_reference(sha256, 1, content_type=content_type).get('stored')
+
+    @staticmethod
+    def store(sha256: str,
+              data: bytes | bytearray | memoryview,
+              user_id: str,
+              content_type: str,
+              /) -> None:
+        """Put the bytes of an acquired blob, then mark its record stored for later uploads of them"""
+        AWSActions.put_object_in_to_bucket(BUCKET_NAME, ContentStore.blob_s3_key(sha256), data, user_id, content_type)
+        AWSActions.mark_blob_stored(sha256)
+        return None
+
+    @staticmethod
+    def release(sha256: str,
+                /) -> bool:
+        """Drop a reference on the blob, True when it was the last one and the object should be deleted"""
+        if int(AWSActions.update_blob_reference(sha256, -1).get('refCount', 0)) > 0:
+            return False
+        return AWSActions.delete_blob_record_if_unreferenced(sha256)
+
+
+class ImageVariants:
+    """Resized and re-encoded copies of an image, generated off the request path"""
+
+    _executor: ThreadPoolExecutor | None = None
+
+    @staticmethod
+    def variant_name(size: str,
+                     image_format: str,
+                     /) -> str:
+        if size not in VariantSettings.sizes:
+            raise ImageServiceError(f"Unsupported size: {size}")
+        if image_format not in VariantSettings.formats:
+            raise ImageServiceError(f"Unsupported format: {image_format}")
+        return f"{size}.{image_format}"
+
+    @staticmethod
+    def variant_s3_key(user_id: str,
+                       image_id: str,
+                       variant: str,
+                       /) -> str:
+        return f"images/{user_id}/{image_id}/{variant}"
+
+    @staticmethod
+    def render(source: bytes,
+               width: int,
+               image_format: str,
+               /) -> bytes:
+        """Scale source down to width (never up) and encode it as image_format"""
+        from PIL import Image, ImageOps
+
+        pil_format = VariantSettings.formats[image_format][0]
+        with Image.open(BytesIO(source)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width, max(1, image.height * width // max(image.width, 1))))
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            output = BytesIO()
+            image.save(output, format=pil_format, quality=VariantSettings.quality)
+        return output.getvalue()
+
+    @staticmethod
+    def generate(user_id: str,
+                 image_id: str,
+                 variants: list[str],
+                 /) -> dict[str, str]:
+        """Render the missing variants, store them in s3 and record them on the table item"""
+        key = {'imageId': image_id, 'userId': user_id}
+        response = AWSActions.get_item_from_table(key)
+        if 'Item' not in response:
+            raise ImageServiceError("Image not found", 404)
+
+        item = response['Item']
+        existing_variants = item.get('variants') or {}
+        missing_variants = [variant for variant in variants if variant not in existing_variants]
+        if not missing_variants:
+            return existing_variants
+
+        source = AWSActions.get_object_from_bucket(BUCKET_NAME, item['s3Key'])
+        generated_variants = {}
+        for variant in missing_variants:
+            size, image_format = variant.split('.')
+            s3_key = ImageVariants.variant_s3_key(user_id, image_id, variant)
+            AWSActions.put_object_in_to_bucket(BUCKET_NAME,
+                                               s3_key,
+                                               ImageVariants.render(source, VariantSettings.sizes[size], image_format),
+                                               user_id,
+                                               VariantSettings.formats[image_format][1])
+            generated_variants[variant] = s3_key
+
+        names = {'#variants': 'variants'}
+        values = {}
+        assignments = []
+        for index, (variant, s3_key) in enumerate(generated_variants.items()):
+            names[f'#v{index}'] = variant
+            values[f':v{index}'] = s3_key
+            assignments.append(f'#variants.#v{index} = :v{index}')
+        requested = [index for index, variant in enumerate(generated_variants)
+                     if variant in (item.get('variantRequests') or {})]
+        removal = ''
+        if requested:
+            names['#requests'] = 'variantRequests'
+            removal = ' REMOVE ' + ', '.join(f'#requests.#v{index}' for index in requested)
+        created = False
+        if 'variants' not in item:
+            # the first variants of the image create the map, unless a concurrent generator did already
+            map_names = {'#variants': 'variants', **{f'#v{index}': names[f'#v{index}'] for index in requested}}
+            if requested:
+                map_names['#requests'] = 'variantRequests'
+            try:
+                AWSActions.update_item_in_table(key, 'SET #variants = :variants' + removal,
+                                                {':variants': generated_variants},
+                                                names=map_names,
+                                                condition='attribute_exists(imageId) AND attribute_not_exists(#variants)')
+                created = True
+            except Exception as e:
+                if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                    raise
+        if not created:
+            AWSActions.update_item_in_table(key, 'SET ' + ', '.join(assignments) + removal, values, names=names)
+        image_cache.invalidate(user_id, image_id)
+        return {**existing_variants, **generated_variants}
+
+    @staticmethod
+    def claim_request(item: dict[str, Any],
+                      variant: str,
+                      /) -> bool:
+        """
+        Mark the variant requested on the item, False when a request for it is in flight already
+        so a popular image renders a missing variant once rather than once per read
+        """
+        now = datetime.now(timezone.utc)
+        names = {'#variants': 'variants', '#requests': 'variantRequests', '#variant': variant}
+        condition = 'attribute_exists(imageId) AND attribute_not_exists(#variants.#variant)'
+        if 'variantRequests' in item:
+            update_expression = 'SET #requests.#variant = :now'
+            values = {':now': now.isoformat(),
+                      ':stale': (now - timedelta(seconds=VariantSettings.request_timeout)).isoformat()}
+            condition += (' AND attribute_exists(#requests) AND '
+                          '(attribute_not_exists(#requests.#variant) OR #requests.#variant < :stale)')
+        else:
+            update_expression = 'SET #requests = :requests'
+            values = {':requests': {variant: now.isoformat()}}
+            condition += ' AND attribute_not_exists(#requests)'
+        try:
+            AWSActions.update_item_in_table({'imageId': item['imageId'], 'userId': item['userId']},
+                                            update_expression, values, names=names, condition=condition)
+        except Exception as e:
+            if Utils.client_error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    @classmethod
+    def request(cls,
+                user_id: str,
+                image_id: str,
+                variants: list[str],
+                /) -> None:
+        """
+        Schedule generation without waiting for it, through an async invoke of the variant
+        function, or of this function inside lambda, otherwise on a background thread
+        """
+        payload = {'userId': user_id, 'imageId': image_id, 'variants': variants}
+        if VariantSettings.function_name:
+            AWSActions.invoke_function_async(VariantSettings.function_name, payload)
+            return None
+
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-variants')
+        future = cls._executor.submit(cls.generate, user_id, image_id, variants)
+        future.add_done_callback(lambda done: done.exception() and logger.error(
+            f"Variant generation for {image_id} failed: {str(done.exception())}"))
+        return None
+
+
+class ImageProcessing:
+    """
+    Post-upload processing off the request path: strips EXIF and other embedded metadata from
+    the stored object, records dimensions, dominant colors and a perceptual hash on the item and
+    moves its status from processing to active, or to failed so a redelivery can try again.
+    Processing an image twice is harmless, an item which already has processedAt is skipped.
+    A deduplicated blob is never rewritten, the item moves to the blob of the stripped bytes
+    """
+
+    jpeg_dropped_segments = {0xE1, 0xED}
+    png_dropped_chunks = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+    webp_dropped_chunks = {b'EXIF', b'XMP '}
+
+    @staticmethod
+    def strip_jpeg(data: memoryview,
+                   /) -> bytes:
+        """Drop APP1 (Exif, XMP) and APP13 (IPTC) segments, the entropy coded data is copied untouched"""
+        parts = [data[:2]]
+        offset = 2
+        while offset + 4 <= len(data) and data[offset] == 0xFF:
+            marker = data[offset + 1]
+            if marker == 0xDA:
+                break
+            end = offset + 2 + int.from_bytes(data[offset + 2:offset + 4], 'big')
+            if marker not in ImageProcessing.jpeg_dropped_segments:
+                parts.append(data[offset:end])
+            offset = end
+        parts.append(data[offset:])
+        return b''.join(parts)
+
+    @staticmethod
+    def strip_png(data: memoryview,
+                  /) -> bytes:
+        parts = [data[:8]]
+        offset = 8
+        while offset + 12 <= len(data):
+            end = offset + 12 + int.from_bytes(data[offset:offset + 4], 'big')
+            if bytes(data[offset + 4:offset + 8]) not in ImageProcessing.png_dropped_chunks:
+                parts.append(data[offset:end])
+            offset = end
+        parts.append(data[offset:])
+        return b''.join(parts)
+
+    @staticmethod
+    def strip_webp(data: memoryview,
+                   /) -> bytes:
+        parts = []
+        offset = 12
+        while offset + 8 <= len(data):
+            fourcc = bytes(data[offset:offset + 4])
+            end = offset + 8 + int.from_bytes(data[offset + 4:offset + 8], 'little')
+            end += end % 2
+            if fourcc == b'VP8X':
+                chunk = bytearray(data[offset:end])
+                chunk[8] &= ~0x0C
+                parts.append(chunk)
+            elif fourcc not in ImageProcessing.webp_dropped_chunks:
+                parts.append(data[offset:end])
+            offset = end
+        body = b''.join(parts)
+        return b'RIFF' + (len(body) + 4).to_bytes(4, 'little') + b'WEBP' + body
+
+    @staticmethod
+    def strip_metadata(source: bytes,
+                       content_type: str,
+                       /) -> bytes:
+        """Remove embedded metadata without re-encoding, GIF has none worth removing"""
+        strip = {'image/jpeg': ImageProcessing.strip_jpeg,
+                 'image/png': ImageProcessing.strip_png,
+                 'image/webp': ImageProcessing.strip_webp}.get(content_type)
+        return strip(memoryview(source)) if strip else source
+
+    @staticmethod
+    def analyze(source: bytes,
+                content_type: str,
+                /) -> tuple[bytes, dict[str, Any]]:
+        """Returns (source without embedded metadata, attributes for the item)"""
+        from PIL import Image, ImageOps
+
+        with Image.open(BytesIO(source)) as image:
+            image_format = image.format
+            if image.getexif().get(0x0112, 1) != 1:
+                # the orientation lives in the exif about to be dropped, so bake it in to the pixels
+                image = ImageOps.exif_transpose(image)
+                output = BytesIO()
+                save_options = {'quality': ProcessingSettings.reencode_quality} if image_format != 'PNG' else {}
+                image.save(output, format=image_format, **save_options)
+                source = output.getvalue()
+            else:
+                image.draft('RGB', (ProcessingSettings.sample_size * 4, ProcessingSettings.sample_size * 4))
+            width, height = image.size
+            sample = image.convert('RGB')
+
+        sample.thumbnail((ProcessingSettings.sample_size, ProcessingSettings.sample_size))
+        quantized = sample.quantize(colors=ProcessingSettings.dominant_colors)
+        palette = quantized.getpalette() or []
+        dominant_colors = ['#{:02x}{:02x}{:02x}'.format(*palette[index * 3:index * 3 + 3])
+                           for _, index in sorted(quantized.getcolors() or [], reverse=True)]
+
+        # difference hash: 8 rows of 9 grey pixels, one bit per horizontal neighbour comparison
+        pixels = sample.convert('L').resize((9, 8)).tobytes()
+        bits = [pixels[row * 9 + column] > pixels[row * 9 + column + 1] for row in range(8) for column in range(8)]
+        perceptual_hash = f"{sum(bit << index for index, bit in enumerate(reversed(bits))):016x}"
+
+        return ImageProcessing.strip_metadata(source, content_type), {
+            'width': width,
+            'height': height,
+            'dominantColors': dominant_colors,
+            'perceptualHash': perceptual_hash
+        }
+
+    @staticmethod
+    def process(user_id: str,
+                image_id: str,
+                /) -> str:
+        """Process one image, returns the status it ended in"""
+        key = {'imageId': image_id, 'userId': user_id}
+        item = AWSActions.get_item_from_table(key).get('Item')
+        if not item:
+            return 'missing'
+        if item.get('processedAt') or not Utils.is_committed(item):
+            return item.get('status', 'active')
+
+        names = {'#status': 'status'}
+        condition = 'attribute_exists(imageId) AND attribute_not_exists(processedAt)'
+        new_sha256 = None
+        try:
+            source = AWSActions.get_object_from_bucket(BUCKET_NAME, item['s3Key'])
+            stripped, attributes = ImageProcessing.analyze(source, item.get('contentType', ''))
+            values = {':status': 'active', ':processedAt': datetime.now(timezone.utc).isoformat(),
+                      ':exifStripped': stripped != source}
+            assignments = ['#status = :status', 'processedAt = :processedAt', 'exifStripped = :exifStripped']
+            if stripped != source and item.get('sha256'):
+                # a content addressed blob is shared by every image with the same bytes, the
+                # stripped copy is a blob of its own which the item moves to
+                new_sha256 = ContentStore.sha256_digest(stripped)
+                if ContentStore.acquire(new_sha256, item.get('contentType', '')):
+                    ContentStore.store(new_sha256, stripped, user_id, item.get('contentType', ''))
+                values.update({':s3Key': ContentStore.blob_s3_key(new_sha256), ':sha256': new_sha256,
+                               ':sizeBytes': len(stripped)})
+                assignments += ['s3Key = :s3Key', 'sha256 = :sha256', 'sizeBytes = :sizeBytes']
+            elif stripped != source:
+                AWSActions.put_object_in_to_bucket(BUCKET_NAME, item['s3Key'], stripped, user_id,
+                                                   item.get('contentType', ''))
+            for name, value in attributes.items():
+                names[f'#{name}'] = name
+                values[f':{name}'] = value
+                assignments.append(f'#{name} = :{name}')
+            AWSActions.update_item_in_table(key, 'SET ' + ', '.join(assignments) + ' REMOVE processingError',
+                                            values, names=names, condition=condition)
+            if new_sha256:
+                new_sha256 = None
+                if ContentStore.release(item['sha256']):
+                    AWSActions.delete_object_from_bucket(BUCKET_NAME, item['s3Key'])
+                if 'sizeBytes' in item:
+                    UsageAccounting.adjust(user_id, len(stripped) - int(item['sizeBytes']), 0)
+        except Exception as e:
+            if new_sha256 and ContentStore.release(new_sha256):
+                AWSActions.delete_object_from_bucket(BUCKET_NAME, ContentStore.blob_s3_key(new_sha256))
+            if Utils.client_error_code(e) == 'ConditionalCheckFailedException':
+                return 'skipped'
+            logger.error(f"Processing of {image_id} failed: {str(e)}")
+            try:
+                AWSActions.update_item_in_table(key, 'SET #status = :status, processingError = :error',
+                                                {':status': 'failed', ':error': str(e)[:1000]},
+                                                names=names, condition=condition)
+            except Exception as update_error:
+                if Utils.client_error_code(update_error) != 'ConditionalCheckFailedException':
+                    raise
+            raise
+        finally:
+            image_cache.invalidate(user_id, image_id)
+        return 'active'
+
+    @staticmethod
+    def process_batch(messages: list[dict[str, Any]],
+                      /) -> list[int]:
+        """Process a batch concurrently, duplicates once, returns the indexes of the messages that failed"""
+        indexes_by_image: dict[tuple[str, str], list[int]] = {}
+        for index, message in enumerate(messages):
+            indexes_by_image.setdefault((message['userId'], message['imageId']), []).append(index)
+
+        def process(image: tuple[str, str]) -> bool:
+            try:
+                ImageProcessing.process(*image)
+                return True
+            except Exception:
+                return False
+
+        failed_indexes = []
+        with ThreadPoolExecutor(max_workers=ProcessingSettings.max_workers) as executor:
+            for image, succeeded in zip(indexes_by_image, executor.map(process, indexes_by_image)):
+                if not succeeded:
+                    failed_indexes.extend(indexes_by_image[image])
+        return sorted(failed_indexes)
+
+    @staticmethod
+    def request(user_id: str,
+                image_id: str,
+                /) -> None:
+        """Queue the image on PROCESSING_QUEUE_URL, or on the in-process queue when it is not set"""
+        message = {'userId': user_id, 'imageId': image_id}
+        if ProcessingSettings.queue_url:
+            AWSActions.send_message_to_queue(ProcessingSettings.queue_url, message)
+        else:
+            processing_queue.send(message)
+        return None
+
+
+class LocalProcessingQueue:
+    """
+    In-process stand-in for the processing queue, for local runs and tests. Messages are
+    processed in batches on one background thread, or only when flush is called if background is off
+    """
+
+    def __init__(self,
+                 batch_size: int | None = None,
+                 /,
+                 *,
+                 background: bool = True):
+        self.batch_size = batch_size or ProcessingSettings.batch_size
+        self.background = background
+        self._lock = threading.Lock()
+        self._messages: list[dict[str, Any]] = []
+        self._executor: ThreadPoolExecutor | None = None
+
+    def send(self,
+             message: dict[str, Any],
+             /) -> None:
+        with self._lock:
+            self._messages.append(message)
+            if not self.background:
+                return None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-processing')
+        self._executor.submit(self.flush)
+        return None
+
+    def flush(self) -> int:
+        """Process every queued message in batches, returns how many failed"""
+        failed = 0
+        while True:
+            with self._lock:
+                batch, self._messages = self._messages[:self.batch_size], self._messages[self.batch_size:]
+            if not batch:
+                return failed
+            failed += len(ImageProcessing.process_batch(batch))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._messages)
+
+
+class Utils:
+
+    @staticmethod
+    def validate_image(content_type: str,
+                       size: int,
+                       /,
+                       *,
+                       allowed_types: list[str] | None = None,
+                       max_size: int | None = None) -> None:
+
+        if content_type not in (allowed_types or ImageRequirements.allowed_types):
+            raise ImageServiceError(f"Unsupported image type: {content_type}")
+
+        if size > (max_size or ImageRequirements.max_size):
+            raise ImageServiceError(f"Image size exceeds maximum allowed size")
+
+    @staticmethod
+    def event_header(event: dict[str, Any],
+                     name: str,
+                     /,
+                     default: str = '') -> str:
+        """Header lookup ignoring case, api gateway passes them as the client sent them"""
+        for header, value in (event.get('headers') or {}).items():
+            if header.lower() == name:
+                return value
+        return default
+
+    @staticmethod
+    def is_committed(item: dict[str, Any],
+                     /) -> bool:
+        """
+        False for an upload not finished yet or a delete under way, reads treat those as absent.
+        Items written before statusChangedAt existed used pending for what is now processing
+        """
+        if item.get('status') == 'pending':
+            return 'statusChangedAt' not in item
+        return item.get('status') not in ConsistencySettings.uncommitted_statuses
+
+    @staticmethod
+    def upload_image_id(user_id: str,
+                        idempotency_key: str,
+                        /) -> str:
+        """The same key of the same user always names the same image, so a retry finds the first attempt"""
+        return str(uuid.uuid5(ConsistencySettings.idempotency_namespace, f"{user_id}/{idempotency_key}"))
+
+    @staticmethod
+    def decoded_base64_length(encoded: str | bytes,
+                              /) -> int:
+        padding = encoded[-2:].count('=' if isinstance(encoded, str) else b'=')
+        return len(encoded) // 4 * 3 - padding
+
+    @staticmethod
+    def decode_base64(encoded: str | bytes,
+                      /) -> bytearray:
+        """
+        Decode into a buffer allocated once at its final size, a chunk at a time, so the only
+        copy of the image held next to the encoded text is the result itself
+        """
+        if len(encoded) % 4:
+            raise ImageServiceError("Image body is not valid base64")
+        buffer = bytearray(Utils.decoded_base64_length(encoded))
+        view = memoryview(buffer)
+        chunk_size = ImageRequirements.decode_chunk_size
+        position = 0
+        try:
+            for offset in range(0, len(encoded), chunk_size):
+                decoded = binascii.a2b_base64(encoded[offset:offset + chunk_size], strict_mode=True)
+                view[position:position + len(decoded)] = decoded
+                position += len(decoded)
+        except (binascii.Error, ValueError):
+            raise ImageServiceError("Image body is not valid base64")
+        if position != len(buffer):
+            raise ImageServiceError("Image body is not valid base64")
+        return buffer
+
+    @staticmethod
+    def validate_image_bytes(content_type: str,
+                             data: bytes | bytearray | memoryview,
+                             /) -> tuple[int, int]:
+        """
+        Check the decoded image itself before any network call: byte size, format sniffed from
+        the magic bytes against the declared content type and the pixel count read from the headers
+        returns (width, height)
+        """
+        view = memoryview(data)
+        Utils.validate_image(content_type, view.nbytes)
+        detected_type, width, height = ImageInspector.inspect(view)
+        if detected_type != content_type:
+            raise ImageServiceError(f"Image data is {detected_type}, not {content_type}")
+        if width * height > ImageRequirements.max_pixels:
+            raise ImageServiceError(f"Image dimensions {width}x{height} exceed maximum allowed pixels")
+        return width, height
+
+    @staticmethod
+    def process_metadata(metadata: str,
+                         /) -> dict[str, Any]:
+        """Process and validate metadata"""
+        try:
+            metadata = JsonCodec.loads(metadata)
+            if 'description' not in metadata:
+                raise ImageServiceError(f"Missing required metadata key: 'description'")
+
+            return metadata
+        except json.JSONDecodeError:
+            raise ImageServiceError("Invalid metadata format")
+
+    @staticmethod
+    def parse_event_body(event: dict[str, Any],
+                         /) -> dict[str, Any]:
+        """Decode the json body of an api gateway event"""
+        if not event.get('body'):
+            raise ImageServiceError("No body found in request")
+
+        body = event['body']
+        if event.get('isBase64Encoded', False):
+            body = b64decode(body)
+        try:
+            return JsonCodec.loads(body)
+        except json.JSONDecodeError:
+            raise ImageServiceError("Invalid request body")
+
+    @staticmethod
+    def build_image_item(image_id: str,
+                         user_id: str,
+                         file_extension: str,
+                         content_type: str,
+                         s3_key: str,
+                         metadata: dict[str, Any],
+                         /) -> dict[str, Any]:
+        created_at = datetime.now(timezone.utc).isoformat()
+        return {
+            'imageId': image_id,
+            'userId': user_id,
+            'fileName': f"{image_id}{file_extension}",
+            'contentType': content_type,
+            's3Key': s3_key,
+            'status': 'processing' if ProcessingSettings.enabled else 'active',
+            'statusChangedAt': created_at,
+            'description': metadata['description'],
+            'createdAt': created_at,
+            'variants': {},
+            **Utils.search_attributes(metadata)
+        }
+
+    @staticmethod
+    def search_attributes(metadata: dict[str, Any],
+                          /) -> dict[str, Any]:
+        """title, tags and the normalized title tokens SearchIndex indexes"""
+        attributes: dict[str, Any] = {}
+        if metadata.get('title'):
+            attributes['title'] = str(metadata['title'])
+            attributes['titleTokens'] = SearchIndex.tokenize(attributes['title'])
+        if metadata.get('tags'):
+            attributes['tags'] = SearchIndex.normalize_tags(metadata['tags'])
+        return attributes
+
+    @staticmethod
+    def run_async(coroutine: Coroutine[Any, Any, Any],
+                  /) -> Any:
+        """Run a coroutine from the synchronous handlers, asyncio is imported here to keep it off cold starts"""
+        import asyncio
+        return asyncio.run(coroutine)
+
+    @staticmethod
+    def file_extension_for(content_type: str,
+                           /) -> str:
+        """Known image types skip mimetypes, whose first lookup reads the system mime tables"""
+        if content_type in ImageRequirements.file_extensions:
+            return ImageRequirements.file_extensions[content_type]
+        import mimetypes
+        return mimetypes.guess_extension(content_type) or '.bin'
+
+    @staticmethod
+    def client_error_code(error: Exception,
+                          /) -> str | None:
+        """Error code of a botocore ClientError, None for anything else"""
+        response = getattr(error, 'response', None)
+        if not isinstance(response, dict):
+            return None
+        return response.get('Error', {}).get('Code')
+
+    @staticmethod
+    def upload_variant_names() -> list[str]:
+        return [ImageVariants.variant_name(size, image_format)
+                for size in VariantSettings.sizes
+                for image_format in VariantSettings.upload_formats]
+
+    @staticmethod
+    def chunked(values: list[Any],
+                size: int,
+                /) -> list[list[Any]]:
+        return [values[index:index + size] for index in range(0, len(values), size)]
+
+    @staticmethod
+    def parse_image_ids(body: dict[str, Any],
+                        /) -> list[str]:
+        """Read the imageIds list of a batch request, dropping duplicates but keeping order"""
+        image_ids = body.get('imageIds')
+        if not isinstance(image_ids, list) or not image_ids:
+            raise ImageServiceError("imageIds must be a non empty list")
+        if not all(isinstance(image_id, str) and image_id for image_id in image_ids):
+            raise ImageServiceError("imageIds must only contain strings")
+
+        image_ids = list(dict.fromkeys(image_ids))
+        if len(image_ids) > BatchSettings.max_ids_per_request:
+            raise ImageServiceError(f"At most {BatchSettings.max_ids_per_request} imageIds per request")
+        return image_ids
+
+    @staticmethod
+    def parse_upload_parts(parts: Any,
+                           /) -> list[dict[str, Any]]:
+        """
+        Read the parts of a multipart completion, in the partNumber and etag shape the part urls
+        are handed out with, and turn them in to the PartNumber and ETag shape s3 expects
+        """
+        if not isinstance(parts, list) or not parts:
+            raise ImageServiceError("parts must be a non empty list")
+        upload_parts = []
+        for part in parts:
+            if not isinstance(part, dict):
+                raise ImageServiceError("parts must only contain objects with partNumber and etag")
+            part_number, etag = part.get('partNumber'), part.get('etag')
+            if (not isinstance(part_number, int) or isinstance(part_number, bool)
+                    or not 1 <= part_number <= MultipartSettings.max_parts):
+                raise ImageServiceError(f"partNumber must be an integer from 1 to {MultipartSettings.max_parts}")
+            if not isinstance(etag, str) or not etag:
+                raise ImageServiceError("etag must be a non empty string")
+            if upload_parts and part_number <= upload_parts[-1]['PartNumber']:
+                raise ImageServiceError("parts must be in ascending partNumber order")
+            upload_parts.append({'PartNumber': part_number, 'ETag': etag})
+        return upload_parts
+
+    @staticmethod
+    def encode_next_token(last_evaluated_key: dict[str, Any] | None,
+                          /) -> str | None:
+        """Turn a LastEvaluatedKey in to an opaque cursor for the client"""
+        if not last_evaluated_key:
+            return None
+        raw_token = JsonCodec.dumps(last_evaluated_key)
+        return urlsafe_b64encode(raw_token.encode()).decode()
+
+    @staticmethod
+    def decode_next_token(next_token: str,
+                          user_id: str,
+                          /) -> dict[str, Any]:
+        """Turn a client cursor back in to an ExclusiveStartKey owned by the user"""
+        try:
+            last_evaluated_key = JsonCodec.loads(urlsafe_b64decode(next_token.encode()))
+        except (ValueError, UnicodeDecodeError):
+            raise ImageServiceError("Invalid nextToken")
+
+        if not isinstance(last_evaluated_key, dict) or last_evaluated_key.get('userId') != user_id:
+            raise ImageServiceError("Invalid nextToken")
+
+        return last_evaluated_key
+
+    @staticmethod
+    def parse_limit(limit: str | None,
+                    /) -> int:
+        if limit is None:
+            return ListingRequirements.default_limit
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ImageServiceError(f"Invalid limit: {limit}")
+
+        if not 1 <= limit <= ListingRequirements.max_limit:
+            raise ImageServiceError(f"limit must be between 1 and {ListingRequirements.max_limit}")
+        return limit
+
+    @staticmethod
+    def create_response(status_code: int,
+                        body: dict[str, Any],
+                        /,
+                        *,
+                        base_64_encoded: bool = False,
+                        headers: dict[str, str] | None = None,
+                        cache_control: str | None = None,
+                        if_none_match: str | None = None,
+                        etag_of: Any = None,
+                        stream_key: str | None = None,
+                        error: Exception | None = None
+                        ) -> dict[str, Any]:
+
+        """
+        Creating the response structure for the apis
+        with cache_control a 200 also carries an ETag of the body, or of etag_of when the body holds
+        values such as presigned urls which change while the resource does not, and is answered with
+        an empty 304 when if_none_match already names that ETag. A body whose stream_key list is longer than
+        JsonSettings.stream_threshold is encoded in batches with JsonCodec.iter_dumps.
+        error is the exception the handler caught, when aws throttled, was unavailable or timed out
+        the response is a 503 (504 for timeouts) with Retry-After so clients back off rather than
+        retrying a 500 right away
+        """
+        retry_status = Resilience.response_status(error) if error is not None else None
+        if retry_status is not None:
+            status_code, retry_after = retry_status
+            body = {"message": "Timed out waiting for storage, retry later" if status_code == 504
+                    else "Service temporarily unavailable, retry later"}
+            headers = {**(headers or {}), 'Retry-After': str(max(1, math.ceil(retry_after)))}
+        if stream_key and len(body.get(stream_key) or []) > JsonSettings.stream_threshold:
+            serialized_body = ''.join(JsonCodec.iter_dumps(body, stream_key))
+        else:
+            serialized_body = JsonCodec.dumps(body)
+        if cache_control and status_code == 200:
+            tagged = serialized_body if etag_of is None else JsonCodec.dumps(etag_of)
+            etag = f'"{hashlib.sha256(tagged.encode()).hexdigest()[:32]}"'
+            headers = {**(headers or {}), 'ETag': etag, 'Cache-Control': cache_control}
+            if if_none_match and Utils.etag_matches(if_none_match, etag):
+                status_code, serialized_body = 304, ''
+
+        return {
+            'statusCode': status_code,
+            'headers': {**ResponseHeaders.headers, **headers} if headers else ResponseHeaders.headers,
+            'body': serialized_body,
+            "isBase64Encoded": base_64_encoded
+
+        }
+
+    @staticmethod
+    def etag_matches(if_none_match: str,
+                     etag: str,
+                     /) -> bool:
+        """Weak comparison as If-None-Match asks for, against a list of tags or *"""
+        if if_none_match.strip() == '*':
+            return True
+        return any(candidate.strip().removeprefix('W/') == etag for candidate in if_none_match.split(','))
+
+    @staticmethod
+    def image_version(metadata: dict[str, Any],
+                      variant: str,
+                      /) -> dict[str, Any]:
+        """
+        What the ETag of get_image is taken from in place of its body: the item fields which change
+        with the image, and the window of the presigned url so a 304 never keeps an expired url
+        """
+        return {'imageId': metadata.get('imageId'),
+                'variant': variant,
+                's3Key': (metadata.get('variants') or {}).get(variant, metadata.get('s3Key')),
+                'sha256': metadata.get('sha256'),
+                'statusChangedAt': metadata.get('statusChangedAt'),
+                'processedAt': metadata.get('processedAt'),
+                'urlWindow': int(time.time() // CacheSettings.url_expiry_margin)}
+
+    @staticmethod
+    def cache_options(event: dict[str, Any],
+                      handler_name: str,
+                      /) -> dict[str, str | None]:
+        """create_response keywords for a cacheable read route"""
+        return {'cache_control': Routes.cache_control.get(handler_name),
+                'if_none_match': Utils.event_header(event, 'if-none-match') or None}
+
+
+logger = logging.getLogger()
+StructuredLogging.configure(logger)
+BUCKET_NAME = os.environ.get('BUCKET_NAME', 'imagehost')
+image_cache = ImageCache(max_entries=CacheSettings.max_entries, ttl=CacheSettings.ttl)
+processing_queue = LocalProcessingQueue()
+access_tracker = AccessTracker(sample_rate=TieringSettings.access_sample_rate,
+                               resolution=TieringSettings.access_resolution,
+                               flush_size=TieringSettings.access_flush_size,
+                               flush_interval=TieringSettings.access_flush_interval)
+
+
+class ImageServiceHandler:
+    def __init__(self):
+        pass
+
+    def upload_image(self,
+                     event: dict[str, Any],
+                     /) -> dict[str, Any]:
+        """
+        Uploading the image in to the s3 bucket and saving the same data in to the table
+        @event: it is dict which contains the details about the lambda handler event
+        """
+        try:
+            user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
+                                                                                                 'default-user-id')
+            content_type, metadata, image_body, width, height = self.fetch_upload_from_event(event)
+            idempotency_key = Utils.event_header(event, 'idempotency-key')
+            image_id = Utils.upload_image_id(user_id, idempotency_key) if idempotency_key else str(uuid.uuid4())
+            file_extension = Utils.file_extension_for(content_type)
+            size = len(image_body)
+            UsageAccounting.check_quota(user_id, size)
+
+            sha256 = ContentStore.sha256_digest(image_body)
+            s3_key = ContentStore.blob_s3_key(sha256)
+            item = Utils.build_image_item(image_id, user_id, file_extension, content_type, s3_key, metadata)
+            item.update(sha256=sha256, width=width, height=height, sizeBytes=size)
+            committed_status = item['status']
+            item['status'] = 'pending'
+
+            completed = self.begin_upload(item)
+            if completed is not None:
+                return Utils.create_response(200, {'imageId': image_id, 'metadata': completed})
+
+            blob_acquired = False
+            try:
+                store_blob = ContentStore.acquire(sha256, content_type)
+                blob_acquired = True
+            except Exception:
+                self.abandon_upload(item, blob_acquired)
+                raise
+            legs: list[tuple[Awaitable[Any], Callable[[], Awaitable[Any]] | None]] = []
+            if SearchIndex.item_terms(item):
+                legs.append((AsyncAWSActions.run(SearchIndex.add, [item]),
+                             lambda: AsyncAWSActions.run(SearchIndex.remove, [item])))
+            if UsageSettings.enabled:
+                legs.append((AsyncAWSActions.run(UsageAccounting.adjust, user_id, size, 1),
+                             lambda: AsyncAWSActions.run(UsageAccounting.adjust, user_id, -size, -1)))
+            if store_blob:
+                legs.append((AsyncAWSActions.run(ContentStore.store,
+                                                 sha256,
+                                                 image_body,
+                                                 user_id,
+                                                 content_type), None))
+            try:
+                Utils.run_async(AsyncAWSActions.gather_with_rollback(*legs))
+            except Exception:
+                self.abandon_upload(item, blob_acquired)
+                raise
+            item.update(self.commit_upload(item, committed_status))
+            image_cache.invalidate(user_id, image_id)
+            if ProcessingSettings.enabled:
+                ImageProcessing.request(user_id, image_id)
+            if VariantSettings.generate_on_upload:
+                ImageVariants.request(user_id, image_id, Utils.upload_variant_names())
+
+            return Utils.create_response(200, {
+                'imageId': image_id,
+                'metadata': item
+            })
+
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"}, error=e)
+
+    def begin_upload(self,
+                     item: dict[str, Any],
+                     /) -> dict[str, Any] | None:
+        """
+        Write the pending item ahead of everything else the upload stores, so a crash leaves a
+        trace ReconciliationJob can roll back. When the image id exists already this is a retry
+        with the same Idempotency-Key: the item of a finished upload is returned for the replay,
+        an abandoned pending one is taken over, None means the caller goes on with the upload
+        """
+        key = {'imageId': item['imageId'], 'userId': item['userId']}
+        try:
+            AWSActions.put_item_in_to_dynamo_table(item, condition='attribute_not_exists(imageId)')
+            return None
+        except Exception as e:
+            if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                raise
+
+        existing = AWSActions.get_item_from_table(key, consistent=True).get('Item')
+        if existing is None or existing.get('status') == 'deleting':
+            raise ImageServiceError("The image of this Idempotency-Key is being deleted", 409)
+        if existing.get('sha256') != item['sha256']:
+            raise ImageServiceError("Idempotency-Key was already used for a different image", 422)
+        if existing.get('status') != 'pending':
+            return existing
+
+        pending_for = datetime.now(timezone.utc) - datetime.fromisoformat(existing['statusChangedAt'])
+        if pending_for.total_seconds() < ConsistencySettings.pending_timeout:
+            raise ImageServiceError("An upload with this Idempotency-Key is in progress", 409)
+        try:
+            AWSActions.update_item_in_table(key, 'SET statusChangedAt = :now',
+                                            {':now': item['statusChangedAt'], ':pending': 'pending',
+                                             ':seen': existing['statusChangedAt']},
+                                            names={'#status': 'status'},
+                                            condition='#status = :pending AND statusChangedAt = :seen')
+        except Exception as e:
+            if Utils.client_error_code(e) == 'ConditionalCheckFailedException':
+                raise ImageServiceError("An upload with this Idempotency-Key is in progress", 409)
+            raise
+        return None
+
+    def commit_upload(self,
+                      item: dict[str, Any],
+                      status: str,
+                      /) -> dict[str, str]:
+        """Flip the pending item to its final status once the object and index entries are stored"""
+        changes = {'status': status, 'statusChangedAt': datetime.now(timezone.utc).isoformat()}
+        AWSActions.update_item_in_table({'imageId': item['imageId'], 'userId': item['userId']},
+                                        'SET #status = :status, statusChangedAt = :statusChangedAt',
+                                        {':status': status, ':statusChangedAt': changes['statusChangedAt'],
+                                         ':pending': 'pending'},
+                                        names={'#status': 'status'},
+                                        condition='#status = :pending')
+        return changes
 
-class ImageRequirements:
-    allowed_types = ['image/jpeg', 'image/png', 'image/gif']
-    max_size = 5 * 1024 * 1024
+    def abandon_upload(self,
+                       item: dict[str, Any],
+                       blob_acquired: bool,
+                       /) -> None:
+        """Undo a failed upload, whatever cannot be undone now stays pending for ReconciliationJob"""
+        try:
+            if blob_acquired and ContentStore.release(item['sha256']):
+                AWSActions.delete_object_from_bucket(BUCKET_NAME, item['s3Key'])
+            AWSActions.delete_an_item_from_table({'imageId': item['imageId'], 'userId': item['userId']})
+        except Exception as e:
+            logger.error(f"Upload of {item['imageId']} left pending: {str(e)}")
+        return None
 
+    def fetch_upload_from_event(self,
+                                event: dict[str, Any],
+                                /) -> tuple[str, dict[str, Any], bytearray, int, int]:
+        """
+        Read and validate the image of an upload request, returns (content_type, metadata, image, width, height)
+        A raw binary body (api gateway binary media type, isBase64Encoded) with the metadata in the
+        x-image-metadata header is decoded straight into the image buffer, the local http server
+        hands it over undecoded as a bytearray. The older json envelope
+        ({"body": <base64>, "headers": {...}}) is still accepted but costs a copy of the envelope
+        """
+        if not event.get('body'):
+            raise ImageServiceError("No body found in request")
 
-class AWSUtils:
-    s3_presigned_url_timeout = 3600
-    ENDPOINT_URL = "http://localhost.localstack.cloud:4566"
+        if Utils.event_header(event, 'content-type').startswith('image/'):
+            if isinstance(event['body'], bytearray):
+                content_type = Utils.event_header(event, 'content-type').split(';')[0].strip()
+                metadata = Utils.process_metadata(Utils.event_header(event, 'x-image-metadata', '{}'))
+                Utils.validate_image(content_type, len(event['body']))
+                width, height = Utils.validate_image_bytes(content_type, event['body'])
+                return content_type, metadata, event['body'], width, height
+            if not event.get('isBase64Encoded', False):
+                raise ImageServiceError("Binary image bodies must be base64 encoded by the gateway")
+            content_type = Utils.event_header(event, 'content-type').split(';')[0].strip()
+            metadata_header = Utils.event_header(event, 'x-image-metadata', '{}')
+            encoded_body = event['body']
+        else:
+            body = Utils.parse_event_body(event)
+            content_type = body.get('headers', {}).get('content-type', '')
+            metadata_header = body.get('headers', {}).get('x-image-metadata', '{}')
+            encoded_body = body.get('body') or ''
 
+        metadata = Utils.process_metadata(metadata_header)
+        Utils.validate_image(content_type, Utils.decoded_base64_length(encoded_body))
+        image_body = Utils.decode_base64(encoded_body)
+        width, height = Utils.validate_image_bytes(content_type, image_body)
+        return content_type, metadata, image_body, width, height
 
-class ResponseHeaders:
-    headers = {
-        'Content-Type': 'application/json',
-        'Access-Control-Allow-Origin': '*'
-    }
-    message = "Action performed Successfully"
+    def prepare_direct_upload(self,
+                              event: dict[str, Any],
+                              body: dict[str, Any],
+                              /,
+                              *,
+                              allowed_types: list[str] | None = None,
+                              max_size: int | None = None) -> tuple[str, str, str, int, dict[str, str]]:
+        """Validate a direct upload request and mint the image id, s3 key and object metadata"""
+        content_type = body.get('contentType', '')
+        try:
+            content_length = int(body.get('contentLength', 0))
+        except (TypeError, ValueError):
+            raise ImageServiceError("Invalid contentLength")
 
+        user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
+                                                                                             'default-user-id')
+        metadata = body.get('metadata', {})
+        if not isinstance(metadata, dict):
+            raise ImageServiceError("Invalid metadata format")
+        metadata = Utils.process_metadata(json.dumps(metadata))
+        if content_length <= 0:
+            raise ImageServiceError("contentLength is required")
+        Utils.validate_image(content_type, content_length, allowed_types=allowed_types, max_size=max_size)
+        UsageAccounting.check_quota(user_id, content_length)
 
-class ImageServiceError(Exception):
-    """Custom exception for image service errors"""
+        image_id = str(uuid.uuid4())
+        file_extension = Utils.file_extension_for(content_type)
+        s3_key = f"images/{user_id}/{image_id}{file_extension}"
+        object_metadata = {
+            'userid': user_id,
+            'imageid': image_id,
+            'metadata': quote(json.dumps(metadata, separators=(',', ':')))
+        }
+        return image_id, s3_key, content_type, content_length, object_metadata
 
-    def __init__(self, message: str, status_code: int = 400):
-        super().__init__(message)
-        self.status_code = status_code
+    def create_upload_url(self,
+                          event: dict[str, Any],
+                          /) -> dict[str, Any]:
+        """
+        First phase of a direct upload, validates the metadata and hands out a presigned
+        POST (or PUT) so the image bytes go straight to s3 instead of through the lambda
+        @event: it is dict which contains the details about the lambda handler event
+        """
+        try:
+            body = Utils.parse_event_body(event)
+            upload_method = body.get('method', 'POST').upper()
+            if upload_method not in ('POST', 'PUT'):
+                raise ImageServiceError(f"Unsupported upload method: {upload_method}")
 
+            image_id, s3_key, content_type, content_length, object_metadata = self.prepare_direct_upload(event, body)
 
-class Utils:
+            upload_details: dict[str, Any] = {'method': upload_method}
+            if upload_method == 'POST':
+                fields = {'Content-Type': content_type,
+                          **{f'x-amz-meta-{name}': value for name, value in object_metadata.items()}}
+                conditions = [{name: value} for name, value in fields.items()]
+                conditions.append(['content-length-range', 1, ImageRequirements.max_size])
+                presigned_post = AWSActions.generate_presigned_post_for_object(
+                    BUCKET_NAME,
+                    s3_key,
+                    fields=fields,
+                    conditions=conditions,
+                    expires_in=AWSUtils.s3_presigned_upload_timeout
+                )
+                upload_details.update(url=presigned_post['url'], fields=presigned_post['fields'])
+            else:
+                upload_details['url'] = AWSActions.generate_presigned_url_for_object(
+                    BUCKET_NAME,
+                    s3_key,
+                    action_name='put_object',
+                    extra_params={'ContentType': content_type,
+                                  'ContentLength': content_length,
+                                  'Metadata': object_metadata},
+                    expires_in=AWSUtils.s3_presigned_upload_timeout
+                )
+                upload_details['headers'] = {
+                    'Content-Type': content_type,
+                    **{f'x-amz-meta-{name}': value for name, value in object_metadata.items()}
+                }
 
-    @staticmethod
-    def validate_image(content_type: str,
-                       size: int,
-                       /) -> None:
+            return Utils.create_response(200, {
+                'imageId': image_id,
+                's3Key': s3_key,
+                'upload': upload_details,
+                'expiresIn': AWSUtils.s3_presigned_upload_timeout
+            })
 
-        if content_type not in ImageRequirements.allowed_types:
-            raise ImageServiceError(f"Unsupported image type: {content_type}")
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"}, error=e)
 
-        if size > ImageRequirements.max_size:
-            raise ImageServiceError(f"Image size exceeds maximum allowed size")
+    def register_uploaded_object(self,
+                                 s3_key: str,
+                                 /) -> dict[str, Any]:
+        """
+        Second phase of a direct upload, writes the table item for an object that was
+        put in to the bucket with the metadata issued by create_upload_url
+        """
+        return self.store_uploaded_item(self.uploaded_object_item(s3_key))
 
-    @staticmethod
-    def process_metadata(metadata: str,
-                         /) -> dict[str, Any]:
-        """Process and validate metadata"""
+    def uploaded_object_item(self,
+                             s3_key: str,
+                             /) -> dict[str, Any]:
+        """
+        Validate a directly uploaded object and build its item, nothing is written yet so an
+        ImageServiceError here means the object was never a valid upload
+        """
         try:
-            metadata = json.loads(metadata)
-            if 'description' not in metadata:
-                raise ImageServiceError(f"Missing required metadata key: 'description'")
+            head = AWSActions.head_object_in_bucket(BUCKET_NAME, s3_key)
+        except Exception as e:
+            if Utils.client_error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+                raise ImageServiceError("Uploaded object not found", 404)
+            raise
 
-            return metadata
-        except json.JSONDecodeError:
-            raise ImageServiceError("Invalid metadata format")
+        object_metadata = head.get('Metadata', {})
+        user_id = object_metadata.get('userid')
+        image_id = object_metadata.get('imageid')
+        if not user_id or not image_id or s3_key != f"images/{user_id}/{image_id}{os.path.splitext(s3_key)[1]}":
+            raise ImageServiceError(f"Object was not issued by the upload-url endpoint: {s3_key}")
 
-    @staticmethod
-    def create_response(status_code: int,
-                        body: dict[str, Any],
-                        /,
-                        *,
-                        base_64_encoded: bool = False
-                        ) -> dict[str, Any]:
+        content_type = head.get('ContentType', '')
+        if object_metadata.get('uploadmode') == 'multipart':
+            Utils.validate_image(content_type, head.get('ContentLength', 0),
+                                 allowed_types=MultipartSettings.allowed_types,
+                                 max_size=MultipartSettings.max_size)
+        else:
+            Utils.validate_image(content_type, head.get('ContentLength', 0))
+        metadata = Utils.process_metadata(unquote(object_metadata.get('metadata', '{}')))
+        file_extension = os.path.splitext(s3_key)[1]
 
-        """Creating the response structure for the apis"""
-        return {
-            'statusCode': status_code,
-            'headers': ResponseHeaders.headers,
-            'body': json.dumps(body, default=str),
-            "isBase64Encoded": base_64_encoded
+        item = Utils.build_image_item(image_id, user_id, file_extension, content_type, s3_key, metadata)
+        item['sizeBytes'] = head.get('ContentLength', 0)
+        return item
 
-        }
+    def store_uploaded_item(self,
+                            item: dict[str, Any],
+                            /) -> dict[str, Any]:
+        """
+        Write the item pending, index it, then commit it together with its usage. The s3 event
+        and the client's complete call both register, and so may ReconciliationJob: whichever
+        comes second finds the item and re-drives the steps a failed attempt did not finish
+        """
+        user_id, image_id = item['userId'], item['imageId']
+        key = {'imageId': image_id, 'userId': user_id}
+        committed_status = item['status']
+        item['status'] = 'pending'
+        try:
+            AWSActions.put_item_in_to_dynamo_table(item, condition='attribute_not_exists(imageId)')
+        except Exception as e:
+            if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                raise
+            existing = AWSActions.get_item_from_table(key, consistent=True).get('Item')
+            if existing is None or existing.get('status') != 'pending' or Utils.is_committed(existing):
+                return existing or item
+            item = existing
+        SearchIndex.add([item])
+        if not self.commit_uploaded_item(item, committed_status):
+            return AWSActions.get_item_from_table(key, consistent=True).get('Item', item)
+        image_cache.invalidate(user_id, image_id)
+        if ProcessingSettings.enabled:
+            ImageProcessing.request(user_id, image_id)
+        if VariantSettings.generate_on_upload:
+            ImageVariants.request(user_id, image_id, Utils.upload_variant_names())
+        return item
 
+    def commit_uploaded_item(self,
+                             item: dict[str, Any],
+                             status: str,
+                             /) -> bool:
+        """
+        Flip the pending item to status and add its usage in one transaction, so a re-driven
+        registration counts the image once, False when another attempt committed it first
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        actions: list[dict[str, Any]] = [{'Update': {
+            'TableName': AWSActions.get_dynamodb_table().name,
+            'Key': {'imageId': item['imageId'], 'userId': item['userId']},
+            'UpdateExpression': 'SET #status = :status, statusChangedAt = :now',
+            'ConditionExpression': '#status = :pending',
+            'ExpressionAttributeNames': {'#status': 'status'},
+            'ExpressionAttributeValues': {':status': status, ':now': now, ':pending': 'pending'}
+        }}]
+        if UsageSettings.enabled:
+            actions.append({'Update': {
+                'TableName': AWSActions.get_usage_table().name,
+                'Key': {'userId': item['userId']},
+                'UpdateExpression': 'ADD totalBytes :bytes, imageCount :images SET changedAt = :changedAt',
+                'ExpressionAttributeValues': {':bytes': int(item.get('sizeBytes') or 0), ':images': 1,
+                                              ':changedAt': now}
+            }})
+        try:
+            AWSActions.transact_write_items(actions)
+        except Exception as e:
+            reasons = getattr(e, 'response', {}).get('CancellationReasons', [])
+            if any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons):
+                return False
+            raise
+        item.update(status=status, statusChangedAt=now)
+        return True
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-BUCKET_NAME = os.environ.get('BUCKET_NAME', 'imagehost')
+    def complete_upload(self,
+                        event: dict[str, Any],
+                        /) -> dict[str, Any]:
+        """Client driven completion of a direct upload"""
+        try:
+            image_id = event['pathParameters']['imageId']
+            user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
+                                                                                                 'default-user-id')
+            s3_key = Utils.parse_event_body(event).get('s3Key', '')
+            if not s3_key.startswith(f"images/{user_id}/{image_id}"):
+                raise ImageServiceError("s3Key does not belong to this image", 403)
 
+            item = self.register_uploaded_object(s3_key)
+            return Utils.create_response(200, {
+                'imageId': image_id,
+                'metadata': item
+            })
 
-class ImageServiceHandler:
-    def __init__(self):
-        pass
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"}, error=e)
 
-    def upload_image(self,
-                     event: dict[str, Any],
-                     /) -> dict[str, Any]:
+    def presign_upload_parts(self,
+                             s3_key: str,
+                             upload_id: str,
+                             part_numbers: Iterable[int],
+                             /) -> list[dict[str, Any]]:
+        return [{'partNumber': part_number,
+                 'url': AWSActions.generate_presigned_url_for_object(
+                     BUCKET_NAME,
+                     s3_key,
+                     action_name='upload_part',
+                     extra_params={'UploadId': upload_id, 'PartNumber': part_number},
+                     expires_in=AWSUtils.s3_presigned_upload_timeout)}
+                for part_number in part_numbers]
+
+    def fetch_multipart_upload_from_event(self,
+                                          event: dict[str, Any],
+                                          /) -> tuple[str, str, str]:
+        """Read s3Key and uploadId for a multipart call and check they belong to the caller"""
+        image_id = event['pathParameters']['imageId']
+        user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
+                                                                                             'default-user-id')
+        if event.get('httpMethod') in ('GET', 'DELETE'):
+            params = event.get('queryStringParameters', {}) or {}
+        else:
+            params = Utils.parse_event_body(event)
+
+        s3_key, upload_id = params.get('s3Key', ''), params.get('uploadId', '')
+        if not upload_id:
+            raise ImageServiceError("uploadId is required")
+        if not s3_key.startswith(f"images/{user_id}/{image_id}"):
+            raise ImageServiceError("s3Key does not belong to this image", 403)
+        return image_id, s3_key, upload_id
+
+    def create_multipart_upload(self,
+                                event: dict[str, Any],
+                                /) -> dict[str, Any]:
         """
-        Uploading the image in to the s3 bucket and saving the same data in to the table
+        Start a multipart upload for large images and hand out one presigned url per part
         @event: it is dict which contains the details about the lambda handler event
         """
         try:
-            if 'body' not in event:
-                raise ImageServiceError("No body found in request")
+            body = Utils.parse_event_body(event)
+            image_id, s3_key, content_type, content_length, object_metadata = self.prepare_direct_upload(
+                event,
+                body,
+                allowed_types=MultipartSettings.allowed_types,
+                max_size=MultipartSettings.max_size
+            )
+            object_metadata['uploadmode'] = 'multipart'
+            try:
+                part_size = MultipartSettings.part_size_for(content_length,
+                                                            part_size=int(body.get('partSize', 0)) or None)
+            except (TypeError, ValueError):
+                raise ImageServiceError("Invalid partSize")
+            part_count = -(-content_length // part_size)
+
+            upload_id = AWSActions.create_multipart_upload(BUCKET_NAME, s3_key, content_type, object_metadata)
 
-            body = event['body']
-            if event.get('isBase64Encoded', False):
-                body = b64decode(body)
+            return Utils.create_response(200, {
+                'imageId': image_id,
+                's3Key': s3_key,
+                'uploadId': upload_id,
+                'partSize': part_size,
+                'parts': self.presign_upload_parts(s3_key, upload_id, range(1, part_count + 1)),
+                'expiresIn': AWSUtils.s3_presigned_upload_timeout
+            })
 
-            body = json.loads(body)
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"}, error=e)
 
-            content_type = body.get('headers', {}).get('content-type', '')
-            user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
-                                                                                                 'default-user-id')
-            metadata = Utils.process_metadata(body.get('headers', {}).get('x-image-metadata', '{}'))
-            image_id = str(uuid.uuid4())
-            file_extension = mimetypes.guess_extension(content_type) or '.bin'
-            s3_key = f"images/{user_id}/{image_id}{file_extension}"
-            Utils.validate_image(content_type, len(body))
+    def get_multipart_upload(self,
+                             event: dict[str, Any],
+                             /) -> dict[str, Any]:
+        """Report the parts already in s3 so a client can resume, re-signing the missing ones"""
+        try:
+            image_id, s3_key, upload_id = self.fetch_multipart_upload_from_event(event)
+            query_params = event.get('queryStringParameters', {}) or {}
+            uploaded_parts = AWSActions.list_uploaded_parts(BUCKET_NAME, s3_key, upload_id)
 
-            AWSActions.put_object_in_to_bucket(BUCKET_NAME,
-                                               s3_key,
-                                               body.get('body'),
-                                               user_id,
-                                               content_type)
+            try:
+                part_count = int(query_params.get('partCount', 0))
+            except ValueError:
+                raise ImageServiceError("Invalid partCount")
+            uploaded_numbers = {part['PartNumber'] for part in uploaded_parts}
+            missing_parts = [part_number for part_number in range(1, part_count + 1)
+                             if part_number not in uploaded_numbers]
 
-            item = {
+            return Utils.create_response(200, {
                 'imageId': image_id,
-                'userId': user_id,
-                'fileName': f"{image_id}{file_extension}",
-                'contentType': content_type,
-                's3Key': s3_key,
-                'status': 'active',
-                'description': metadata['description']
-            }
+                'uploadId': upload_id,
+                'uploadedParts': uploaded_parts,
+                'parts': self.presign_upload_parts(s3_key, upload_id, missing_parts)
+            })
+
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"}, error=e)
 
-            AWSActions.put_item_in_to_dynamo_table(item)
+    def complete_multipart_upload(self,
+                                  event: dict[str, Any],
+                                  /) -> dict[str, Any]:
+        """Stitch the uploaded parts together and register the image"""
+        try:
+            image_id, s3_key, upload_id = self.fetch_multipart_upload_from_event(event)
+            body = Utils.parse_event_body(event)
+            if 'parts' in body:
+                parts = Utils.parse_upload_parts(body['parts'])
+            else:
+                parts = AWSActions.list_uploaded_parts(BUCKET_NAME, s3_key, upload_id)
+            if not parts:
+                raise ImageServiceError("No parts uploaded")
 
+            AWSActions.complete_multipart_upload(BUCKET_NAME, s3_key, upload_id, parts)
+            item = self.register_uploaded_object(s3_key)
             return Utils.create_response(200, {
                 'imageId': image_id,
                 'metadata': item
@@ -232,7 +4036,26 @@ class ImageServiceHandler:
             return Utils.create_response(e.status_code, {"message": str(e)})
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
-            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"})
+            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"}, error=e)
+
+    def abort_multipart_upload(self,
+                               event: dict[str, Any],
+                               /) -> dict[str, Any]:
+        """Abort an incomplete multipart upload so its parts stop being billed"""
+        try:
+            image_id, s3_key, upload_id = self.fetch_multipart_upload_from_event(event)
+            AWSActions.abort_multipart_upload(BUCKET_NAME, s3_key, upload_id)
+            return Utils.create_response(200, {
+                'message': 'Upload aborted successfully',
+                'imageId': image_id
+            })
+
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal Server Error::{str(e)}"}, error=e)
 
     def fetch_s3_key_from_event_dict(self,
                                      event: dict[str, Any],
@@ -246,7 +4069,8 @@ class ImageServiceHandler:
             key_to_check_in_table
         )
 
-        if 'Item' not in response:
+        if 'Item' not in response or (response['Item'].get('status') == 'pending'
+                                      and not Utils.is_committed(response['Item'])):
             raise ImageServiceError("Image not found", 404)
 
         s3_key = response['Item']['s3Key']
@@ -254,25 +4078,107 @@ class ImageServiceHandler:
 
         return key_to_check_in_table, metadata, s3_key
 
+    def batch_get_images(self,
+                         event: dict[str, Any],
+                         /) -> dict[str, Any]:
+        """
+        Get details and download urls for many images with batch_get_item, the table key
+        carries the userId so like fetch_s3_key_from_event_dict only the caller's images are found
+        @event: it is dict which contains the details about the lambda handler event
+        """
+        try:
+            user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
+                                                                                                 'default-user-id')
+            image_ids = Utils.parse_image_ids(Utils.parse_event_body(event))
+            items, unprocessed_keys = AWSActions.batch_get_items_from_table(
+                [{'imageId': image_id, 'userId': user_id} for image_id in image_ids]
+            )
+
+            items_by_id = {item['imageId']: item for item in items if Utils.is_committed(item)}
+            presigned_urls = AWSActions.generate_presigned_urls_for_objects(
+                BUCKET_NAME,
+                [item['s3Key'] for item in items_by_id.values()]
+            )
+            unprocessed_ids = {key['imageId'] for key in unprocessed_keys}
+
+            images = [{'imageId': image_id,
+                       'downloadUrl': presigned_urls[items_by_id[image_id]['s3Key']],
+                       'metadata': items_by_id[image_id]}
+                      for image_id in image_ids if image_id in items_by_id]
+            return Utils.create_response(200, {
+                'images': images,
+                'count': len(images),
+                'notFound': [image_id for image_id in image_ids
+                             if image_id not in items_by_id and image_id not in unprocessed_ids],
+                'unprocessed': [image_id for image_id in image_ids if image_id in unprocessed_ids]
+            })
+
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Error retrieving images: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal server error::{str(e)}"}, error=e)
+
     def get_image(self,
                   event: dict[str, Any]) -> dict[str, Any]:
-        """Get image details and generate download URL"""
+        """
+        Get image details and generate download URL
+        the optional size (and format) query params return the url of a resized variant,
+        a variant which does not exist yet is generated in the background and the original is returned
+        """
+        query_params = event.get('queryStringParameters', {}) or {}
+        variant = 'original'
+        if query_params.get('size', 'original') != 'original':
+            try:
+                variant = ImageVariants.variant_name(query_params['size'],
+                                                     query_params.get('format', VariantSettings.default_format))
+            except ImageServiceError as e:
+                return Utils.create_response(e.status_code, {"message": str(e)})
+
         try:
-            key_to_check_in_table, metadata, s3_key = self.fetch_s3_key_from_event_dict(event)
             image_id = event['pathParameters']['imageId']
+            user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
+                                                                                                 'default-user-id')
+            cached = image_cache.get(user_id, image_id, variant=variant)
+            if cached is not None:
+                access_tracker.record(user_id, image_id)
+                return Utils.create_response(200, cached, etag_of=Utils.image_version(cached['metadata'], variant),
+                                             **Utils.cache_options(event, 'get_image'))
+
+            key_to_check_in_table, metadata, s3_key = self.fetch_s3_key_from_event_dict(event)
+            if not Utils.is_committed(metadata):
+                raise ImageServiceError("Image not found", 404)
+            variant_status = 'ready'
+            if variant != 'original':
+                if variant in (metadata.get('variants') or {}):
+                    s3_key = metadata['variants'][variant]
+                else:
+                    if ImageVariants.claim_request(metadata, variant):
+                        ImageVariants.request(user_id, image_id, [variant])
+                    variant_status = 'pending'
+
             presigned_url = AWSActions.generate_presigned_url_for_object(
                 BUCKET_NAME,
                 s3_key
             )
+            access_tracker.record(user_id, image_id)
 
-            return Utils.create_response(200, {
+            response_body = {
                 'imageId': image_id,
                 'downloadUrl': presigned_url,
                 'metadata': metadata
-            })
+            }
+            if variant != 'original':
+                response_body['variant'] = {'name': variant, 'status': variant_status}
+            if variant_status != 'ready':
+                return Utils.create_response(200, response_body)
+            image_cache.put(user_id, image_id, response_body, variant=variant)
+            return Utils.create_response(200, response_body, etag_of=Utils.image_version(metadata, variant),
+                                         **Utils.cache_options(event, 'get_image'))
         except Exception as e:
             logger.error(f"Error retrieving image: {str(e)}")
-            return Utils.create_response(500, {"message": f'Internal server error::{str(e)}'})
+            return Utils.create_response(500, {"message": f'Internal server error::{str(e)}'}, error=e)
 
     def list_images(self,
                     event: dict[str, Any],
@@ -283,29 +4189,78 @@ class ImageServiceHandler:
                                                                                                   'default-user-id')
 
             query_params = event.get('queryStringParameters', {}) or {}
-            filter_expressions = ['userId = :userId']
-            expression_values = {':userId': user_id}
-            if 'title' in query_params:
-                filter_expressions.append('contains(title, :title)')
-                expression_values[':title'] = query_params['title']
-
-            if 'tag' in query_params:
-                filter_expressions.append('contains(tags, :tag)')
-                expression_values[':tag'] = query_params['tag']
-            response = AWSActions.scan_items_from_table(' AND '.join(filter_expressions),
-                                                        expression_values)
+            limit = Utils.parse_limit(query_params.get('limit'))
+            order = query_params.get('order', 'newest')
+            if order not in ListingRequirements.sort_orders:
+                raise ImageServiceError(f"Unsupported order: {order}")
 
-            return Utils.create_response(200, {
-                'images': response['Items'],
-                'count': len(response['Items'])
-            })
+            if 'title' in query_params or 'tag' in query_params:
+                return Utils.create_response(200, self.search_images(user_id, query_params, limit, order),
+                                             stream_key='images', **Utils.cache_options(event, 'list_images'))
 
+            exclusive_start_key = None
+            if query_params.get('nextToken'):
+                exclusive_start_key = Utils.decode_next_token(query_params['nextToken'], user_id)
 
+            response = AWSActions.query_items_from_table('userId = :userId',
+                                                         {':userId': user_id},
+                                                         index_name=ListingRequirements.user_index_name,
+                                                         limit=limit,
+                                                         exclusive_start_key=exclusive_start_key,
+                                                         scan_forward=ListingRequirements.sort_orders[order])
+
+            images = [item for item in response['Items'] if Utils.is_committed(item)]
+            return Utils.create_response(200, {
+                'images': images,
+                'count': len(images),
+                'nextToken': Utils.encode_next_token(response.get('LastEvaluatedKey'))
+            }, stream_key='images', **Utils.cache_options(event, 'list_images'))
+
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
         except Exception as e:
             logger.error(f"Error listing images: {str(e)}")
             return Utils.create_response(500, {
                 "message": f"Internal server error::{str(e)}"
-            })
+            }, error=e)
+
+    def search_images(self,
+                      user_id: str,
+                      query_params: dict[str, str],
+                      limit: int,
+                      order: str,
+                      /) -> dict[str, Any]:
+        """Answer title and tag filters from the search index, every term has to match, returns the body"""
+        tags = SearchIndex.normalize_tags(query_params.get('tag', ''))
+        tokens = SearchIndex.tokenize(query_params.get('title', ''))
+        terms = ([SearchIndex.term(user_id, 'tag', tag) for tag in tags] +
+                 [SearchIndex.term(user_id, 'token', token) for token in tokens])
+        if not terms:
+            raise ImageServiceError("title or tag has nothing to search for")
+
+        after = None
+        if query_params.get('nextToken'):
+            after = Utils.decode_next_token(query_params['nextToken'], user_id).get('sortKey')
+            if not isinstance(after, str):
+                raise ImageServiceError("Invalid nextToken")
+
+        image_ids, next_sort_key = SearchIndex.search(terms,
+                                                      limit=limit,
+                                                      newest_first=not ListingRequirements.sort_orders[order],
+                                                      after=after)
+        items, unprocessed_keys = AWSActions.batch_get_items_from_table([{'imageId': image_id, 'userId': user_id}
+                                                                         for image_id in image_ids])
+        if unprocessed_keys:
+            # nextToken moves past the whole page, a page missing matches would lose them for good
+            raise ServiceUnavailableError("Search results could not all be read")
+        items_by_id = {item['imageId']: item for item in items if Utils.is_committed(item)}
+        images = [items_by_id[image_id] for image_id in image_ids if image_id in items_by_id]
+        return {
+            'images': images,
+            'count': len(images),
+            'nextToken': Utils.encode_next_token(next_sort_key and {'userId': user_id, 'sortKey': next_sort_key})
+        }
 
     def delete_image(self,
                      event: dict[str, Any],
@@ -314,10 +4269,17 @@ class ImageServiceHandler:
         try:
             key_to_check_in_table, metadata, s3_key = self.fetch_s3_key_from_event_dict(event)
             image_id = event['pathParameters']['imageId']
-            AWSActions.delete_object_from_bucket(BUCKET_NAME, s3_key)
-            AWSActions.delete_an_item_from_table(
-                key_to_check_in_table
-            )
+            image_cache.invalidate(key_to_check_in_table['userId'], image_id)
+            # the item is marked deleting before anything goes, from there the delete only rolls
+            # forward: a failed or crashed attempt is finished by a retry or by ReconciliationJob
+            if self.claim_delete(key_to_check_in_table):
+                delete_blob = 'sha256' not in metadata or ContentStore.release(metadata['sha256'])
+                UsageAccounting.adjust(metadata['userId'], -int(metadata.get('sizeBytes') or 0), -1)
+            else:
+                # a resumed delete does not know whether the blob was released, an orphaned one
+                # is collected by ReconciliationJob
+                delete_blob = 'sha256' not in metadata
+            self.finish_delete(metadata, delete_blob)
 
             return Utils.create_response(200, {
                 'message': 'Image deleted successfully',
@@ -326,30 +4288,307 @@ class ImageServiceHandler:
 
         except Exception as e:
             logger.error(f"Error deleting image: {str(e)}")
-            return Utils.create_response(500, {"message": f"Internal server error::{str(e)}"})
+            return Utils.create_response(500, {"message": f"Internal server error::{str(e)}"}, error=e)
+
+    def claim_delete(self,
+                     key: dict[str, Any],
+                     /) -> bool:
+        """
+        Mark the item deleting, True for the one call which gets to release its blob and usage,
+        False when an earlier attempt did already and this one resumes it
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            AWSActions.update_item_in_table(key,
+                                            'SET #status = :deleting, statusChangedAt = :now, releasedAt = :now',
+                                            {':deleting': 'deleting', ':now': now, ':pending': 'pending'},
+                                            names={'#status': 'status'},
+                                            condition='attribute_exists(imageId) AND attribute_not_exists(releasedAt) AND '
+                                                      '(#status <> :pending OR attribute_not_exists(statusChangedAt))')
+        except Exception as e:
+            if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                raise
+            response = AWSActions.get_item_from_table(key, consistent=True)
+            if 'Item' not in response or (response['Item'].get('status') == 'pending'
+                                          and not Utils.is_committed(response['Item'])):
+                raise ImageServiceError("Image not found", 404)
+            return False
+        return True
+
+    @staticmethod
+    def finish_delete(metadata: dict[str, Any],
+                      delete_blob: bool,
+                      /) -> None:
+        """Remove what a deleting item points at, then the item itself, every step is safe to repeat"""
+        legs: list[tuple[Awaitable[Any], Callable[[], Awaitable[Any]] | None]] = []
+        if SearchIndex.item_terms(metadata):
+            legs.append((AsyncAWSActions.run(SearchIndex.remove, [metadata]), None))
+        if delete_blob and metadata.get('s3Key'):
+            legs.append((AsyncAWSActions.run(AWSActions.delete_object_from_bucket,
+                                             BUCKET_NAME,
+                                             metadata['s3Key']), None))
+        if metadata.get('variants'):
+            legs.append((AsyncAWSActions.run(AWSActions.delete_objects_from_bucket,
+                                             BUCKET_NAME,
+                                             list(metadata['variants'].values())), None))
+        if legs:
+            Utils.run_async(AsyncAWSActions.gather_with_rollback(*legs))
+        try:
+            AWSActions.delete_an_item_from_table({'imageId': metadata['imageId'], 'userId': metadata['userId']},
+                                                 condition='#status = :deleting',
+                                                 values={':deleting': 'deleting'},
+                                                 names={'#status': 'status'})
+        except Exception as e:
+            if Utils.client_error_code(e) != 'ConditionalCheckFailedException':
+                raise
+        return None
+
+    def fetch_image_key_pages(self,
+                              user_id: str,
+                              /) -> Iterator[list[dict[str, Any]]]:
+        """Page through the user index yielding imageId and s3Key of the images of the user, a page at a time"""
+        exclusive_start_key = None
+        while True:
+            response = AWSActions.query_items_from_table('userId = :userId',
+                                                         {':userId': user_id},
+                                                         index_name=ListingRequirements.user_index_name,
+                                                         limit=BatchSettings.delete_page_size,
+                                                         exclusive_start_key=exclusive_start_key)
+            yield [{'imageId': item['imageId'],
+                    'userId': user_id,
+                    'createdAt': item.get('createdAt'),
+                    's3Key': item.get('s3Key'),
+                    'variants': item.get('variants'),
+                    'sha256': item.get('sha256'),
+                    'tags': item.get('tags'),
+                    'titleTokens': item.get('titleTokens'),
+                    'sizeBytes': item.get('sizeBytes')}
+                   for item in response['Items']]
+            exclusive_start_key = response.get('LastEvaluatedKey')
+            if not exclusive_start_key:
+                return None
+
+    def delete_image_batch(self,
+                           user_id: str,
+                           items: list[dict[str, Any]],
+                           results: dict[str, dict[str, Any]],
+                           /) -> None:
+        """Claim, release and delete one bounded batch of images, recording the outcome of each in results"""
+        claims = Utils.run_async(AsyncAWSActions.map(
+            self.claim_delete, [{'imageId': item['imageId'], 'userId': user_id} for item in items]
+        ))
+        claimed_items, released_items = [], []
+        for item, claim in zip(items, claims):
+            if isinstance(claim, ImageServiceError):
+                results[item['imageId']] = {'imageId': item['imageId'], 'status': 'not_found'}
+            elif isinstance(claim, Exception):
+                results[item['imageId']] = {'imageId': item['imageId'], 'status': 'failed',
+                                            'message': str(claim)}
+            else:
+                claimed_items.append(item)
+                if claim:
+                    released_items.append(item)
+        items = claimed_items
+
+        s3_keys_to_delete = [variant_key for item in items for variant_key in (item.get('variants') or {}).values()]
+        s3_keys_to_delete.extend(item['s3Key'] for item in items if item.get('s3Key') and not item.get('sha256'))
+        shared_items = [item for item in released_items if item.get('s3Key') and item.get('sha256')]
+        releases = Utils.run_async(AsyncAWSActions.map(ContentStore.release,
+                                                       [item['sha256'] for item in shared_items]))
+        for item, last_reference in zip(shared_items, releases):
+            if isinstance(last_reference, Exception):
+                # the reference count may or may not have dropped, keeping the blob is the safe side
+                logger.error(f"Releasing blob of {item['imageId']} failed: {str(last_reference)}")
+            elif last_reference:
+                s3_keys_to_delete.append(item['s3Key'])
+        failed_s3_keys = AWSActions.delete_objects_from_bucket(BUCKET_NAME, s3_keys_to_delete)
+
+        keys_to_delete = []
+        for item in items:
+            if item.get('s3Key') in failed_s3_keys:
+                results[item['imageId']] = {'imageId': item['imageId'], 'status': 'failed',
+                                            'message': failed_s3_keys[item['s3Key']]}
+            else:
+                keys_to_delete.append({'imageId': item['imageId'], 'userId': user_id})
+
+        deleted_image_ids = {key['imageId'] for key in keys_to_delete}
+        for posting_key in SearchIndex.remove([item for item in items if item['imageId'] in deleted_image_ids]):
+            logger.warning("Search posting left behind: %s", posting_key['searchTerm'])
+        for key in keys_to_delete:
+            image_cache.invalidate(user_id, key['imageId'])
+            results[key['imageId']] = {'imageId': key['imageId'], 'status': 'deleted'}
+        for key in AWSActions.batch_delete_items_from_table(keys_to_delete):
+            results[key['imageId']] = {'imageId': key['imageId'], 'status': 'failed',
+                                       'message': 'Could not delete image metadata'}
+        # usage follows the claim, an item left deleting is gone for the user already
+        UsageAccounting.adjust(user_id, -sum(int(item.get('sizeBytes') or 0) for item in released_items),
+                               -len(released_items))
+        return None
+
+    def delete_images(self,
+                      event: dict[str, Any],
+                      /) -> dict[str, Any]:
+        """
+        delete many images at once, the body carries either imageIds or deleteAll
+        @event: it is dict which contains the details about the lambda handler event
+        """
+        try:
+            user_id = event.get('requestContext', {}).get('authorizer', {}).get('claims', {}).get('sub',
+                                                                                                 'default-user-id')
+            body = Utils.parse_event_body(event)
+            results: dict[str, dict[str, Any]] = {}
+            if body.get('deleteAll') is True:
+                batches: Iterable[list[dict[str, Any]]] = self.fetch_image_key_pages(user_id)
+            else:
+                image_ids = Utils.parse_image_ids(body)
+                results = {image_id: {'imageId': image_id, 'status': 'not_found'} for image_id in image_ids}
+                items, unprocessed_keys = AWSActions.batch_get_items_from_table(
+                    [{'imageId': image_id, 'userId': user_id} for image_id in image_ids],
+                    projection='imageId, userId, createdAt, s3Key, variants, sha256, tags, titleTokens, sizeBytes'
+                )
+                for key in unprocessed_keys:
+                    results[key['imageId']] = {'imageId': key['imageId'], 'status': 'failed',
+                                               'message': 'Could not read image metadata'}
+                batches = Utils.chunked(items, BatchSettings.delete_page_size)
+
+            for batch in batches:
+                if batch:
+                    self.delete_image_batch(user_id, batch, results)
+
+            statuses = [result['status'] for result in results.values()]
+            return Utils.create_response(200, {
+                'message': ResponseHeaders.message,
+                'deleted': statuses.count('deleted'),
+                'failed': statuses.count('failed'),
+                'notFound': statuses.count('not_found'),
+                'results': list(results.values())
+            })
+
+        except ImageServiceError as e:
+            logger.error(f"Validation error: {str(e)}")
+            return Utils.create_response(e.status_code, {"message": str(e)})
+        except Exception as e:
+            logger.error(f"Error deleting images: {str(e)}")
+            return Utils.create_response(500, {"message": f"Internal server error::{str(e)}"}, error=e)
+
+
+image_service = ImageServiceHandler()
 
 
 def lambda_handler(event: dict[str, Any],
                    context: Any,
                    /) -> dict[str, Any]:
     """Main Lambda handler which takes care of the api actions"""
-    logger.info(f"Received event: {json.dumps(event)}")
+    if 'httpMethod' not in event and 'variants' in event:
+        # ImageVariants.request invokes this function itself when no variant function is configured
+        return variant_event_handler(event, context)
+    StructuredLogging.log_event(event, context)
+    Resilience.start_invocation(context)
+    if not Instrumentation.enabled:
+        try:
+            return dispatch_request(event)
+        finally:
+            access_tracker.flush_if_due()
 
-    service = ImageServiceHandler()
+    Instrumentation.start_request(f"{event.get('httpMethod')} {event.get('resource')}")
+    response = None
+    try:
+        response = dispatch_request(event)
+        return response
+    finally:
+        access_tracker.flush_if_due()
+        Instrumentation.finish_request(response)
+
+
+def dispatch_request(event: dict[str, Any],
+                     /) -> dict[str, Any]:
+    """Route the event to the ImageServiceHandler method registered in Routes.table"""
     http_method = event['httpMethod']
     resource = event['resource']
 
     try:
-        if http_method == 'POST' and resource == '/images':
-            return service.upload_image(event)
-        elif http_method == 'DELETE' and resource == '/images/{imageId}':
-            return service.delete_image(event)
-        elif http_method == 'GET' and resource == '/images':
-            return service.list_images(event)
-        elif http_method == 'GET' and resource == '/images/{imageId}':
-            return service.get_image(event)
-        else:
-            return Utils.create_response(405, {"message": "Method Not Allowed"})
+        handler_name = Routes.table.get((http_method, resource))
+        if handler_name is None:
+            allowed_methods = Routes.allowed_methods(resource)
+            if not allowed_methods:
+                return Utils.create_response(404, {"message": "Not Found"})
+            return Utils.create_response(405, {"message": "Method Not Allowed"},
+                                         headers={'Allow': ', '.join(allowed_methods)})
+
+        return getattr(image_service, handler_name)(event)
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
-        return Utils.create_response(500, {'error': f'Internal server error::{str(e)}'})
+        return Utils.create_response(500, {'error': f'Internal server error::{str(e)}'}, error=e)
+
+
+def variant_event_handler(event: dict[str, Any],
+                          context: Any,
+                          /) -> dict[str, Any]:
+    """Async invoked handler which renders the variants scheduled by ImageVariants.request"""
+    variants = ImageVariants.generate(event['userId'], event['imageId'], event['variants'])
+    return {'imageId': event['imageId'], 'variants': variants}
+
+
+def s3_event_handler(event: dict[str, Any],
+                     context: Any,
+                     /) -> dict[str, Any]:
+    """S3 ObjectCreated handler which completes direct uploads without a client call"""
+    Resilience.start_invocation(context)
+    service = ImageServiceHandler()
+    registered, skipped = [], []
+    for record in event.get('Records', []):
+        s3_key = unquote_plus(record['s3']['object']['key'])
+        if not s3_key.startswith('images/'):
+            continue
+        try:
+            registered.append(service.register_uploaded_object(s3_key)['imageId'])
+        except ImageServiceError as e:
+            logger.warning(f"Skipping {s3_key}: {str(e)}")
+            skipped.append(s3_key)
+
+    return {'registered': registered, 'skipped': skipped}
+
+
+def processing_queue_handler(event: dict[str, Any],
+                             context: Any,
+                             /) -> dict[str, Any]:
+    """SQS handler for PROCESSING_QUEUE_URL, failed messages are reported back so only they are redelivered"""
+    Resilience.start_invocation(context)
+    records = event.get('Records', [])
+    failed_indexes = ImageProcessing.process_batch([json.loads(record['body']) for record in records])
+    return {'batchItemFailures': [{'itemIdentifier': records[index]['messageId']} for index in failed_indexes]}
+
+
+def tiering_job_handler(event: dict[str, Any],
+                        context: Any,
+                        /) -> dict[str, Any]:
+    """
+    Scheduled handler of TieringJob, stops short of the lambda timeout and returns complete False
+    with the runId, invoking it again with that runId resumes the run from its checkpoints
+    """
+    run_id = event.get('runId') or datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+    deadline = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = (time.monotonic() + context.get_remaining_time_in_millis() / 1000
+                    - TieringSettings.time_margin_seconds)
+    return TieringJob(run_id, total_segments=event.get('totalSegments'), deadline=deadline).run()
+
+
+def reconciliation_job_handler(event: dict[str, Any],
+                               context: Any,
+                               /) -> dict[str, Any]:
+    """
+    Scheduled handler of ReconciliationJob, stops short of the lambda timeout and returns
+    complete False, the next run starts over. {"dryRun": true} reports the drift without repairing it
+    """
+    deadline = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = (time.monotonic() + context.get_remaining_time_in_millis() / 1000
+                    - ConsistencySettings.time_margin_seconds)
+    return ReconciliationJob(deadline=deadline, dry_run=bool(event.get('dryRun'))).run()
+
+
+if ResilienceSettings.enabled:
+    Resilience.install()
+if MetricsSettings.enabled:
+    Instrumentation.install()
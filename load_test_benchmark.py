@@ -0,0 +1,316 @@
+"""
+Load test and benchmark harness for the image service routes
+
+The handlers run in process against an in-process moto server (the default) or any
+LocalStack compatible endpoint, which is written to AWSUtils.ENDPOINT_URL. Synthetic users and
+images are seeded first, then every route is driven by a pool of concurrent callers and the
+p50/p95/p99 latency, throughput and peak RSS are reported. The results are written as json and
+can be compared to the json of an earlier run to catch regressions between releases.
+
+    python load_test_benchmark.py --images 1000 --concurrency 1 --concurrency 100 --output bench.json
+    python load_test_benchmark.py --images 100000 --baseline bench.json --max-regression 20
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import sys
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
+
+import image_service_handler
+from image_service_handler import AWSActions, AWSClientRegistry, AWSUtils, BUCKET_NAME, ListingRequirements
+
+ROUTES = ('upload_image', 'list_images', 'get_image', 'delete_image')
+SAMPLE_PNG = base64.b64decode(b"iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8/wcAAgEB/RTmVQAAAABJRU5ErkJggg==")
+
+
+def start_moto_server() -> tuple[Any, str]:
+    """Start moto in a background thread on a free local port"""
+    from moto.server import ThreadedMotoServer
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'),
+                        ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        os.environ.setdefault(name, value)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+def create_resources() -> None:
+    """Bucket, metadata table with its user index, the blob, search and usage tables, skipping what already exists"""
+    s3_client = AWSActions.get_s3_client()
+    try:
+        s3_client.create_bucket(Bucket=BUCKET_NAME)
+    except Exception as e:
+        if image_service_handler.Utils.client_error_code(e) not in ('BucketAlreadyOwnedByYou',
+                                                                   'BucketAlreadyExists'):
+            raise
+
+    dynamodb_client = AWSClientRegistry.get_client('dynamodb', AWSUtils.ENDPOINT_URL)
+    existing_tables = dynamodb_client.list_tables()['TableNames']
+    metadata_table = AWSActions.get_dynamodb_table().name
+    if metadata_table not in existing_tables:
+        dynamodb_client.create_table(
+            TableName=metadata_table,
+            KeySchema=[{'AttributeName': 'imageId', 'KeyType': 'HASH'},
+                       {'AttributeName': 'userId', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'imageId', 'AttributeType': 'S'},
+                                  {'AttributeName': 'userId', 'AttributeType': 'S'},
+                                  {'AttributeName': 'createdAt', 'AttributeType': 'S'}],
+            GlobalSecondaryIndexes=[{
+                'IndexName': ListingRequirements.user_index_name,
+                'KeySchema': [{'AttributeName': 'userId', 'KeyType': 'HASH'},
+                              {'AttributeName': 'createdAt', 'KeyType': 'RANGE'}],
+                'Projection': {'ProjectionType': 'ALL'}
+            }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+    blob_table = AWSActions.get_blob_table().name
+    if blob_table not in existing_tables:
+        dynamodb_client.create_table(
+            TableName=blob_table,
+            KeySchema=[{'AttributeName': 'sha256', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'sha256', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+    search_table = AWSActions.get_search_table().name
+    if search_table not in existing_tables:
+        dynamodb_client.create_table(
+            TableName=search_table,
+            KeySchema=[{'AttributeName': 'searchTerm', 'KeyType': 'HASH'},
+                       {'AttributeName': 'sortKey', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'searchTerm', 'AttributeType': 'S'},
+                                  {'AttributeName': 'sortKey', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+    usage_table = AWSActions.get_usage_table().name
+    if usage_table not in existing_tables:
+        dynamodb_client.create_table(
+            TableName=usage_table,
+            KeySchema=[{'AttributeName': 'userId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'userId', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+
+def seed_images(users: int,
+                images: int,
+                /) -> dict[str, list[str]]:
+    """Write synthetic metadata items straight to the table, returns the image ids of every user"""
+    s3_key = 'benchmark/seed.png'
+    AWSActions.get_s3_client().put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=SAMPLE_PNG,
+                                          ContentType='image/png')
+    started_at = datetime.now(timezone.utc)
+    image_ids: dict[str, list[str]] = {f"benchmark-user-{index}": [] for index in range(users)}
+    user_ids = list(image_ids)
+
+    with AWSActions.get_dynamodb_table().batch_writer() as batch:
+        for index in range(images):
+            user_id = user_ids[index % users]
+            image_id = str(uuid.uuid4())
+            batch.put_item(Item={
+                'imageId': image_id,
+                'userId': user_id,
+                'fileName': f"{image_id}.png",
+                'contentType': 'image/png',
+                's3Key': s3_key,
+                'status': 'active',
+                'description': f"benchmark image {index}",
+                'createdAt': (started_at - timedelta(seconds=index)).isoformat(),
+                'variants': {}
+            })
+            image_ids[user_id].append(image_id)
+    return image_ids
+
+
+def build_event(route: str,
+                user_id: str,
+                image_id: str | None,
+                /) -> dict[str, Any]:
+    event: dict[str, Any] = {'requestContext': {'authorizer': {'claims': {'sub': user_id}}}}
+    if route == 'upload_image':
+        event.update(httpMethod='POST', resource='/images', isBase64Encoded=True,
+                     body=base64.b64encode(SAMPLE_PNG + uuid.uuid4().bytes).decode(),
+                     headers={'Content-Type': 'image/png',
+                              'X-Image-Metadata': json.dumps({'description': 'benchmark upload',
+                                                              'title': 'Benchmark upload',
+                                                              'tags': ['benchmark']})})
+    elif route == 'list_images':
+        event.update(httpMethod='GET', resource='/images', queryStringParameters={'limit': '50'})
+    elif route == 'get_image':
+        event.update(httpMethod='GET', resource='/images/{imageId}', pathParameters={'imageId': image_id})
+    elif route == 'delete_image':
+        event.update(httpMethod='DELETE', resource='/images/{imageId}', pathParameters={'imageId': image_id})
+    return event
+
+
+def percentile(sorted_values: list[float],
+               fraction: float,
+               /) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_route(route: str,
+              concurrency: int,
+              requests: int,
+              event_factory: Callable[[], dict[str, Any]],
+              /) -> dict[str, Any]:
+    """Drive one route with concurrent callers, events are built up front so only the handler is timed"""
+    events = [event_factory() for _ in range(requests)]
+
+    def invoke(event: dict[str, Any]) -> tuple[float, int]:
+        started = time.perf_counter()
+        response = image_service_handler.lambda_handler(event, None)
+        return (time.perf_counter() - started) * 1000, response['statusCode']
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(invoke, events))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in outcomes)
+    return {
+        'route': route,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': sum(1 for _, status_code in outcomes if status_code >= 400),
+        'p50Ms': round(percentile(latencies, 0.50), 3),
+        'p95Ms': round(percentile(latencies, 0.95), 3),
+        'p99Ms': round(percentile(latencies, 0.99), 3),
+        'meanMs': round(statistics.fmean(latencies), 3) if latencies else 0.0,
+        'throughputRps': round(requests / elapsed, 2) if elapsed else 0.0,
+        'peakRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    }
+
+
+def run_benchmark(args: argparse.Namespace,
+                  /) -> dict[str, Any]:
+    create_resources()
+    seeding_started = time.perf_counter()
+    image_ids = seed_images(args.users, args.images)
+    seed_seconds = time.perf_counter() - seeding_started
+
+    user_ids = list(image_ids)
+    deletable = [(user_id, image_id) for user_id, ids in image_ids.items() for image_id in ids]
+    random.shuffle(deletable)
+    results = []
+    for concurrency in args.concurrency:
+        for route in args.routes:
+            image_service_handler.image_cache.clear()
+            if route == 'delete_image':
+                def event_factory() -> dict[str, Any]:
+                    if not deletable:
+                        return build_event(route, 'none', 'none')
+                    user_id, image_id = deletable.pop()
+                    image_ids[user_id].remove(image_id)
+                    return build_event(route, user_id, image_id)
+            else:
+                def event_factory() -> dict[str, Any]:
+                    user_id = random.choice(user_ids)
+                    image_id = random.choice(image_ids[user_id]) if image_ids[user_id] else None
+                    return build_event(route, user_id, image_id)
+
+            result = run_route(route, concurrency, args.requests, event_factory)
+            result['cache'] = image_service_handler.image_cache.stats()
+            results.append(result)
+            print(f"{route:14} x{concurrency:<4} p50 {result['p50Ms']:9.2f} ms  p95 {result['p95Ms']:9.2f} ms  "
+                  f"p99 {result['p99Ms']:9.2f} ms  {result['throughputRps']:9.2f} req/s  "
+                  f"errors {result['errors']}  rss {result['peakRssMb']} MB")
+
+    return {
+        'generatedAt': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'endpointUrl': AWSUtils.ENDPOINT_URL,
+        'users': args.users,
+        'images': args.images,
+        'seedSeconds': round(seed_seconds, 2),
+        'results': results
+    }
+
+
+def find_regressions(report: dict[str, Any],
+                     baseline: dict[str, Any],
+                     max_regression: float,
+                     /) -> list[str]:
+    """p95 latencies which grew by more than max_regression percent compared to the baseline"""
+    baseline_results = {(result['route'], result['concurrency']): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        previous = baseline_results.get((result['route'], result['concurrency']))
+        if not previous or not previous['p95Ms']:
+            continue
+        change = (result['p95Ms'] - previous['p95Ms']) / previous['p95Ms'] * 100
+        if change > max_regression:
+            regressions.append(f"{result['route']} x{result['concurrency']}: p95 {previous['p95Ms']} ms -> "
+                               f"{result['p95Ms']} ms (+{change:.1f}%)")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint-url', default=None,
+                        help='run against this LocalStack compatible endpoint instead of an in-process moto server')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and concurrency level')
+    parser.add_argument('--concurrency', type=int, action='append', help='concurrent callers, repeatable')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=list(ROUTES))
+    parser.add_argument('--output', default=None, help='write the json report to this file')
+    parser.add_argument('--baseline', default=None, help='json report of an earlier run to compare against')
+    parser.add_argument('--max-regression', type=float, default=20.0, help='allowed p95 growth in percent')
+    args = parser.parse_args()
+    args.concurrency = args.concurrency or [1, 100]
+    image_service_handler.logger.setLevel(logging.WARNING)
+
+    server = None
+    if args.endpoint_url:
+        AWSUtils.ENDPOINT_URL = args.endpoint_url
+    else:
+        server, AWSUtils.ENDPOINT_URL = start_moto_server()
+    AWSClientRegistry.reset()
+
+    try:
+        report = run_benchmark(args)
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(report, json.load(baseline_file), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
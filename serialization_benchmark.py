@@ -0,0 +1,121 @@
+"""
+Serialization benchmark for the json backends
+
+Encodes list_images responses of the given sizes (DynamoDB shaped items, numbers as Decimal)
+with the previous json.dumps(default=str) and with Utils.create_response on every available
+JsonCodec backend, whole and streamed in batches, and decodes an upload envelope of the given size. Mean time and peak allocation per call are
+reported, the json results can be kept to compare backends or releases.
+
+    python serialization_benchmark.py --items 1000 --repeat 50 --output serialization.json
+"""
+import argparse
+import base64
+import json
+import os
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Callable
+
+from image_service_handler import JsonCodec, JsonSettings, Utils
+
+
+def build_listing(items: int,
+                  /) -> dict[str, Any]:
+    started_at = datetime.now(timezone.utc)
+    return {
+        'images': [{
+            'imageId': f"00000000-0000-0000-0000-{index:012d}",
+            'userId': 'benchmark-user',
+            'fileName': f"{index}.png",
+            'contentType': 'image/png',
+            's3Key': f"blobs/{index:064x}",
+            'status': 'active',
+            'title': f"benchmark image {index}",
+            'titleTokens': ['benchmark', 'image', str(index)],
+            'tags': ['benchmark', 'listing'],
+            'description': 'synthetic item for the serialization benchmark',
+            'createdAt': (started_at - timedelta(seconds=index)).isoformat(),
+            'width': Decimal(1024),
+            'height': Decimal(768),
+            'dominantColors': ['#0978c9', '#ffffff'],
+            'variants': {'thumb.webp': f"images/benchmark-user/{index}/thumb.webp"}
+        } for index in range(items)],
+        'count': items,
+        'nextToken': None
+    }
+
+
+def measure(function: Callable[[], Any],
+            repeat: int,
+            /) -> dict[str, float]:
+    function()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    mean_ms = (time.perf_counter() - started) / repeat * 1000
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'meanMs': round(mean_ms, 3), 'peakKb': round(peak / 1024, 1)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, action='append', help='items per listing, repeatable')
+    parser.add_argument('--upload-kb', type=int, default=4096, help='size of the decoded upload envelope')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--output', default=None, help='write the json results to this file')
+    args = parser.parse_args()
+
+    envelope = json.dumps({'body': base64.b64encode(os.urandom(args.upload_kb * 1024)).decode(),
+                           'headers': {'content-type': 'image/png',
+                                       'x-image-metadata': json.dumps({'description': 'benchmark'})}})
+    backends = ['stdlib']
+    try:
+        import orjson  # noqa: F401
+        backends.append('orjson')
+    except ImportError:
+        print("orjson is not installed, only the stdlib backend is measured")
+
+    results = []
+    for items in args.items or [1000]:
+        listing = build_listing(items)
+        results.append({'backend': 'json', 'case': 'json.dumps default=str', 'items': items,
+                        **measure(lambda: json.dumps(listing, default=str), args.repeat)})
+
+    original_backend, original_threshold = JsonCodec.backend(), JsonSettings.stream_threshold
+    JsonSettings.stream_threshold = 0
+    try:
+        for backend in backends:
+            JsonCodec.use(backend)
+            for items in args.items or [1000]:
+                listing = build_listing(items)
+                cases = {
+                    'create_response': lambda: Utils.create_response(200, listing),
+                    'create_response streamed': lambda: Utils.create_response(200, listing, stream_key='images')
+                }
+                for case, function in cases.items():
+                    results.append({'backend': backend, 'case': case, 'items': items,
+                                    **measure(function, args.repeat)})
+            results.append({'backend': backend, 'case': 'loads upload envelope', 'items': 1,
+                            **measure(lambda: JsonCodec.loads(envelope), args.repeat)})
+    finally:
+        JsonCodec.use(original_backend)
+        JsonSettings.stream_threshold = original_threshold
+
+    for result in results:
+        print(f"{result['backend']:7} {result['case']:26} {result['items']:6} items  "
+              f"mean {result['meanMs']:9.3f} ms  peak {result['peakKb']:10.1f} KB")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
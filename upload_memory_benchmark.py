@@ -0,0 +1,80 @@
+"""
+Memory benchmark for the upload_image decoding path
+
+Builds upload events for images of the given sizes in both envelopes, the raw binary body
+(api gateway binary media type with the metadata in headers) and the older json envelope, and
+measures with tracemalloc the peak memory allocated while the handler reads, validates and
+hashes the image. The event itself is excluded since lambda holds it either way. The overhead is
+reported as a multiple of the image size, 1.0 being the single decoded copy handed to S3.
+
+    python upload_memory_benchmark.py --size-mb 1 --size-mb 4 --output upload_memory.json
+"""
+import argparse
+import base64
+import json
+import tracemalloc
+
+from typing import Any
+
+from image_service_handler import ContentStore, ImageServiceHandler
+
+SAMPLE_PNG = base64.b64decode(b"iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8/wcAAgEB/RTmVQAAAABJRU5ErkJggg==")
+METADATA = json.dumps({'description': 'upload memory benchmark'})
+
+
+def build_event(envelope: str,
+                image: bytes,
+                /) -> dict[str, Any]:
+    auth_context = {'requestContext': {'authorizer': {'claims': {'sub': 'benchmark-user'}}}}
+    encoded_image = base64.b64encode(image).decode()
+    if envelope == 'binary':
+        return {**auth_context, 'isBase64Encoded': True, 'body': encoded_image,
+                'headers': {'Content-Type': 'image/png', 'X-Image-Metadata': METADATA}}
+    body = json.dumps({'body': encoded_image, 'headers': {'content-type': 'image/png', 'x-image-metadata': METADATA}})
+    return {**auth_context, 'isBase64Encoded': True, 'body': base64.b64encode(body.encode()).decode()}
+
+
+def measure(envelope: str,
+            size: int,
+            /) -> dict[str, Any]:
+    image = SAMPLE_PNG + bytes(size - len(SAMPLE_PNG))
+    event = build_event(envelope, image)
+    del image
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    _, _, image_body, _, _ = ImageServiceHandler().fetch_upload_from_event(event)
+    ContentStore.sha256_digest(image_body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'envelope': envelope,
+        'imageBytes': size,
+        'eventBytes': len(event['body']),
+        'peakBytes': peak - baseline,
+        'overhead': round((peak - baseline) / size, 2)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, action='append', help='image size in MB, repeatable')
+    parser.add_argument('--output', default=None, help='write the json results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for size_mb in args.size_mb or [1, 4]:
+        for envelope in ('binary', 'json'):
+            result = measure(envelope, int(size_mb * 1024 * 1024))
+            results.append(result)
+            print(f"{envelope:6} {result['imageBytes'] / 1024 / 1024:6.2f} MB image  "
+                  f"peak {result['peakBytes'] / 1024 / 1024:7.2f} MB  overhead {result['overhead']:.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()